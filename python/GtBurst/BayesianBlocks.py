@@ -4,9 +4,9 @@
 # Licensed under the Apache License, Version 2.0 (the "License");
 # you may not use this file except in compliance with the License.
 # You may obtain a copy of the License at
-# 
+#
 #   http://www.apache.org/licenses/LICENSE-2.0
-# 
+#
 # Unless required by applicable law or agreed to in writing, software
 # distributed under the License is distributed on an "AS IS" BASIS,
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
@@ -15,6 +15,7 @@
 
 import numpy as np
 import logging
+import math
 
 try:
   import numexpr
@@ -23,13 +24,25 @@ except:
   class _numexpr(object):
     def evaluate(self,expr):
       return eval(expr)
-  
+
   numexpr = _numexpr()
 
+try:
+  from numba import njit
+except ImportError:
+  #Without numba the pruned engine would run as plain python, which is slower
+  #than the vectorized O(N^2) loop. The latter is then used by default
+  njit = None
+
 logging.basicConfig(level=logging.INFO)
 logger                        = logging.getLogger("bayesian_blocks")
 
-__all__ = ['bayesian_blocks']    
+__all__ = ['bayesian_blocks', 'bayesian_blocks_binned']
+
+# Relative tolerance used when pruning change point candidates. A candidate is
+# discarded only if it is worse than the current optimum by more than this amount,
+# so that round-off can never remove the candidate the full search would choose
+_prune_tolerance              = 1e-12
 
 def bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution=None):
     """
@@ -48,6 +61,20 @@ def bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution=None):
     :return: the np.array containing the edges of the blocks
     """
 
+    return _bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution)
+
+def _bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution=None, engine=None):
+    """
+    Implementation of bayesian_blocks. The engine used to find the optimal
+    partition can be 'pruned' (the default when numba is available), 'numpy'
+    (the O(N^2) loop written with NumPy array operations, the default otherwise)
+    or 'legacy' (the original O(N^2) loop, kept for validation and benchmarking)
+    """
+
+    if engine is None:
+
+        engine = _default_engine
+
     # Verify that the input array is one-dimensional
     tt = np.asarray(tt, dtype=float)
 
@@ -95,15 +122,151 @@ def bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution=None):
 
     N = t.shape[0]
 
-    # arrays to store the best configuration
-    best = np.zeros(N, dtype=float)
-    last = np.zeros(N, dtype=int)
-
     # eq. 21 from Scargle 2012
     prior = 4 - np.log(73.53 * p0 * (N**-0.478))
 
     logger.debug("Finding blocks...")
 
+    if engine == 'legacy':
+
+        last = _legacy_partition(block_length, prior)
+
+    elif engine in ('pruned', 'numpy'):
+
+        # Number of events from each cell to the end (one event per cell)
+        n_remaining = np.arange(N, -1, -1, dtype=float)
+
+        if engine == 'pruned':
+
+            last = _pruned_partition(block_length, n_remaining, prior)
+
+        else:
+
+            last = _numpy_partition(block_length, n_remaining, prior)
+
+    else:
+
+        raise ValueError("Unknown engine %s" % engine)
+
+    logger.debug("Done\n")
+
+    edg = edges[_change_points(last)]
+
+    # Transform the found edges back into the original time system
+
+    if (bkg_integral_distribution is not None):
+
+        final_edges = [lookup_table[x] for x in edg]
+
+    else:
+
+        final_edges = edg
+
+    # Now fix the first and last edge so that they are tstart and tstop
+    final_edges[0] = ttstart
+    final_edges[-1] = ttstop
+
+    return np.asarray(final_edges)
+
+def bayesian_blocks_binned(bin_start, bin_stop, counts, exposure, p0):
+    """
+    Divide a binned light curve in blocks of perceptibly constant count rate.
+    This uses the binned version of the fitness function (Scargle et al. 2012),
+    so the cost scales with the number of bins and not with the number of counts.
+
+    :param bin_start: start time of each bin (bins must be sorted and non-overlapping)
+    :param bin_stop: stop time of each bin
+    :param counts: number of counts in each bin
+    :param exposure: exposure (livetime) of each bin. Must be positive
+    :param p0: the false positive probability. This is used to decide the penalization on the likelihood, so this
+    parameter affects the number of blocks
+    :return: the np.array containing the edges of the blocks
+    """
+
+    bin_start = np.asarray(bin_start, dtype=float)
+    bin_stop = np.asarray(bin_stop, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    exposure = np.asarray(exposure, dtype=float)
+
+    assert bin_start.ndim == 1
+    assert bin_start.shape == bin_stop.shape == counts.shape == exposure.shape
+
+    if np.any(bin_start[1:] < bin_stop[:-1]) or np.any(bin_stop < bin_start):
+
+        raise RuntimeError("Bins appears to be out of order or overlapping! Check the input light curve.")
+
+    if np.any(exposure <= 0):
+
+        raise RuntimeError("Bins must have a positive exposure. Remove bins with no exposure before "
+                           "running the Bayesian Blocks.")
+
+    N = bin_start.shape[0]
+
+    # Exposure and number of counts from each bin to the end
+    block_length = np.concatenate([np.cumsum(exposure[::-1])[::-1], [0.0]])
+    n_remaining = np.concatenate([np.cumsum(counts[::-1])[::-1], [0.0]])
+
+    # eq. 21 from Scargle 2012, with N the number of bins
+    prior = 4 - np.log(73.53 * p0 * (N**-0.478))
+
+    logger.debug("Finding blocks...")
+
+    if _default_engine == 'pruned':
+
+        last = _pruned_partition(block_length, n_remaining, prior)
+
+    else:
+
+        last = _numpy_partition(block_length, n_remaining, prior)
+
+    logger.debug("Done\n")
+
+    change_points = _change_points(last)
+
+    # Each block starts at the beginning of its first bin, and the last one
+    # ends at the end of the last bin
+    return np.append(bin_start[change_points[:-1]], bin_stop[-1])
+
+def _change_points(last):
+    """
+    Peel off the optimal partition found by the dynamic program (see the algorithm
+    in Scargle et al.), returning the index of the first cell of each block plus the
+    total number of cells.
+    """
+
+    N = last.shape[0]
+
+    change_points = np.zeros(N + 1, dtype=int)
+    i_cp = N + 1
+    ind = N
+
+    while True:
+
+        i_cp -= 1
+
+        change_points[i_cp] = ind
+
+        if ind == 0:
+
+            break
+
+        ind = last[ind - 1]
+
+    return change_points[i_cp:]
+
+def _legacy_partition(block_length, prior):
+    """
+    Original O(N^2) dynamic program of Scargle et al. 2012 for unbinned events.
+    Returns the array of the last change point of the optimal partition
+    ending at each cell.
+    """
+
+    N = block_length.shape[0] - 1
+
+    # arrays to store the best configuration
+    best = np.zeros(N, dtype=float)
+    last = np.zeros(N, dtype=int)
+
     # This is where the computation happens. Following Scargle et al. 2012.
     # This loop has been optimized for speed:
     # * the expression for the fitness function has been rewritten to
@@ -168,47 +331,384 @@ def bayesian_blocks(tt, ttstart, ttstop, p0, bkg_integral_distribution=None):
 
     numexpr.set_vml_accuracy_mode(oldaccuracy)
 
-    logger.debug("Done\n")
+    return last
 
-    # Now peel off and find the blocks (see the algorithm in Scargle et al.)
-    change_points = np.zeros(N, dtype=int)
-    i_cp = N
-    ind = N
+def _numpy_partition(block_length, n_remaining, prior):
+    """
+    O(N^2) dynamic program of Scargle et al. 2012 written with NumPy array
+    operations, for binned or unbinned data (see _pruned_partition for the
+    parameters). Returns the array of the last change point of the optimal
+    partition ending at each cell.
+    """
 
-    while True:
+    N = block_length.shape[0] - 1
 
-        i_cp -= 1
+    best = np.zeros(N, dtype=float)
+    last = np.zeros(N, dtype=int)
 
-        change_points[i_cp] = ind
+    # Work buffers, reused at each step
+    N_buffer = np.empty(N, dtype=float)
+    fit_buffer = np.empty(N, dtype=float)
 
-        if ind == 0:
+    has_empty_blocks = np.any(n_remaining[:-1] == n_remaining[1:])
 
-            break
+    with np.errstate(divide='ignore', invalid='ignore'):
 
-        ind = last[ind - 1]
+        for R in range(N):
 
-    change_points = change_points[i_cp:]
+            N_k = np.subtract(n_remaining[:R + 1], n_remaining[R + 1], out=N_buffer[:R + 1])
+            fit_vec = np.subtract(block_length[:R + 1], block_length[R + 1], out=fit_buffer[:R + 1])
 
-    edg = edges[change_points]
+            # Fitness function N_k * log(N_k / T_k)
+            np.divide(N_k, fit_vec, out=fit_vec)
+            np.log(fit_vec, out=fit_vec)
+            fit_vec *= N_k
 
-    # Transform the found edges back into the original time system
+            if has_empty_blocks:
 
-    if (bkg_integral_distribution is not None):
+                # Blocks without counts have a null fitness
+                fit_vec[N_k == 0] = 0.0
 
-        final_edges = [lookup_table[x] for x in edg]
+            fit_vec -= prior
+
+            fit_vec[1:] += best[:R]
+
+            i_max = fit_vec.argmax()
+
+            last[R] = i_max
+            best[R] = fit_vec[i_max]
+
+    return last
+
+# The pruned engine.
+#
+# The fitness of a block with n events and length t is n log(n/t), which is the
+# maximum over x = log(rate) of h(x) = n (x + 1) - t exp(x). Following the
+# functional pruning of Maidstone et al. 2017 (FPOP), for each candidate start i
+# of the last block we keep track of the values of x for which the candidate can
+# still be better than all the others. All candidates receive the same
+# contribution from the cells yet to come, so once this set is empty candidate i
+# can never be optimal again and it is dropped. Unlike plain PELT pruning, this
+# also works on stretches without any change of rate, so the number of surviving
+# candidates stays small and the cost is close to linear in the number of cells.
+#
+# The set of each candidate is stored as an interval [lo, hi] (the values of x
+# where it beats every candidate opened after it) minus an excluded interval
+# [ex_lo, ex_hi] (where it was already beaten, when it was opened, by the
+# candidates opened before it). Every bound is checked against h(x) with a
+# small tolerance, so a candidate is dropped only if it is worse by more than
+# round-off.
+#
+# The functions below are written with scalar loops so that numba can compile
+# them. Only a handful of candidates survive at each step, so even without numba
+# (when they run as plain python) the cost stays linear in the number of cells,
+# but with a large constant: below a few tens of thousands of cells they are then
+# slower than the vectorized O(N^2) loop of _numpy_partition.
+
+def _candidate_intervals(n, t, d, tol):
+    """
+    Consider a candidate with n events and length t after its start, whose best
+    partition before the start is worse by d than the one of a new candidate.
+    Return (lo, hi, in_lo, in_hi), where [lo, hi] contains all x such that
+    h(x) >= d - tol, and all x in [in_lo, in_hi] have h(x) >= d + tol.
+    Empty intervals have lo > hi.
+    """
+
+    if n > 0 and t > 0:
+
+        xs = math.log(n / t)
+        h_max = n * xs
+
+        if h_max < d - tol:
+
+            return 1.0, -1.0, 1.0, -1.0
+
+        # Solve exp(y) - y - 1 = s on both sides of y = 0, with y = x - xs.
+        # Newton's method approaches both roots from outside
+        s = max(h_max - d, 0.0) / n
+
+        # Right root: sqrt(2s) is always beyond it
+        yr = math.sqrt(2.0 * s)
+
+        for _ in range(50):
+
+            if yr <= 0:
+
+                break
+
+            step = (math.expm1(yr) - yr - s) / math.expm1(yr)
+            yr -= step
+
+            if step <= 1e-10 * (1.0 + yr):
+
+                break
+
+        # Left root: -(s + 1) is always beyond it
+        yl = -(s + 1.0)
+
+        for _ in range(50):
+
+            if yl >= 0:
+
+                break
+
+            step = (math.expm1(yl) - yl - s) / math.expm1(yl)
+            yl -= step
+
+            if -step <= 1e-10 * (1.0 - yl):
+
+                break
+
+        # Outer interval, at level d - tol
+        lo = -np.inf
+        pad = 1e-8 * (1.0 - yl)
+
+        for _ in range(10):
+
+            x = xs + yl - pad
+
+            if n * (x + 1.0) - t * math.exp(x) < d - tol:
+
+                lo = x
+                break
+
+            pad *= 10.0
+
+        hi = np.inf
+        pad = 1e-8 * (1.0 + yr)
+
+        for _ in range(10):
+
+            x = xs + yr + pad
+
+            if n * (x + 1.0) - t * math.exp(x) < d - tol:
+
+                hi = x
+                break
+
+            pad *= 10.0
+
+        # Inner interval, at level d + tol
+        in_lo = 1.0
+        in_hi = -1.0
+
+        if h_max >= d + tol:
+
+            shrink = 1e-8
+
+            for _ in range(9):
+
+                a = xs + yl * (1.0 - shrink)
+                b = xs + yr * (1.0 - shrink)
+
+                if (n * (a + 1.0) - t * math.exp(a) >= d + tol and
+                    n * (b + 1.0) - t * math.exp(b) >= d + tol):
+
+                    in_lo = a
+                    in_hi = b
+                    break
+
+                shrink = min(10.0 * shrink, 1.0)
+
+        return lo, hi, in_lo, in_hi
+
+    # Degenerate cases (only possible with binned data or duplicated events).
+    # These never contribute to the excluded interval
+
+    d = d - tol
+
+    if n > 0:
+
+        # Zero length: h(x) is a straight line
+        return d / n - 1.0, np.inf, 1.0, -1.0
+
+    elif t > 0:
+
+        # No events: h(x) is negative and decreasing
+        if d < 0:
+
+            return -np.inf, math.log(-d / t), 1.0, -1.0
+
+        else:
+
+            return 1.0, -1.0, 1.0, -1.0
 
     else:
 
-        final_edges = edg
+        if d <= 0:
 
-    # Now fix the first and last edge so that they are tstart and tstop
-    final_edges[0] = ttstart
-    final_edges[-1] = ttstop
+            return -np.inf, np.inf, 1.0, -1.0
 
-    return np.asarray(final_edges)
+        else:
+
+            return 1.0, -1.0, 1.0, -1.0
+
+def _pruned_partition_scalar(block_length, n_remaining, prior):
+
+    n_cells = block_length.shape[0] - 1
+
+    best = np.zeros(n_cells)
+    last = np.zeros(n_cells, dtype=np.int64)
+
+    candidates = np.empty(n_cells, dtype=np.int64)
+    lo = np.empty(n_cells)
+    hi = np.empty(n_cells)
+    ex_lo = np.empty(n_cells)
+    ex_hi = np.empty(n_cells)
+
+    # Work space for the intervals where the old candidates beat the new one
+    dominated_lo = np.empty(n_cells)
+    dominated_hi = np.empty(n_cells)
+
+    n_candidates = 0
+
+    for R in range(n_cells):
+
+        new_ex_lo = 1.0
+        new_ex_hi = -1.0
+
+        if R > 0:
+
+            # Compare the candidates with a new block starting at R
+            best_previous = best[R - 1]
+            anchor = -1
+            n_kept = 0
+
+            for c in range(n_candidates):
+
+                i = candidates[c]
+
+                best_i = best[i - 1] if i > 0 else 0.0
+
+                n = n_remaining[i] - n_remaining[R]
+                t = block_length[i] - block_length[R]
+
+                tol = _prune_tolerance * (abs(best_previous) + abs(best_i) + 1.0)
+
+                this_lo, this_hi, dominated_lo[c], dominated_hi[c] = _candidate_intervals(n, t,
+                                                                                         best_previous - best_i,
+                                                                                         tol)
+
+                if i == last[R - 1]:
+
+                    anchor = c
+
+                this_lo = max(lo[c], this_lo)
+                this_hi = min(hi[c], this_hi)
+
+                if this_lo <= this_hi and not (ex_lo[c] <= this_lo and this_hi <= ex_hi[c]):
+
+                    candidates[n_kept] = i
+                    lo[n_kept] = this_lo
+                    hi[n_kept] = this_hi
+                    ex_lo[n_kept] = ex_lo[c]
+                    ex_hi[n_kept] = ex_hi[c]
+                    n_kept += 1
+
+            # The new candidate is beaten wherever an old candidate is better by more
+            # than the tolerance. Start from the best old candidate and merge all the
+            # intervals overlapping with it
+            if anchor >= 0 and dominated_lo[anchor] <= dominated_hi[anchor]:
+
+                new_ex_lo = dominated_lo[anchor]
+                new_ex_hi = dominated_hi[anchor]
+
+                for _ in range(5):
+
+                    changed = False
+
+                    for c in range(n_candidates):
+
+                        if (dominated_lo[c] <= dominated_hi[c] and
+                            dominated_lo[c] <= new_ex_hi and dominated_hi[c] >= new_ex_lo and
+                            (dominated_lo[c] < new_ex_lo or dominated_hi[c] > new_ex_hi)):
+
+                            new_ex_lo = min(new_ex_lo, dominated_lo[c])
+                            new_ex_hi = max(new_ex_hi, dominated_hi[c])
+                            changed = True
+
+                    if not changed:
+
+                        break
+
+            n_candidates = n_kept
+
+        candidates[n_candidates] = R
+        lo[n_candidates] = -np.inf
+        hi[n_candidates] = np.inf
+        ex_lo[n_candidates] = new_ex_lo
+        ex_hi[n_candidates] = new_ex_hi
+        n_candidates += 1
+
+        # Find the best start of the last block among the survivors. The candidates
+        # are sorted, so in case of ties we select the first one like argmax would
+        br = block_length[R + 1]
+        nr = n_remaining[R + 1]
+
+        best_value = -np.inf
+        i_max = 0
+
+        for c in range(n_candidates):
+
+            i = candidates[c]
+
+            N_k = n_remaining[i] - nr
+            T_k = block_length[i] - br
+
+            if N_k > 0:
+
+                fitness = N_k * math.log(N_k / T_k)
+
+            else:
+
+                fitness = 0.0
+
+            A = fitness - prior
+
+            if i > 0:
+
+                A += best[i - 1]
+
+            if A > best_value:
+
+                best_value = A
+                i_max = i
+
+        best[R] = best_value
+        last[R] = i_max
+
+    return last
+
+if njit is not None:
+
+    _candidate_intervals = njit(cache=True, error_model='numpy')(_candidate_intervals)
+    _pruned_partition_scalar = njit(cache=True, error_model='numpy')(_pruned_partition_scalar)
+
+    _default_engine = 'pruned'
+
+else:
+
+    _default_engine = 'numpy'
+
+def _pruned_partition(block_length, n_remaining, prior):
+    """
+    Find the optimal partition with the pruned engine. Returns the array of the
+    last change point of the optimal partition ending at each cell.
+
+    :param block_length: for each cell edge, the length (or exposure) from that edge
+    to the end of the interval
+    :param n_remaining: for each cell edge, the number of events from that edge to the
+    end of the interval
+    :param prior: the penalty for each block
+    """
+
+    block_length = np.ascontiguousarray(block_length, dtype=float)
+    n_remaining = np.ascontiguousarray(n_remaining, dtype=float)
+
+    return _pruned_partition_scalar(block_length, n_remaining, float(prior))
 
 #To be run with a profiler
 if __name__=="__main__":
     tt                        = np.random.uniform(0,1000,30000)
     tt.sort()
-    res                       = bayesian_blocks(tt,1e-3,None)
+    res                       = bayesian_blocks(tt,0,1000,1e-3)
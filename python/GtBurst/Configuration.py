@@ -40,6 +40,37 @@ class Configuration(object):
           
           self.configuration['maxNumberOfCPUs'] = multiprocessing.cpu_count()
       
+      # Max. size (MB) of the cache of livetime cubes and exposure maps (0 disables it)
+      
+      if os.environ.get("GTBURST_PRODUCT_CACHE_SIZE") is not None:
+          
+          self.configuration['productCacheSize'] = os.environ.get("GTBURST_PRODUCT_CACHE_SIZE")
+      
+      else:
+          
+          self.configuration['productCacheSize'] = 2000
+      
+      # Directory of the cache of downloaded data, which can be shared among users (empty disables it)
+      
+      if os.environ.get("GTBURST_CACHE") is not None:
+          
+          self.configuration['dataCache'] = os.environ.get("GTBURST_CACHE")
+      
+      else:
+          
+          self.configuration['dataCache'] = ''
+      
+      # Check the result of the parallel gtdiffrsp against the standard one (yes/no).
+      # This doubles the time needed to compute the diffuse response
+      
+      if os.environ.get("GTBURST_VALIDATE_DIFFRSP") is not None:
+          
+          self.configuration['validateDiffuseResponse'] = os.environ.get("GTBURST_VALIDATE_DIFFRSP")
+      
+      else:
+          
+          self.configuration['validateDiffuseResponse'] = 'no'
+      
       if not os.path.exists(self.configuration['dataRepository']):
         
         #Create it!
@@ -49,6 +80,9 @@ class Configuration(object):
       self.description['dataRepository'] = 'Directory for the storage of data'
       self.description['ftpWebsite']     = 'FTP data repository'
       self.description['maxNumberOfCPUs']= 'Max. number of CPUs to use'
+      self.description['productCacheSize']= 'Max. size of the cache of livetime cubes and exposure maps (MB)'
+      self.description['dataCache']      = 'Directory of the cache of downloaded data, shared among users (empty to disable)'
+      self.description['validateDiffuseResponse'] = 'Check the parallel gtdiffrsp against the standard one (yes/no)'
     
     def set(self,key,value):
 
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import time
+
+from GtBurst.Configuration import Configuration
+from GtBurst.ProductCache import ProductCache
+
+
+class DataCache(ProductCache):
+    '''
+    A read-through cache of the data files downloaded for each trigger, which can be shared by
+    all the users of a machine (or of a farm, on a shared file system). The directory is set by
+    the dataCache configuration key (GTBURST_CACHE), and the cache is disabled if it is empty.
+
+    Files are stored as [instrument]/[trigger]/[file name], where the file name contains the
+    version of the file. Files which depend on a data selection (like the LAT data from a query)
+    are stored in a further sub-directory identified by a hash of the selection. The index
+    records size and checksum of each file. Files are written to a temporary file and then
+    renamed, and never modified in place, so they can be copied out of the cache without
+    holding the lock on the index, and a copy is used only if its checksum matches the one
+    in the index.
+
+    To share the cache among users, they must belong to a common group owning the cache
+    directory. Directories are created group-writable with the setgid bit (so that everything
+    below them belongs to the same group), and files group-writable, independently of the umask
+    of the user. Errors in reading or writing the cache (permissions, full file system...) are
+    reported and treated as a miss by get() and ignored by put(), so they never stop a download.
+    '''
+
+    fileMode = 0o664
+    directoryMode = 0o2775
+
+    def __init__(self, directory=None):
+
+        if (directory is None):
+            directory = Configuration().get('dataCache')
+        pass
+
+        if (directory is None or str(directory).strip() == ''):
+
+            # Disabled
+            ProductCache.__init__(self, directory='.', maxSize=0)
+
+        else:
+
+            try:
+
+                # There is no eviction: the files are removed only with clear()
+                ProductCache.__init__(self, directory=str(directory), maxSize=float('inf'))
+
+            except (IOError, OSError) as error:
+
+                print("\nWARNING: cannot use the data cache in %s (%s). Disabling it.\n" % (directory, error))
+                ProductCache.__init__(self, directory='.', maxSize=0)
+
+            pass
+
+        pass
+
+    pass
+
+    @staticmethod
+    def _getRelativePath(instrument, trigger, filename, selection=None):
+
+        if (selection is not None):
+
+            digest = ProductCache.getKey('selection', **selection).split("_")[-1]
+
+            return os.path.join(instrument, trigger, digest, filename)
+
+        else:
+
+            return os.path.join(instrument, trigger, filename)
+
+        pass
+
+    pass
+
+    @staticmethod
+    def _copy(source, destination):
+        # Copy source to a temporary file next to destination, and return its name
+        # and the checksum of the content
+
+        temporaryFile = "%s.%s.tmp" % (destination, os.getpid())
+
+        digest = hashlib.sha1()
+
+        try:
+
+            with open(source, 'rb') as f:
+
+                with open(temporaryFile, 'wb') as out:
+
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                        out.write(block)
+                    pass
+
+                pass
+
+            pass
+
+        except (IOError, OSError):
+
+            # Do not leave partial copies around (for example when the file system is full)
+            if (os.path.exists(temporaryFile)):
+                os.remove(temporaryFile)
+            pass
+
+            raise
+
+        pass
+
+        return temporaryFile, digest.hexdigest()
+
+    pass
+
+    def _makeDirectories(self, directory):
+        # Like os.makedirs, but giving to each new directory the permissions of the cache
+
+        if (os.path.isdir(directory)):
+            return
+
+        self._makeDirectories(os.path.dirname(directory))
+
+        try:
+            os.mkdir(directory)
+        except OSError:
+            # Already existing (maybe created by another process)
+            if (not os.path.isdir(directory)):
+                raise
+        pass
+
+        self._setMode(directory, self.directoryMode)
+
+    pass
+
+    def get(self, instrument, trigger, filename, destination, selection=None):
+        '''
+        If the file is in the cache, copy it to destination and return True, otherwise return False
+        '''
+
+        if (not self.isEnabled()):
+            return False
+
+        try:
+
+            return self._get(instrument, trigger, filename, destination, selection)
+
+        except (IOError, OSError) as error:
+
+            print("\nWARNING: could not read %s from the data cache (%s)\n" % (filename, error))
+
+            return False
+
+        pass
+
+    pass
+
+    def _get(self, instrument, trigger, filename, destination, selection):
+
+        path = self._getRelativePath(instrument, trigger, filename, selection)
+
+        with self._lockedIndex() as index:
+
+            entry = index['products'].get(path)
+
+            if (entry is None):
+                index['misses'] += 1
+
+                return False
+            pass
+
+        pass
+
+        try:
+
+            temporaryFile, digest = self._copy(os.path.join(self.directory, path), destination)
+
+        except (IOError, OSError):
+
+            # Removed by clear() in the meantime, or destination not writable
+            digest = None
+            temporaryFile = None
+
+        pass
+
+        good = (digest == entry['sha1'])
+
+        if (good):
+            os.rename(temporaryFile, destination)
+        elif (temporaryFile is not None and os.path.exists(temporaryFile)):
+            os.remove(temporaryFile)
+        pass
+
+        with self._lockedIndex() as index:
+
+            current = index['products'].get(path)
+
+            if (good):
+
+                index['hits'] += 1
+
+                if (current is not None):
+                    current['lastAccess'] = time.time()
+                    current['hits'] += 1
+                pass
+
+            else:
+
+                index['misses'] += 1
+
+                if (current is not None and current['sha1'] == entry['sha1']):
+                    # Corrupted: forget it, it will be stored again after the download
+                    index['products'].pop(path)
+                pass
+
+            pass
+
+        pass
+
+        return good
+
+    pass
+
+    def put(self, instrument, trigger, filename, source, selection=None):
+        '''
+        Store a copy of the file source in the cache
+        '''
+
+        if (not self.isEnabled()):
+            return
+
+        try:
+
+            self._put(instrument, trigger, filename, source, selection)
+
+        except (IOError, OSError) as error:
+
+            print("\nWARNING: could not store %s in the data cache (%s)\n" % (filename, error))
+
+        pass
+
+    pass
+
+    def _put(self, instrument, trigger, filename, source, selection):
+
+        path = self._getRelativePath(instrument, trigger, filename, selection)
+        cachedFile = os.path.join(self.directory, path)
+
+        self._makeDirectories(os.path.dirname(cachedFile))
+
+        # Copy outside of the lock, then move in place (which is atomic)
+        temporaryFile, digest = self._copy(source, cachedFile)
+
+        try:
+            self._setMode(temporaryFile, self.fileMode)
+            os.rename(temporaryFile, cachedFile)
+        except OSError:
+            os.remove(temporaryFile)
+            raise
+        pass
+
+        with self._lockedIndex() as index:
+
+            now = time.time()
+            index['products'][path] = {'file': path, 'size': os.path.getsize(cachedFile), 'sha1': digest,
+                                       'created': now, 'lastAccess': now, 'hits': 0}
+
+        pass
+
+    pass
+
+
+pass
@@ -0,0 +1,345 @@
+import ftplib
+import os
+import threading
+import time
+
+from GtBurst.GtBurstException import GtBurstException
+from GtBurst import downloadCallback
+
+
+class FTPDownloader(object):
+    '''
+    Download files from a directory of a FTP server over a small pool of persistent connections,
+    each one used by a thread fetching the next file in the list.
+
+    Each file is first written to a ".part" file, which is renamed only once its size matches
+    the size of the remote file. When a transfer fails the connection is opened again and the
+    transfer resumes (with REST) from the end of the ".part" file, up to maxTrials times per
+    file. A partial file left by a previous (interrupted) download is resumed as well.
+    '''
+
+    def __init__(self, serverAddress, directory, nConnections=4, maxTrials=10, timeout=60, useTLS=True):
+
+        # serverAddress can be "host" or "host:port"
+        if (serverAddress.find(":") > 0):
+            self.host, port = serverAddress.split(":")
+            self.port = int(port)
+        else:
+            self.host = serverAddress
+            self.port = 0
+        pass
+
+        self.directory = directory
+        self.nConnections = max(1, int(nConnections))
+        self.maxTrials = int(maxTrials)
+        self.timeout = timeout
+        self.useTLS = useTLS
+
+        self._lock = threading.Lock()
+
+    pass
+
+    def connect(self):
+        '''
+        Open a new connection and log in as anonymous. The connection is not yet in the directory
+        '''
+
+        if (self.useTLS):
+            ftp = ftplib.FTP_TLS(timeout=self.timeout)
+        else:
+            ftp = ftplib.FTP(timeout=self.timeout)
+        pass
+
+        ftp.connect(self.host, self.port)
+        ftp.login()
+
+        if (self.useTLS):
+            ftp.prot_p()
+        pass
+
+        return ftp
+
+    pass
+
+    def _openDirectory(self):
+
+        ftp = self.connect()
+        ftp.cwd(self.directory)
+
+        return ftp
+
+    pass
+
+    @staticmethod
+    def _close(ftp):
+
+        try:
+            ftp.close()
+        except:
+            pass
+
+    pass
+
+    @staticmethod
+    def getRemoteSize(ftp, filename):
+        '''
+        Return the size of the remote file, from the SIZE command or, if the server
+        does not support it, from the listing of the file
+        '''
+
+        try:
+            ftp.voidcmd('TYPE I')
+            size = ftp.size(filename)
+        except ftplib.error_perm:
+            size = None
+        pass
+
+        if (size is None):
+            g = downloadCallback.get_size()
+            ftp.dir(filename, g)
+            size = g.size
+        pass
+
+        return int(size)
+
+    pass
+
+    def getStatus(self):
+        '''
+        Return a dictionary with the progress of the download: number of files done and total,
+        bytes transferred, elapsed time and, for each file being downloaded, (bytes on disk, size)
+        '''
+
+        with self._lock:
+            return {'filesDone': self._filesDone,
+                    'filesTotal': self._filesTotal,
+                    'bytes': self._bytes,
+                    'elapsed': time.time() - self._start,
+                    'activeFiles': dict([(k, tuple(v)) for k, v in list(self._activeFiles.items())])}
+
+    pass
+
+    def download(self, filenames, destination, connection=None, progress=None, refreshTime=0.2):
+        '''
+        Download the files in the destination directory. connection, if given, is an open
+        connection already in the directory, which is used by the first thread. progress, if
+        given, is called from this thread with the output of getStatus every refreshTime seconds
+        (so it can update graphical widgets). Return the final status.
+        '''
+
+        self._queue = list(filenames)
+        self._queue.reverse()
+        self._filesDone = 0
+        self._filesTotal = len(self._queue)
+        self._bytes = 0
+        self._activeFiles = {}
+        self._errors = []
+        self._start = time.time()
+
+        if (len(self._queue) == 0):
+
+            # Nothing to download (for example, all files were in the data cache)
+            if (connection is not None):
+                try:
+                    connection.quit()
+                except:
+                    self._close(connection)
+                pass
+            pass
+
+            return self.getStatus()
+
+        pass
+
+        nThreads = min(self.nConnections, len(self._queue))
+
+        threads = []
+
+        for i in range(nThreads):
+            thread = threading.Thread(target=self._worker, args=(destination, connection if i == 0 else None))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        pass
+
+        alive = threads
+
+        while (len(alive) > 0):
+
+            alive[0].join(refreshTime)
+
+            if (progress is not None):
+                progress(self.getStatus())
+            pass
+
+            alive = [t for t in threads if t.is_alive()]
+
+        pass
+
+        status = self.getStatus()
+
+        if (progress is not None):
+            progress(status)
+        pass
+
+        if (len(self._errors) > 0):
+            raise self._errors[0]
+        pass
+
+        megabytes = status['bytes'] / 1024.0 / 1024.0
+
+        print(("Downloaded %s files (%.1f MB) in %.1f s with %s connections (%.2f MB/s)"
+               % (status['filesDone'], megabytes, status['elapsed'], nThreads,
+                  megabytes / max(status['elapsed'], 1e-3))))
+
+        return status
+
+    pass
+
+    def _nextFile(self):
+
+        with self._lock:
+
+            if (len(self._queue) == 0 or len(self._errors) > 0):
+                # Nothing left to do, or another thread failed: stop
+                return None
+
+            return self._queue.pop()
+
+    pass
+
+    def _worker(self, destination, ftp):
+
+        try:
+
+            while True:
+
+                filename = self._nextFile()
+
+                if (filename is None):
+                    break
+
+                ftp = self._downloadFile(ftp, filename, destination)
+
+                with self._lock:
+                    self._filesDone += 1
+                pass
+
+            pass
+
+        except Exception as e:
+
+            with self._lock:
+                self._errors.append(e)
+            pass
+
+        finally:
+
+            if (ftp is not None):
+                try:
+                    ftp.quit()
+                except:
+                    self._close(ftp)
+                pass
+            pass
+
+        pass
+
+    pass
+
+    def _downloadFile(self, ftp, filename, destination):
+        # Download one file, re-opening the connection when needed. Return the connection
+        # (possibly a new one) so that the next file can use it
+
+        localFile = os.path.join(destination, filename)
+        partFile = "%s.part" % (localFile)
+
+        print(("Retrieving %s ..." % (filename)))
+
+        lastError = None
+
+        for trial in range(self.maxTrials):
+
+            try:
+
+                if (ftp is None):
+                    ftp = self._openDirectory()
+                pass
+
+                remoteSize = self.getRemoteSize(ftp, filename)
+
+                if (os.path.exists(partFile) and os.path.getsize(partFile) <= remoteSize):
+                    offset = os.path.getsize(partFile)
+                else:
+                    offset = 0
+                pass
+
+                try:
+                    f = open(partFile, 'ab' if offset > 0 else 'wb')
+                except IOError:
+                    raise GtBurstException(3, "Could not open file %s for writing. Do you have write permission on %s?"
+                                           % (partFile, destination))
+                pass
+
+                with self._lock:
+                    self._activeFiles[filename] = [offset, remoteSize]
+                pass
+
+                def callback(data):
+                    f.write(data)
+                    with self._lock:
+                        self._bytes += len(data)
+                        self._activeFiles[filename][0] += len(data)
+                    pass
+
+                pass
+
+                try:
+                    if (offset < remoteSize):
+                        ftp.retrbinary('RETR %s' % (filename), callback, rest=offset if offset > 0 else None)
+                    pass
+                    localSize = f.tell()
+                finally:
+                    f.close()
+                pass
+
+                if (localSize != remoteSize):
+                    raise IOError("got %s bytes instead of %s" % (localSize, remoteSize))
+                pass
+
+                os.replace(partFile, localFile)
+
+                with self._lock:
+                    self._activeFiles.pop(filename, None)
+                pass
+
+                print(("%s done" % (filename)))
+
+                return ftp
+
+            except ftplib.all_errors as e:
+
+                lastError = e
+
+                print(("\nConnection lost while downloading %s (%s). Trying to reconnect..." % (filename, e)))
+
+                if (ftp is not None):
+                    self._close(ftp)
+                pass
+
+                ftp = None
+
+            pass
+
+        pass
+
+        with self._lock:
+            self._activeFiles.pop(filename, None)
+        pass
+
+        raise GtBurstException(1, "Could not download %s after %s attempts: %s" % (filename, self.maxTrials, lastError))
+
+    pass
+
+
+pass
@@ -811,9 +811,22 @@ class LikelihoodResultsPrinter(object):
 pass
 
 
-def optimizeBins(like, energies, sourceName, minTs=20, minEvt=3):
+def optimizeBins(like, energies, sourceName, minTs=20, minEvt=3, method='stepwise'):
+    '''
+    Divide the energy range in bins so that the source has at least minTs in each of them, starting from the highest
+    energy. With method='stepwise' the bins are enlarged one photon at a time, computing the TS at each step. With
+    method='fast' the expected background counts are used to jump close to the boundary where the TS reaches minTs,
+    then the boundary is found by bisection (assuming that the TS grows with the number of photons in the bin).
+    '''
     if (len(energies) <= minEvt * 2):
         raise RuntimeError("Not enough events to build a SED!")
+
+    if (method == 'fast'):
+        return _optimizeBinsFast(like, energies, sourceName, minTs, minEvt)
+    elif (method != 'stepwise'):
+        raise ValueError("Unknown method %s for optimizeBins. Possible values are: fast, stepwise" % (method))
+    pass
+
     # Reversed array of energies (so we start binning from the top!)
     energies = numpy.array(sorted(energies)[::-1])
     # Get the first minEvt photons
@@ -863,6 +876,166 @@ def optimizeBins(like, energies, sourceName, minTs=20, minEvt=3):
 pass
 
 
+class BinTsCalculator(object):
+    '''
+    Compute the TS of the source in a given energy range, caching the result for each range
+    (so that the same range is never fit twice) and counting the number of fits.
+    '''
+
+    def __init__(self, like, sourceName):
+        self.like = like
+        self.sourceName = sourceName
+        self.cache = {}
+        self.nFits = 0
+
+    pass
+
+    def __call__(self, e1, e2):
+        key = (float(e1), float(e2))
+
+        if (key not in self.cache):
+            print(("Trying bin %s-%s" % (key[0], key[1])))
+            self.like.setEnergyRange(key[0], key[1])
+            self.cache[key] = self.like.Ts(self.sourceName, reoptimize=True)
+            self.nFits += 1
+            print(("TS = %s" % (self.cache[key])))
+        pass
+
+        return self.cache[key]
+
+    pass
+
+
+pass
+
+
+def _getCumulativeBackgroundCounts(like, energies, sourceName, nPoints=100):
+    # Return a function giving the expected background counts between any energy and the
+    # maximum energy, interpolating on a grid (so that Npred is called only a few times)
+    emax = float(energies.max()) + 1
+    emin = max(float(energies.min()) - 1, 1e-3)
+    grid = numpy.logspace(numpy.log10(emin), numpy.log10(emax), nPoints)
+    counts = numpy.array([getExpectedBackgroundCounts(like, float(e), emax, sourceName) for e in grid])
+
+    # counts decreases with energy, numpy.interp needs increasing x
+    return lambda e: numpy.interp(numpy.log10(e), numpy.log10(grid), counts)
+
+
+pass
+
+
+def _optimizeBinsFast(like, energies, sourceName, minTs, minEvt):
+    # Reversed array of energies (so we start binning from the top!)
+    energies = numpy.array(sorted(energies)[::-1], dtype=float)
+    nEnergies = len(energies)
+
+    # Candidate boundaries: half way between consecutive photons. The boundary below the
+    # n-th photon (counting from 1) is candidates[n-1]
+    candidates = numpy.append((energies[:-1] + energies[1:]) / 2.0, energies[-1] - 0.5)
+
+    backgroundCounts = _getCumulativeBackgroundCounts(like, energies, sourceName)
+    candidatesBackground = backgroundCounts(candidates)
+
+    getTs = BinTsCalculator(like, sourceName)
+
+    boundaries = [float(energies[0]) + 1]
+    start = 0
+
+    # True if the last photons do not reach minTs (see below)
+    lastBinFailed = False
+
+    while (nEnergies - start >= minEvt):
+        # Possible number of photons in this bin
+        n = numpy.arange(minEvt, nEnergies - start + 1)
+
+        # Predicted TS from the observed counts and the expected background
+        expectedBackground = numpy.maximum(candidatesBackground[start + n - 1] - backgroundCounts(boundaries[-1]), 1e-10)
+        predictedTs = numpy.where(n > expectedBackground,
+                                  2 * (n * numpy.log(n / expectedBackground) - (n - expectedBackground)), 0.0)
+
+        def passes(nPhotons):
+            return getTs(candidates[start + nPhotons - 1], boundaries[-1]) >= minTs
+
+        # Number of photons where the TS should reach minTs
+        idx = numpy.argmax(predictedTs >= minTs) if numpy.any(predictedTs >= minTs) else len(n) - 1
+        guess = int(n[idx])
+
+        # Bracket the boundary starting from the guess, with steps of increasing size:
+        # bad is the largest number of photons known to fail, good the smallest known to pass
+        if (passes(guess)):
+            good = guess
+            bad = minEvt - 1
+            step = 1
+            while (good - step > bad):
+                if (passes(good - step)):
+                    good = good - step
+                    step *= 2
+                else:
+                    bad = good - step
+                    break
+                pass
+            pass
+        else:
+            bad = guess
+            good = None
+            step = 1
+            while (bad < n[-1]):
+                thisN = min(bad + step, int(n[-1]))
+                if (passes(thisN)):
+                    good = thisN
+                    break
+                else:
+                    bad = thisN
+                    step *= 2
+                pass
+            pass
+
+            if (good is None):
+                # Not enough signal in the remaining photons
+                lastBinFailed = True
+                break
+            pass
+        pass
+
+        # Bisection
+        while (good - bad > 1):
+            mid = (good + bad) // 2
+            if (passes(mid)):
+                good = mid
+            else:
+                bad = mid
+            pass
+        pass
+
+        boundaries.append(float(candidates[start + good - 1]))
+        print(("\n==> Accepted bin %s-%s with TS = %5.2f and %s events\n" % (
+            boundaries[-1], boundaries[-2], getTs(boundaries[-1], boundaries[-2]), good)))
+
+        start += good
+    pass
+
+    # Make sure the last boundary corresponds to the last photons (the remaining ones,
+    # if any, are merged with the last bin)
+    if (len(boundaries) == 1):
+        boundaries.append(float(energies[-1] - 1))
+    else:
+        boundaries[-1] = float(energies[-1] - 1)
+
+        if (lastBinFailed and len(boundaries) > 2):
+            # Same as the stepwise method: when the last photons do not reach minTs,
+            # the first two bins are merged
+            del boundaries[1]
+        pass
+    pass
+
+    print(("\nBins optimized with %s fits" % (getTs.nFits)))
+
+    return boundaries[::-1]
+
+
+pass
+
+
 def getSignalToNoise(like, e1, e2, sourceName):
     Nback = getExpectedBackgroundCounts(like, e1, e2, sourceName)
     Nsrc = like[sourceName].src.Npred(e1, e2)
@@ -0,0 +1,295 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy
+
+from GtBurst.Configuration import Configuration
+
+
+class ProductCache(object):
+    '''
+    A cache of data products (livetime cubes, exposure maps...) on disk, under the data repository.
+
+    Each product is identified by a key, which is a hash of all the inputs used to produce it
+    (see getKey). Products are evicted starting from the least recently used one when the total
+    size exceeds the maximum size in the configuration. The index of the cache, with the
+    hit/miss statistics, is kept in a JSON file in the cache directory, protected by a lock
+    so that the cache can be used by several processes at the same time.
+    '''
+
+    # Permissions given to the files and directories created by the cache (None: use the umask)
+    fileMode = None
+    directoryMode = None
+
+    def __init__(self, directory=None, maxSize=None):
+
+        configuration = Configuration()
+
+        if (directory is None):
+            directory = os.path.join(configuration.get('dataRepository'), 'productCache')
+        pass
+
+        if (maxSize is None):
+            # Configuration is in MB
+            maxSize = float(configuration.get('productCacheSize')) * 1024 * 1024
+        pass
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.maxSize = float(maxSize)
+        self.indexFile = os.path.join(self.directory, 'index.json')
+        self.lockFile = os.path.join(self.directory, 'index.lock')
+
+        if (self.isEnabled() and not os.path.exists(self.directory)):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process might have created it in the meantime
+                if (not os.path.isdir(self.directory)):
+                    raise
+            pass
+            self._setMode(self.directory, self.directoryMode)
+        pass
+
+    pass
+
+    @staticmethod
+    def _setMode(path, mode):
+
+        if (mode is None):
+            return
+
+        try:
+            os.chmod(path, mode)
+        except OSError:
+            # Not the owner: it has been created (with the right mode) by another user
+            pass
+        pass
+
+    pass
+
+    def isEnabled(self):
+
+        return self.maxSize > 0
+
+    @staticmethod
+    def getKey(productType, **inputs):
+        '''
+        Return the key for a product of type productType produced from the given inputs.
+        Inputs can be numbers, strings or numpy arrays.
+        '''
+
+        digest = hashlib.sha1(productType.encode())
+
+        for name in sorted(inputs.keys()):
+
+            value = inputs[name]
+            digest.update(name.encode())
+
+            if (isinstance(value, numpy.ndarray)):
+                digest.update(str(value.dtype).encode())
+                digest.update(numpy.ascontiguousarray(value).tobytes())
+            else:
+                digest.update(repr(value).encode())
+            pass
+        pass
+
+        return "%s_%s" % (productType, digest.hexdigest())
+
+    pass
+
+    @staticmethod
+    def getFileDigest(filename):
+        '''
+        Return a hash of the content of a file, to be used as input for getKey
+        '''
+
+        digest = hashlib.sha1()
+
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+            pass
+        pass
+
+        return digest.hexdigest()
+
+    pass
+
+    @contextmanager
+    def _lockedIndex(self):
+        '''
+        Give exclusive access to the index, and save it back when done
+        '''
+
+        with open(self.lockFile, 'a') as lock:
+
+            self._setMode(self.lockFile, self.fileMode)
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+
+                index = self._readIndex()
+
+                yield index
+
+                tempFile = "%s.%s" % (self.indexFile, os.getpid())
+
+                with open(tempFile, 'w') as f:
+                    json.dump(index, f, indent=1)
+
+                self._setMode(tempFile, self.fileMode)
+                os.rename(tempFile, self.indexFile)
+
+            finally:
+
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            pass
+        pass
+
+    pass
+
+    def _readIndex(self):
+
+        index = {'products': {}, 'hits': 0, 'misses': 0}
+
+        if (os.path.exists(self.indexFile)):
+
+            try:
+
+                with open(self.indexFile) as f:
+                    index.update(json.load(f))
+
+            except ValueError:
+
+                # Corrupted index: start from scratch (the products will be overwritten)
+                pass
+            pass
+        pass
+
+        return index
+
+    pass
+
+    def get(self, key, outfile):
+        '''
+        If the product is in the cache, copy it to outfile and return True, otherwise return False
+        '''
+
+        if (not self.isEnabled()):
+            return False
+
+        with self._lockedIndex() as index:
+
+            product = index['products'].get(key)
+
+            if (product is not None and os.path.exists(os.path.join(self.directory, product['file']))):
+
+                shutil.copyfile(os.path.join(self.directory, product['file']), outfile)
+
+                product['lastAccess'] = time.time()
+                product['hits'] += 1
+                index['hits'] += 1
+
+                return True
+
+            else:
+
+                index['products'].pop(key, None)
+                index['misses'] += 1
+
+                return False
+            pass
+        pass
+
+    pass
+
+    def put(self, key, filename):
+        '''
+        Store a copy of filename in the cache under the given key, then evict the least recently
+        used products until the cache fits in the maximum size
+        '''
+
+        if (not self.isEnabled()):
+            return
+
+        size = os.path.getsize(filename)
+
+        if (size > self.maxSize):
+            # It would evict everything else and then itself
+            return
+
+        cachedName = "%s%s" % (key, os.path.splitext(filename)[-1])
+
+        # Copy outside of the lock, then move in place (which is atomic)
+        tempFile = os.path.join(self.directory, "%s.%s.tmp" % (cachedName, os.getpid()))
+        shutil.copyfile(filename, tempFile)
+        os.rename(tempFile, os.path.join(self.directory, cachedName))
+
+        with self._lockedIndex() as index:
+
+            now = time.time()
+            index['products'][key] = {'file': cachedName, 'size': size,
+                                      'created': now, 'lastAccess': now, 'hits': 0}
+
+            totalSize = sum([p['size'] for p in list(index['products'].values())])
+
+            for oldKey in sorted(list(index['products'].keys()), key=lambda k: index['products'][k]['lastAccess']):
+
+                if (totalSize <= self.maxSize):
+                    break
+
+                oldProduct = index['products'].pop(oldKey)
+                totalSize -= oldProduct['size']
+
+                try:
+                    os.remove(os.path.join(self.directory, oldProduct['file']))
+                except OSError:
+                    pass
+            pass
+        pass
+
+    pass
+
+    def getStatistics(self):
+        '''
+        Return a dictionary with number of products, total size (bytes), hits and misses
+        '''
+
+        if (not self.isEnabled()):
+            return {'products': 0, 'size': 0, 'hits': 0, 'misses': 0}
+
+        with self._lockedIndex() as index:
+            return {'products': len(index['products']),
+                    'size': sum([p['size'] for p in list(index['products'].values())]),
+                    'hits': index['hits'],
+                    'misses': index['misses']}
+
+    pass
+
+    def clear(self):
+
+        if (not self.isEnabled()):
+            return
+
+        with self._lockedIndex() as index:
+
+            for product in list(index['products'].values()):
+                try:
+                    os.remove(os.path.join(self.directory, product['file']))
+                except OSError:
+                    pass
+            pass
+
+            index['products'] = {}
+        pass
+
+    pass
+
+
+pass
@@ -1,11 +1,12 @@
 from GtBurst.my_fits_io import pyfits
 
 import sys
-import os, glob
-import shlex, subprocess, shutil
+import os
+import tempfile
 import numpy
 
-from GtBurst.dataHandling import create_from_columns
+from GtBurst.ResponseMatrix import ResponseMatrix
+from GtBurst.ProductCache import ProductCache
 
 #The RSP2 matrix for the GBM are computed by interpolating a grid of
 #responses containing Montecarlo-generated rsp for different position of
@@ -14,13 +15,6 @@ from GtBurst.dataHandling import create_from_columns
 #We want to weight every applying matrix for every desired time interval
 #by the number of total counts contained in that interval
 
-def _callSubprocess(cmdline):
-    args                           = shlex.split(cmdline)
-    #p = subprocess.check_call(args,stdout=None,stderr=None)
-    output, error                  = subprocess.Popen(args,stdout = subprocess.PIPE, stderr= subprocess.PIPE).communicate()
-    return output, error
-pass
-
 class EventsCounter(object):
   def __init__(self,**kwargs):
     
@@ -38,7 +32,8 @@ class EventsCounter(object):
     f                         = pyfits.open(tte)
     self.inputFile            = 'TTE'
     self.data                 = f["EVENTS",1].data.copy()
-    self.eventTimes           = numpy.array(list(self.data.field('TIME')))
+    #Sorted, so that the number of events in any interval is found by bisection
+    self.eventTimes           = numpy.sort(numpy.array(self.data.field('TIME'),dtype=float))
     f.close()
   pass
   
@@ -58,49 +53,68 @@ class EventsCounter(object):
     pass  
     self.tstarts              = numpy.array(cspectstarts)
     self.tstops               = numpy.array(cspectstops)
-    self.counts               = numpy.array([numpy.sum(x) for x in cspeccounts])
+    self.counts               = numpy.sum(numpy.array(cspeccounts,dtype=float).reshape(len(self.tstarts),-1),axis=1)
     #Place zeros where QUALITY is > 0 (bad data)
     self.goodDataMask         = (f["SPECTRUM"].data.field('QUALITY')==0)
     self.counts[~self.goodDataMask]  = 0 
+    #Cumulative counts, so that the counts in any range of bins is a difference
+    self.cumulativeCounts     = numpy.append(0,numpy.cumsum(self.counts))
     f.close()
   pass
   
   def getNevents(self,tstart,tstop):
-    #Return the number of events between tstart and tstop
-    #what is the subinterval of the current interval
+    #Return the number of events between tstart and tstop. They can also
+    #be arrays, in which case an array is returned
+    tstart                    = numpy.asarray(tstart,dtype=float)
+    tstop                     = numpy.asarray(tstop,dtype=float)
+    
     if(self.inputFile=="TTE"):
       
-      if((tstart < min(self.eventTimes)) or (tstop > max(self.eventTimes))):
+      if(numpy.any(tstart < self.eventTimes[0]) or numpy.any(tstop > self.eventTimes[-1])):
         raise RuntimeError("Tstart and tstop out of boundaries")
       
-      thisMask                = (self.eventTimes >= tstart) & (self.eventTimes <= tstop)
-      nEvents                 = len(thisMask.nonzero()[0])
+      nEvents                 = (numpy.searchsorted(self.eventTimes,tstop,side='right') -
+                                 numpy.searchsorted(self.eventTimes,tstart,side='left'))
     
     elif(self.inputFile=="cspec"):
       
-      if((tstart < min(self.tstarts)) or (tstop > max(self.tstops))):
+      if(numpy.any(tstart < self.tstarts.min()) or numpy.any(tstop > self.tstops.max())):
         raise RuntimeError("Tstart and tstop out of boundaries")
       
-      #Select all interesting intervals
-      thisMask                = (self.tstops >= tstart) & (self.tstarts <= tstop) & self.goodDataMask
+      #Range of bins overlapping with the interval: first is the first one
+      #ending after tstart, last is the last one starting before tstop
+      first                   = numpy.searchsorted(self.tstops,tstart,side='left')
+      last                    = numpy.searchsorted(self.tstarts,tstop,side='right')-1
       
-      #Compute the weight for each interval: the weight will be 1 for intervals
-      #completely contained between tstart and tstop, and < 1 for the first and
-      #last interval. The weighted sum of the counts give the total counts between
-      #tstart and tstop, assuming that they are distributed uniformly within the
-      #first and last bin
-      weight                  = []
-      for i in thisMask.nonzero()[0]:
-        weight.append((min(tstop,self.tstops[i])-max(tstart,self.tstarts[i]))/(self.tstops[i]-self.tstarts[i]))
+      #The weight of each bin will be 1 for bins completely contained between tstart
+      #and tstop, and < 1 for the first and last bin. The weighted sum of the counts give
+      #the total counts between tstart and tstop, assuming that they are distributed
+      #uniformly within the first and last bin
+      def overlap(i):
+        i                     = numpy.clip(i,0,len(self.tstarts)-1)
+        weight                = ((numpy.minimum(tstop,self.tstops[i])-numpy.maximum(tstart,self.tstarts[i]))/
+                                 (self.tstops[i]-self.tstarts[i]))
+        return weight,self.counts[i]
       
-      if(len(weight)==0):
-        nEvents               = 0
-      else:  
-        weight                  = numpy.array(weight)
-        nEvents                 = numpy.sum(weight*self.counts[thisMask])
-      pass
+      firstWeight,firstCounts = overlap(first)
+      lastWeight,lastCounts   = overlap(last)
+      
+      #Counts in all the bins, minus the part of the first and last bin outside of the interval
+      nEvents                 = (self.cumulativeCounts[numpy.clip(last+1,0,len(self.tstarts))] -
+                                 self.cumulativeCounts[numpy.clip(first,0,len(self.tstarts))] -
+                                 (1-firstWeight)*firstCounts - (1-lastWeight)*lastCounts)
+      
+      #When the interval is within one bin
+      nEvents                 = numpy.where(first==last,firstWeight*firstCounts,nEvents)
+      
+      #No bins at all
+      nEvents                 = numpy.where(last < first,0,nEvents)
     else:
       raise RuntimeError("Should not get here! this is a bug.")
+    
+    if(nEvents.ndim==0):
+      return nEvents.item()
+    
     return nEvents
   pass
   
@@ -112,23 +126,57 @@ def _fixPath(filename):
 class TimeIntervals(object):
   def __init__(self,**kwargs):
     
-    self.tstarts              = []
-    self.tstops               = []
-    self.counts               = []
-    
-    eventsCounter                     = EventsCounter(eventfile=_fixPath(kwargs['eventfile']))
+    self.eventsCounter                = EventsCounter(eventfile=_fixPath(kwargs['eventfile']))
     
     timeBinsFile                      = pyfits.open(_fixPath(kwargs['timeBinsFile']))
-    for rowID in range(timeBinsFile["TIMEBINS"].data.shape[0]):
-      curTstart                       = timeBinsFile["TIMEBINS"].data[rowID][0]
-      curTstop                        = timeBinsFile["TIMEBINS"].data[rowID][1]
-      self.tstarts.append(curTstart)
-      self.tstops.append(curTstop)
-      #Count how many events are contained in the TTE file between tstart and tstop
-      self.counts.append(eventsCounter.getNevents(curTstart,curTstop))
-    pass
+    self.tstarts                      = numpy.array(timeBinsFile["TIMEBINS"].data.field(0),dtype=float)
+    self.tstops                       = numpy.array(timeBinsFile["TIMEBINS"].data.field(1),dtype=float)
     timeBinsFile.close()
+    
+    #Count how many events are contained in the TTE file between tstart and tstop
+    self.counts                       = self.eventsCounter.getNevents(self.tstarts,self.tstops)
+  pass
+pass
+
+def getMatricesCoverage(rsp2File,instrument):
+  '''
+  Return the extension numbers of the matrices in the RSP2 file, and the start and stop
+  of the time covered by each one of them
+  '''
+  extNumbers                          = [i for i,hdu in enumerate(rsp2File) if hdu.name in ["SPECRESP MATRIX","MATRIX"]]
+  
+  for extNumber in extNumbers:
+    #Check that the instrument is the same of the TTE file
+    instrument2                       = rsp2File[extNumber].header["INSTRUME"]
+    if(instrument2!=instrument):
+      print(("WARNING: the Events file %s and the response matrix file %s refers to different instruments" % (instrument,instrument2)))
+    pass
   pass
+  
+  #Find the start and stop time of the interval covered 
+  #by each response matrix
+  headerStarts                        = numpy.array([rsp2File[i].header["TSTART"] for i in extNumbers],dtype=float)
+  headerStops                         = numpy.array([rsp2File[i].header["TSTOP"] for i in extNumbers],dtype=float)
+  
+  #The matrix cover the period going from the middle point between its start
+  #time and the start time of the previous matrix (or its start time if it is the
+  #first matrix of the file), and the middle point between its start time and its
+  #stop time (that is equal to the start time of the next one):
+  #
+  #           tstart                             tstop
+  #             |==================================|
+  # |--------------x---------------|-----------x-----------|----------x--..
+  #rspStart1    rspStop1=    headerStart2  rspStop2= headerStart3  rspStop3
+  #             rspStart2                  rspStart3
+  #           
+  #covered by: |m1 |           m2             | m3|
+  #
+  #The matrix in the last extension of the file covers until its stop time
+  isLast                              = (numpy.array(extNumbers)==len(rsp2File)-1)
+  rspStops                            = numpy.where(isLast,headerStops,(headerStarts+headerStops)/2.0)
+  rspStarts                           = numpy.append(headerStarts[:1],rspStops[:-1])
+  
+  return numpy.array(extNumbers),rspStarts,rspStops,isLast
 pass
 
 def RSPweight(**kwargs):    
@@ -169,114 +217,41 @@ def RSPweight(**kwargs):
     #For every interval contained in the time bins file
     #find the applying matrices and compute the weight (if necessary)
     nIntervals                        = len(timeIntervals.tstarts)
-    nMatrix                           = len(rsp2File)
-    createdRspNames                   = []
-    eventsCounter                     = EventsCounter(**kwargs)
+    intervalMatrices                  = []
+    eventsCounter                     = timeIntervals.eventsCounter
+    
+    extNumbers,coverageStarts,coverageStops,isLast = getMatricesCoverage(rsp2File,instrument)
+    
+    #For each interval, the first matrix ending after its start and
+    #the first one ending after its stop (the last one to consider)
+    firstMatrix                       = numpy.searchsorted(coverageStops,timeIntervals.tstarts,side='left')
+    lastMatrix                        = numpy.minimum(numpy.searchsorted(coverageStops,timeIntervals.tstops,side='left'),
+                                                      len(extNumbers)-1)
+    
     for tstart,tstop,nEvents,intervalNumber in zip(timeIntervals.tstarts,
                                                    timeIntervals.tstops,
                                                    timeIntervals.counts,
                                                    list(range(nIntervals))):
       print(("\nInterval: %s - %s" % (tstart-trigger,tstop-trigger)))
       
-      #find the RSP matrices falling in the current tstart-tstop interval
-      rspList                         = []
-      rspStarts                       = []
-      rspStops                        = []
-      firstResponse                   = True
-      for extNumber in range(nMatrix):
+      #The RSP matrices falling in the current tstart-tstop interval
+      idx                             = numpy.arange(firstMatrix[intervalNumber],lastMatrix[intervalNumber]+1)
+      idx                             = idx[coverageStarts[idx] <= tstop]
       
-        if(rsp2File[extNumber].name=="SPECRESP MATRIX" or 
-           rsp2File[extNumber].name=="MATRIX"):                    
-                     
-          curHeader                           = rsp2File[extNumber].header
-          
-          #Check that the instrument is the same of the TTE file
-          instrument2                         = curHeader["INSTRUME"]
-          if(instrument2!=instrument):
-            print(("WARNING: the Events file %s and the response matrix file %s refers to different instruments" % (instrument,instrument2)))
-          pass
-          
-          #Find the start and stop time of the interval covered 
-          #by this response matrix
-          headerStart                         = curHeader["TSTART"]
-          headerStop                          = curHeader["TSTOP"]
-
-          #The matrix cover the period going from the middle point between its start
-          #time and the start time of the previous matrix (or its start time if it is the
-          #first matrix of the file), and the middle point between its start time and its
-          #stop time (that is equal to the start time of the next one):
-          #
-          #           tstart                             tstop
-          #             |==================================|
-          # |--------------x---------------|-----------x-----------|----------x--..
-          #rspStart1    rspStop1=    headerStart2  rspStop2= headerStart3  rspStop3
-          #             rspStart2                  rspStart3
-          #           
-          #covered by: |m1 |           m2             | m3|
-          #
-          
-          if(firstResponse):
-            #This is the first matrix
-            if(extNumber==len(rsp2File)-1):
-              #This is both the first both the last matrix
-              rspStart                          = headerStart
-              rspStop                           = headerStop 
-            else:
-              rspStart                          = headerStart
-              rspStop                           = (headerStart+headerStop)/2.0
-              firstResponse                     = False
-            pass
-          elif(extNumber==len(rsp2File)-1):
-            #This is the last matrix
-            rspStart                          = prevRspStop
-            rspStop                           = headerStop            
-          else:
-            rspStart                          = prevRspStop
-            rspStop                           = (headerStart+headerStop)/2.0    
-          pass
-          
-          #Save the stop time for the next iteration of the loop
-          prevRspStop                         = rspStop
-                
-          #Check if the current matrix covers at least a portion of the 
-          #start-stop time interval
-          if( rspStop >= tstart and rspStart <= tstop):
-            #Found a matrix covering a part of the interval:
-            #adding it to the list:
-            rspList.append(fixMatrixHDU(rsp2File[extNumber]))
-            
-            #Get the "true" start time of the time sub-interval covered by this matrix
-            trueRspStart                       = max(rspStart,tstart)
-            
-            #Get the "true" stop time of the time sub-interval covered by this matrix
-            if(extNumber==len(rsp2File)-1):
-              #Since there are no matrices after this one, this has to cover until the end of the interval
-              if(tstop > rspStop):
-                print("\nWARNING: RSPweight: The RSP file does not cover the required time interval.")
-                print(("    The last response should cover from %s to %s, but we'll use it" % (trueRspStart, rspStop)))
-                print(("    to cover until the end of the time interval (%s)." % (tstop)))
-                trueRspStop                      = tstop
-              else:
-                trueRspStop                      = tstop 
-            else:
-              trueRspStop                      = min(rspStop,tstop)
-            pass
-            
-            #Save the true start and stop
-            rspStarts.append(trueRspStart)
-            rspStops.append(trueRspStop)
-            
-            print(("  Matr. in ext #%s covers %s - %s" % (extNumber,trueRspStart-trigger,trueRspStop-trigger)))
-            if(rspStop >= tstop):
-              #This matrix cover after the tstop,
-              #no reason to analize the other matrices
-              #pass
-              break
-            pass
-          pass
-        
-        pass
+      rspList                         = list(extNumbers[idx])
+      
+      #The "true" start and stop time of the time sub-interval covered by each matrix
+      rspStarts                       = numpy.maximum(coverageStarts[idx],tstart)
+      #Since there are no matrices after the last one, it has to cover until the end of the interval
+      rspStops                        = numpy.where(isLast[idx],tstop,numpy.minimum(coverageStops[idx],tstop))
       
+      for extNumber,trueRspStart,trueRspStop,rspStop,last in zip(rspList,rspStarts,rspStops,coverageStops[idx],isLast[idx]):
+        if(last and tstop > rspStop):
+          print("\nWARNING: RSPweight: The RSP file does not cover the required time interval.")
+          print(("    The last response should cover from %s to %s, but we'll use it" % (trueRspStart, rspStop)))
+          print(("    to cover until the end of the time interval (%s)." % (tstop)))
+        pass
+        print(("  Matr. in ext #%s covers %s - %s" % (extNumber,trueRspStart-trigger,trueRspStop-trigger)))
       pass
       
       weight                            = []
@@ -306,12 +281,13 @@ def RSPweight(**kwargs):
           #now look upon the selected events, searching for events
           #falling in the interval covered by each
           #response matrix
+          nRspEvts                            = eventsCounter.getNevents(rspStarts,rspStops)
           for index,rsp in enumerate(rspList):
             rspStart                          = rspStarts[index]
             rspStop                           = rspStops[index]
             
             #how many events of the time interval contained here?
-            nThisRspEvt                       = eventsCounter.getNevents(rspStart,rspStop)
+            nThisRspEvt                       = nRspEvts[index]
 
             #Compute the weight
             if(nThisRspEvt > 0):
@@ -348,138 +324,39 @@ def RSPweight(**kwargs):
       
       print("\n")
       
-      #Use addrmf to add and weight the response matrix
-      #We don't use directly pyFits because dealing with response matrices
-      #can be dangerous due to the variable lenght column,
-      #and other features, so we leave the work to a specialized tool
-      
-      #we need to create a file for every matrix, and an ascii file
-      #containing the list of those files and the weights to be applied
-      asciiFilename                           = "__rspweight_rspList.ascii"
-      asciiFile                               = open(asciiFilename,'w')
-      asciiFile.write('')
-      
-      #Loop on the matrices and sum them
-      names                                   = []
-      for rsp_i in range(len(rspList)):
-        #Decide a temporary filename
-        name                                  = "__rspweight_matrix"+str(rsp_i)+".rsp"
-        names.append(name)
-        
-        primaryHDU                            = rsp2File[0].copy()
-        eboundsHDU                            = rsp2File['EBOUNDS'].copy()
-        responseHDU                           = rspList[rsp_i].copy()
-        HDUlist                               = pyfits.HDUList([primaryHDU,eboundsHDU,responseHDU])
-        HDUlist.writeto(name,output_verify='fix',overwrite=True)
-                        
-        if(instrument.find("GBM")>=0):
-          # FIX the wrong GBM matrices
-          data                                  = pyfits.open(name,'update')
-          #EBOUNDS:
-          #Find what is the tlminColumn column                  
-          columns                               = data['EBOUNDS'].data.names          
-          tlminID                               = columns.index('CHANNEL')+1           
-        
-          #Find the number of channels (usually 128)
-          nChannels                             = data['EBOUNDS'].data.size
-        
-          #Fix the CHANNEL column, and TLMIN/TLMAX keywords
-          data['EBOUNDS'].data.field('CHANNEL')[:]=numpy.array(list(range(1,nChannels+1)))
-          data['EBOUNDS'].header.set("TLMIN%s" %(tlminID),1)
-          data['EBOUNDS'].header.set("TLMAX%s" %(tlminID),nChannels)
-          #SPECRESP MATRIX
-          #Now we have to correct the rows whith wrong F_CHAN and N_CHAN values:
-          #There are rows where F_CHAN = 128, and N_CHAN = 1, but the only element not null
-          #in the row is the first, thus it should be: F_CHAN = 1, N_CHAN = 1
-        
-          for row in range(nChannels):
-            if(data['SPECRESP MATRIX'].data.field('F_CHAN')[row]==128 and
-               data['SPECRESP MATRIX'].data.field('N_CHAN')[row]==1):
-            
-              #We have a possibly wrong row
-              #Try to access the channel 128 of the matrix
-              try:
-                data['SPECRESP MATRIX'].data.field('MATRIX')[row][127]
-              except:
-                #Impossible to access it, thus the values are wrong. Fix them
-                data['SPECRESP MATRIX'].data.field('F_CHAN')[row] = numpy.array([1])
-                data['SPECRESP MATRIX'].data.field('N_CHAN')[row] = numpy.array([1]) 
-              pass
-            pass   
-          pass
-          #Find what is the tlminColumn column                  
-          columns                                            = data['SPECRESP MATRIX'].data.names          
-          tlminID                                            = columns.index('F_CHAN')+1 
-          data['SPECRESP MATRIX'].header.set("TLMIN%s" %(tlminID),1)
-          data['SPECRESP MATRIX'].header.set("TLMAX%s" %(tlminID),nChannels)
-          data.close()
-        pass        
-        
-        asciiFile.write(name+" "+str(weight[rsp_i])+"\n")
-      pass
-      asciiFile.close()
-      
-      #Decide a name for the output matrix for this interval
-      thisRspName                          = "__rspweight_interval"+str(intervalNumber)+".rsp"
-      createdRspNames.append(thisRspName)
-      
-      if(len(names)==1):
-        #Only one matrix. No need to weight
-        shutil.copy(names[0],thisRspName)
-      else:
-        #Run addrmf and weight the relevant matrices
-        cmdline                              = "addrmf @%s rmffile=%s clobber=yes" % (asciiFilename,thisRspName)
-        print(("\n %s \n" %(cmdline)))
-        
-        out, err                             = _callSubprocess(cmdline)
-        
-        print (out)
-        print (err)
-      pass
-      #clean up
-      os.remove(asciiFilename)
+      intervalMatrices.append((rspList,weight))
     pass
     
-    #now append all the produced matrix in one RSP2 file
+    #Decode every applying matrix only once, then form the matrix of each interval
+    #as the weighted sum of its applying matrices, and write the RSP2 file in one go
+    isGBM                            = (instrument.find("GBM")>=0)
+    
+    ebounds                          = fixEboundsHDU(rsp2File['EBOUNDS'],isGBM)
+    nChannels                        = ebounds.data.shape[0]
+    
     #Take the PRIMARY extension from the input RSP2 file
     primary                          = rsp2File[0].copy()
     primary.header.set("DRM_NUM",nIntervals)
     primary.header.set("TSTART",timeIntervals.tstarts[0])
     primary.header.set("TSTOP",timeIntervals.tstops[-1])
-    primary.writeto(outrsp,overwrite='True')
     
-    #Get the EBOUNDS extension from the first matrix
-    firstRsp                    = pyfits.open(createdRspNames[0])
-    ebounds                     = firstRsp['EBOUNDS'].copy()
-    firstRsp.close()
+    outHDUs                          = [primary,ebounds]
     
-    #Reopen the file just created
-    outRsp2                           = pyfits.open(outrsp,'update')
-    outRsp2.append(ebounds)
+    decodedMatrices                  = getDecodedMatrices(rsp2,rsp2File,extNumbers,nChannels,isGBM)
     
-    #now write an extension for each interval
-    for i in range(nIntervals):
-      thisRsp                   = pyfits.open(createdRspNames[i])
-      
-      try:
-        curM                    = fixMatrixHDU(thisRsp["SPECRESP MATRIX"]).copy()
-        name                    = "SPECRESP MATRIX"
-      except:
-        try:
-          curM                  = fixMatrixHDU(thisRsp["SPECRESP MATRIX"]).copy()
-          name                  = "MATRIX"
-        except:
-          raise RuntimeError("Something gone wrong. Invalid file produced by the weighting algorithm.")
+    for i,(rspList,weight) in enumerate(intervalMatrices):
+      if(len(rspList)==0):
+        raise RuntimeError("No response matrix in %s covers the interval %s - %s" %(rsp2,timeIntervals.tstarts[i],timeIntervals.tstops[i]))
       pass
       
-      thisRsp.close()
+      matrix                         = ResponseMatrix.weightedSum([decodedMatrices[e] for e in rspList],weight)
       
-      curHeader               = curM.header
-      curData                 = curM.data
+      curM                           = matrix.toHDU(rsp2File[rspList[0]],isGBM)
+      curHeader                      = curM.header
       
       #Update TSTART and TSTOP
-      curHeader.set("TSTART",timeIntervals.tstarts[intervalNumber])
-      curHeader.set("TSTOP",timeIntervals.tstops[intervalNumber])
+      curHeader.set("TSTART",timeIntervals.tstarts[i])
+      curHeader.set("TSTOP",timeIntervals.tstops[i])
       
       #Update RSP_NUM keyword
       curHeader.set("RSP_NUM",i+1)
@@ -491,56 +368,63 @@ def RSPweight(**kwargs):
       history="This is a matrix computed by weighting applying matrices contained in "+rsp2
       curHeader.add_history(history)
       print(("Appending matrix number %s..." %(i+1)))
-      #Write this as an extension in the output file      
-      outRsp2.append(curM)
+      outHDUs.append(curM)
     pass
-    #Closing everything
-    outRsp2.close()
-       
+    
+    pyfits.HDUList(outHDUs).writeto(outrsp,output_verify='fix',overwrite=True)
+    
     #Close files
     rsp2File.close()
-    #Cleanup
-    print("Cleaning up...")
-    fileToDelete              = glob.glob("__rspweight*")
-    for f in fileToDelete:
-      os.remove(f)
 pass
 
-def fixMatrixHDU(matrixHDU):
-  #This creates a copy of the input matrix with all variable-length arrays converted to fixed length,
-  #of the smallest possible size.
-  #This is needed because pyfits makes all sort of fuckups with variable-length arrays
-
-  newcols = []
+def getDecodedMatrices(rsp2,rsp2File,extNumbers,nChannels,isGBM):
+  '''
+  Return a dictionary extension number -> ResponseMatrix with all the matrices in the RSP2 file.
+  The decoded matrices are kept in the product cache, so that the next run on the same
+  RSP2 file (for example with different time intervals) reads them memory-mapped
+  '''
+  cache                       = ProductCache()
   
-  for col in matrixHDU.columns:
-    if(col.format.find("P")==0):
-      #Variable-length
-      newMatrix               = variableToMatrix(matrixHDU.data.field(col.name))
-      length                  = len(newMatrix[0])
-      coltype                 = col.format.split("(")[0].replace("P","")
-      newFormat               = '%s%s' %(length,coltype)
-      newcols.append(pyfits.Column(col.name,newFormat,col.unit,col.null,col.bscale,col.bzero,col.disp,
-                                 col.start,col.dim,newMatrix))
+  if(not cache.isEnabled()):
+    return dict([(int(extNumber),ResponseMatrix.fromHDU(rsp2File[int(extNumber)],nChannels,isGBM)) for extNumber in extNumbers])
+  pass
+  
+  key                         = cache.getKey('rspmatrices',rsp2=cache.getFileDigest(rsp2),nChannels=nChannels,isGBM=isGBM)
+  
+  fileDescriptor,cacheFile    = tempfile.mkstemp(suffix='.fits')
+  os.close(fileDescriptor)
+  
+  try:
+    if(cache.get(key,cacheFile)):
+      print("\nUsing the decoded response matrices in the cache (%s)" %(key))
+      decodedMatrices         = ResponseMatrix.load(cacheFile)
     else:
-      newcols.append(pyfits.Column(col.name,col.format,col.unit,col.null,col.bscale,col.bzero,col.disp,
-                                 col.start,col.dim,matrixHDU.data.field(col.name)))
+      decodedMatrices         = dict([(int(extNumber),ResponseMatrix.fromHDU(rsp2File[int(extNumber)],nChannels,isGBM)) for extNumber in extNumbers])
+      ResponseMatrix.save(cacheFile,decodedMatrices)
+      cache.put(key,cacheFile)
+    pass
+  finally:
+    #The memory maps stay valid after removing the file
+    if(os.path.exists(cacheFile)):
+      os.remove(cacheFile)
+    pass
   pass
-
-  newtable                    = create_from_columns(newcols,header=matrixHDU.header)
-  return newtable
+  
+  return decodedMatrices
 pass
 
-def variableToMatrix(variableLengthMatrix):
-  '''This take a variable length array and return it in a properly formed constant length array'''
-  nrows                          = len(variableLengthMatrix)
-  ncolumns                       = max([len(elem) for elem in variableLengthMatrix])
-  matrix                         = numpy.zeros([nrows,ncolumns])
-  for i in range(nrows):
-    for j in range(ncolumns):
-      try:
-        matrix[i,j]                = variableLengthMatrix[i][j]
-      except:
-        pass
-  return matrix
+def fixEboundsHDU(eboundsHDU,isGBM):
+  #Return a copy of the EBOUNDS extension. For GBM, fix the CHANNEL column
+  #and the TLMIN/TLMAX keywords, which are wrong in some files
+  ebounds                     = eboundsHDU.copy()
+  
+  if(isGBM):
+    nChannels                 = ebounds.data.size
+    tlminID                   = ebounds.columns.names.index('CHANNEL')+1
+    ebounds.data.field('CHANNEL')[:] = numpy.arange(1,nChannels+1)
+    ebounds.header.set("TLMIN%s" %(tlminID),1)
+    ebounds.header.set("TLMAX%s" %(tlminID),nChannels)
+  pass
+  
+  return ebounds
 pass
@@ -0,0 +1,315 @@
+import numpy
+import scipy.sparse
+
+from GtBurst.my_fits_io import pyfits
+from GtBurst.dataHandling import create_from_columns
+
+
+def _getColumnLimit(hdu, columnName, keyword, default):
+    # Return the TLMIN/TLMAX value for the given column, or the default if not present
+    columnID = hdu.columns.names.index(columnName) + 1
+    return int(hdu.header.get("%s%s" % (keyword, columnID), default))
+
+
+pass
+
+
+def _getRowLengths(column):
+    # Return the number of elements of each row of a (fixed or variable-length) column
+
+    if (isinstance(column, numpy.ndarray) and column.dtype != object):
+
+        if (column.ndim == 1):
+            return numpy.ones(column.shape[0], dtype=int)
+        else:
+            return numpy.zeros(column.shape[0], dtype=int) + column.shape[1]
+        pass
+
+    else:
+
+        return numpy.array([numpy.atleast_1d(x).shape[0] for x in column], dtype=int)
+
+    pass
+
+
+pass
+
+
+def _flattenRows(column, lengths):
+    # Concatenate the first lengths[i] elements of each row i of a (fixed or variable-length) column
+
+    if (isinstance(column, numpy.ndarray) and column.dtype != object):
+
+        column = column.reshape(column.shape[0], -1)
+        mask = numpy.arange(column.shape[1]) < lengths[:, numpy.newaxis]
+
+        return column[mask]
+
+    else:
+
+        rows = [numpy.atleast_1d(x)[:n] for x, n in zip(column, lengths)]
+
+        if (len(rows) == 0):
+            return numpy.array([])
+
+        return numpy.concatenate(rows)
+
+    pass
+
+
+pass
+
+
+class ResponseMatrix(object):
+    '''
+    A response matrix (energy bins x channels) stored in compressed sparse row form.
+
+    OGIP matrices already store only the non-zero groups of channels of each row (F_CHAN,
+    N_CHAN, MATRIX), so they are decoded directly into a scipy.sparse CSR matrix without going
+    through a dense array, and weighted sums, folding and encoding operate on it as well.
+    Several matrices can be saved in one FITS file (see save), which can be read back
+    memory-mapped (see load).
+    '''
+
+    def __init__(self, matrix, energLo=None, energHi=None):
+
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.energLo = energLo
+        self.energHi = energHi
+
+    pass
+
+    @property
+    def shape(self):
+
+        return self.matrix.shape
+
+    pass
+
+    @classmethod
+    def fromHDU(cls, matrixHDU, nChannels, isGBM=False):
+        '''
+        Decode the F_CHAN, N_CHAN and MATRIX columns of a response matrix extension
+        '''
+
+        data = matrixHDU.data
+        nRows = len(data)
+
+        if (isGBM):
+            # GBM channels start from 1, regardless of what the header says
+            firstChannel = 1
+        else:
+            firstChannel = _getColumnLimit(matrixHDU, 'F_CHAN', 'TLMIN', 1)
+        pass
+
+        fChanColumn = data.field('F_CHAN')
+        nChanColumn = data.field('N_CHAN')
+        valuesColumn = data.field('MATRIX')
+
+        if ('NGRP' in data.names):
+            nGroups = numpy.array(data.field('NGRP'), dtype=int)
+        else:
+            nGroups = _getRowLengths(fChanColumn)
+        pass
+
+        # All the groups of all the rows, one after the other
+        fChan = numpy.array(_flattenRows(fChanColumn, nGroups), dtype=int)
+        nChan = numpy.array(_flattenRows(nChanColumn, nGroups), dtype=int)
+
+        if (isGBM):
+            # There are GBM rows with F_CHAN = 128 and N_CHAN = 1, but where the only element
+            # in the row is the first channel: it should be F_CHAN = 1, N_CHAN = 1
+            firstGroup = (numpy.append(0, numpy.cumsum(nGroups))[:-1])[nGroups > 0]
+            wrong = ((fChan[firstGroup] == 128) & (nChan[firstGroup] == 1) &
+                     (_getRowLengths(valuesColumn)[nGroups > 0] < 128))
+            fChan[firstGroup[wrong]] = 1
+        pass
+
+        # Row and channel of each element of the MATRIX column
+        groupRows = numpy.repeat(numpy.arange(nRows), nGroups)
+        nElements = numpy.bincount(groupRows, weights=nChan, minlength=nRows).astype(int)
+
+        values = numpy.array(_flattenRows(valuesColumn, nElements), dtype=float)
+
+        groupStart = numpy.append(0, numpy.cumsum(nChan))[:-1]
+        channels = (numpy.repeat(fChan - firstChannel - groupStart, nChan) + numpy.arange(values.shape[0]))
+        rows = numpy.repeat(groupRows, nChan)
+
+        # Channels out of the range of the EBOUNDS are ignored
+        valid = (channels >= 0) & (channels < nChannels)
+
+        matrix = scipy.sparse.csr_matrix((values[valid], (rows[valid], channels[valid])), shape=(nRows, nChannels))
+        matrix.eliminate_zeros()
+
+        return cls(matrix, numpy.array(data.field('ENERG_LO')), numpy.array(data.field('ENERG_HI')))
+
+    pass
+
+    def toHDU(self, templateHDU, isGBM=False):
+        '''
+        Create a response matrix extension with one group per row, going from the first to
+        the last non-zero channel. Energy bounds, name and header keywords are taken from
+        templateHDU
+        '''
+
+        matrix = self.matrix.copy()
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+
+        nRows, nChannels = matrix.shape
+
+        if (isGBM):
+            firstChannel = 1
+        else:
+            firstChannel = _getColumnLimit(templateHDU, 'F_CHAN', 'TLMIN', 1)
+        pass
+
+        rowLengths = numpy.diff(matrix.indptr)
+        hasValues = rowLengths > 0
+
+        first = numpy.zeros(nRows, dtype=int)
+        last = numpy.zeros(nRows, dtype=int)
+        first[hasValues] = matrix.indices[matrix.indptr[:-1][hasValues]]
+        last[hasValues] = matrix.indices[matrix.indptr[1:][hasValues] - 1]
+        nChan = last - first + 1
+        width = int(nChan.max()) if nRows > 0 else 1
+
+        # Move each group at the beginning of its row
+        rows = numpy.repeat(numpy.arange(nRows), rowLengths)
+        packed = numpy.zeros((nRows, width))
+        packed[rows, matrix.indices - first[rows]] = matrix.data
+
+        energLo = templateHDU.columns['ENERG_LO']
+        energHi = templateHDU.columns['ENERG_HI']
+
+        newcols = [pyfits.Column('ENERG_LO', energLo.format, energLo.unit, array=templateHDU.data.field('ENERG_LO')),
+                   pyfits.Column('ENERG_HI', energHi.format, energHi.unit, array=templateHDU.data.field('ENERG_HI')),
+                   pyfits.Column('NGRP', 'I', array=numpy.ones(nRows, dtype=numpy.int16)),
+                   pyfits.Column('F_CHAN', '1I', array=(first + firstChannel).astype(numpy.int16)),
+                   pyfits.Column('N_CHAN', '1I', array=nChan.astype(numpy.int16)),
+                   pyfits.Column('MATRIX', '%sE' % (width), array=packed)]
+
+        newtable = create_from_columns(newcols, header=templateHDU.header)
+        newtable.name = templateHDU.name
+
+        tlminID = newtable.columns.names.index('F_CHAN') + 1
+        newtable.header.set("TLMIN%s" % (tlminID), firstChannel)
+        newtable.header.set("TLMAX%s" % (tlminID), firstChannel + nChannels - 1)
+        newtable.header.set("DETCHANS", nChannels)
+
+        return newtable
+
+    pass
+
+    def toDense(self):
+
+        return self.matrix.toarray()
+
+    pass
+
+    def fold(self, spectrum):
+        '''
+        Return the expected counts in each channel for the given photon fluence in each energy bin
+        '''
+
+        return self.matrix.T.dot(numpy.asarray(spectrum, dtype=float))
+
+    pass
+
+    @classmethod
+    def weightedSum(cls, matrices, weights):
+        '''
+        Return the sum of the matrices, weighted by the given weights
+        '''
+
+        matrix = matrices[0].matrix * float(weights[0])
+
+        for thisMatrix, weight in zip(matrices[1:], weights[1:]):
+            matrix = matrix + thisMatrix.matrix * float(weight)
+        pass
+
+        return cls(matrix, matrices[0].energLo, matrices[0].energHi)
+
+    pass
+
+    @staticmethod
+    def save(filename, matrices):
+        '''
+        Save a dictionary of matrices (indexed by an integer, like the extension number) in a FITS
+        file, as a table describing each matrix and images with the concatenated CSR arrays
+        '''
+
+        keys = sorted(matrices.keys())
+        csrs = [matrices[key].matrix for key in keys]
+
+        nRows = numpy.array([m.shape[0] for m in csrs], dtype=numpy.int64)
+        nnz = numpy.array([m.nnz for m in csrs], dtype=numpy.int64)
+
+        table = pyfits.BinTableHDU.from_columns(
+            [pyfits.Column('KEY', 'K', array=numpy.array(keys, dtype=numpy.int64)),
+             pyfits.Column('NROWS', 'K', array=nRows),
+             pyfits.Column('NCHAN', 'K', array=numpy.array([m.shape[1] for m in csrs], dtype=numpy.int64)),
+             pyfits.Column('ROWSTART', 'K', array=numpy.append(0, numpy.cumsum(nRows))[:-1]),
+             pyfits.Column('ELEMSTART', 'K', array=numpy.append(0, numpy.cumsum(nnz))[:-1])])
+        table.name = 'MATRICES'
+
+        def image(arrays, dtype, name):
+            if (len(arrays) > 0):
+                hdu = pyfits.ImageHDU(numpy.concatenate(arrays).astype(dtype))
+            else:
+                hdu = pyfits.ImageHDU(numpy.array([], dtype=dtype))
+            pass
+            hdu.name = name
+            return hdu
+
+        pass
+
+        # The row pointers of each matrix are relative to its first element
+        pyfits.HDUList([pyfits.PrimaryHDU(), table,
+                        image([m.indptr[1:] for m in csrs], numpy.int32, 'INDPTR'),
+                        image([m.indices for m in csrs], numpy.int32, 'INDICES'),
+                        image([m.data for m in csrs], numpy.float64, 'VALUES'),
+                        image([matrices[key].energLo for key in keys], numpy.float64, 'ENERG_LO'),
+                        image([matrices[key].energHi for key in keys], numpy.float64, 'ENERG_HI')]).writeto(filename,
+                                                                                                            overwrite=True)
+
+    pass
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Read the matrices saved with save. The CSR arrays are memory-mapped, not read in memory
+        '''
+
+        with pyfits.open(filename, memmap=True) as f:
+
+            table = f['MATRICES'].data
+            indptr = f['INDPTR'].data
+            indices = f['INDICES'].data
+            values = f['VALUES'].data
+            energLo = f['ENERG_LO'].data
+            energHi = f['ENERG_HI'].data
+
+            matrices = {}
+
+            for key, nRows, nChan, rowStart, elemStart in zip(table.field('KEY'), table.field('NROWS'),
+                                                              table.field('NCHAN'), table.field('ROWSTART'),
+                                                              table.field('ELEMSTART')):
+                thisIndptr = numpy.append(0, indptr[rowStart:rowStart + nRows])
+                nnz = thisIndptr[-1]
+
+                matrix = scipy.sparse.csr_matrix((values[elemStart:elemStart + nnz],
+                                                  indices[elemStart:elemStart + nnz],
+                                                  thisIndptr), shape=(int(nRows), int(nChan)))
+
+                matrices[int(key)] = cls(matrix, energLo[rowStart:rowStart + nRows],
+                                         energHi[rowStart:rowStart + nRows])
+            pass
+        pass
+
+        return matrices
+
+    pass
+
+
+pass
@@ -38,6 +38,7 @@ thisCommand.addParameter("strategy","Strategy for Zenith cut. (possible values:
 thisCommand.addParameter("allowEmpty","Allow empty output (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,'no',partype=commandDefiner.HIDDEN)
 thisCommand.addParameter("verbose","Verbose output (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 thisCommand.addParameter("figure","Matplotlib figure for the interactive mode",commandDefiner.OPTIONAL,None,partype=commandDefiner.PYTHONONLY)
+thisCommand.addParameter("preselection","Events pre-selected with looser cuts (dataHandling.LATEventStore), used instead of the event file when possible",commandDefiner.OPTIONAL,None,partype=commandDefiner.PYTHONONLY)
 
 GUIdescription                = "Here you apply cuts on the data."
 GUIdescription               += "TIP For intervals shorter than 100 s it is usually best to use TRANSIENT class, while for longer"
@@ -107,6 +108,7 @@ def run(**kwargs):
     clobber                     = _yesOrNoToBool(thisCommand.getParValue('clobber'))
     verbose                     = _yesOrNoToBool(thisCommand.getParValue('verbose'))
     figure                      = thisCommand.getParValue('figure')
+    preselection                = thisCommand.getParValue('preselection')
 
   except KeyError as err:
     print(("\n\nERROR: Parameter %s not found or incorrect! \n\n" %(err.args[0])))
@@ -123,10 +125,10 @@ def run(**kwargs):
   
   if(strategy.lower()=="time"):
     #gtmktime cut
-    filteredFile,nEvents      = LATdata.performStandardCut(ra,dec,rad,irf,tstart,tstop,emin,emax,zmax,thetamax,True,strategy='time')
+    filteredFile,nEvents      = LATdata.performStandardCut(ra,dec,rad,irf,tstart,tstop,emin,emax,zmax,thetamax,True,strategy='time',preselection=preselection)
   elif(strategy.lower()=="events"):
     #no gtmktime cut, Zenith cut applied directly to the events
-    filteredFile,nEvents      = LATdata.performStandardCut(ra,dec,rad,irf,tstart,tstop,emin,emax,zmax,thetamax,True,strategy='events')
+    filteredFile,nEvents      = LATdata.performStandardCut(ra,dec,rad,irf,tstart,tstop,emin,emax,zmax,thetamax,True,strategy='events',preselection=preselection)
     pass
   
   LATdata.doSkyMap(outfile,skybinsize)
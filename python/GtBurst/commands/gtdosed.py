@@ -10,6 +10,9 @@ from GtBurst.my_fits_io import pyfits
 import numpy,math
 import scipy.integrate
 import re
+import io
+import multiprocessing
+from contextlib import redirect_stdout, nullcontext
 import xml.etree.ElementTree as ET
 
 ################ Command definition #############################
@@ -30,6 +33,7 @@ thisCommand.addParameter("ltcube","pre-computed livetime cube",commandDefiner.OP
 thisCommand.addParameter("xmlmodel","XML model",commandDefiner.MANDATORY,partype=commandDefiner.DATASETFILE,extension="fits")
 thisCommand.addParameter("sedtxt","Text file for the output",commandDefiner.MANDATORY,partype=commandDefiner.OUTPUTFILE,extension="txt")
 thisCommand.addParameter("energybins","Comma-separated list of bin boundaries (in MeV). Do not use this if you want the tool to choose the bin automatically",commandDefiner.OPTIONAL)
+thisCommand.addParameter("binmethod","How to choose the energy bins automatically: 'stepwise' (one photon at a time) or 'fast' (bisection on the bin boundaries, assuming that the TS grows with the number of photons)",commandDefiner.OPTIONAL,"stepwise",possiblevalues=['stepwise','fast'])
 #thisCommand.addParameter("irf","Data class (TRANSIENT or SOURCE)",commandDefiner.MANDATORY,'TRANSIENT',possiblevalues=['TRANSIENT','SOURCE'])
 thisCommand.addParameter("clobber","Overwrite output file? (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 thisCommand.addParameter("verbose","Verbose output (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
@@ -66,6 +70,61 @@ def gtdosed(**kwargs):
   run(**kwargs)
 pass
 
+#Data shared (read-only) with the worker processes fitting the energy bands.
+#It is set before forking the pool, so that the workers inherit it
+_sharedBandData                 = {}
+
+def _initBandWorker():
+  #The workers only save figures to files, and must not touch the GUI of the parent
+  import matplotlib.pyplot as plt
+  plt.switch_backend('Agg')
+pass
+
+def _fitBand(args):
+  i,e1,e2                       = args
+  
+  d                             = _sharedBandData
+  
+  output                        = io.StringIO()
+  
+  if(d['captureOutput']):
+    #Avoid interleaving the output of the workers (it is printed by the parent)
+    redirection                 = redirect_stdout(output)
+  else:
+    redirection                 = nullcontext()
+  pass
+  
+  from GtBurst import dataHandling
+  
+  with redirection:
+    thisLATdata                 = dataHandling.LATData(d['eventfile'],d['rspfile'],d['ft2file'],root="SED_%s-%s" %(e1,e2))
+    #Further cut in the energy range for this Band
+    outf,thisCounts             = thisLATdata.performStandardCut(d['ra'],d['dec'],d['rad'],d['irf'],
+                                                                 d['tmin'],d['tmax'],e1,e2,180,gtmktime=False,roicut=False)
+    #Perform the likelihood analysis, using the livetime cube and the exposure map
+    #of the whole energy range
+    outfilelike, sources        = thisLATdata.doUnbinnedLikelihoodAnalysis("__temporary_XML.xml",
+                                                                           tsmin=d['tsmin'],
+                                                                           dogtdiffrsp=False,
+                                                                           expomap=d['expomap'],
+                                                                           ltcube=d['ltcube'])
+  pass
+  
+  source                        = [x for x in sources if x.name==d['sourceName']][0]
+  if(source.flux.find("<")>=0):
+    #This is an upper limit
+    source.flux                 = float(source.flux.split("<")[1].strip())
+    source.fluxError            = -1
+    source.photonFlux           = float(source.photonFlux.split("<")[1].strip())
+    source.photonFluxError      = -1
+  pass
+  
+  results                       = (thisCounts,source.flux,source.fluxError,source.photonFlux,
+                                   source.photonFluxError,float(source.TS),float(source.photonIndex))
+  
+  return i,results,output.getvalue()
+pass
+
 def run(**kwargs):
   if(len(list(kwargs.keys()))==0):
     #Nothing specified, the user needs just help!
@@ -86,6 +145,7 @@ def run(**kwargs):
     xmlmodel                    = thisCommand.getParValue('xmlmodel')
     sedtxt                      = thisCommand.getParValue('sedtxt')
     energybins                  = thisCommand.getParValue('energybins')
+    binmethod                   = thisCommand.getParValue('binmethod')
     clobber                     = _yesOrNoToBool(thisCommand.getParValue('clobber'))
     verbose                     = _yesOrNoToBool(thisCommand.getParValue('verbose'))
     figure                      = thisCommand.getParValue('figure')
@@ -182,7 +242,7 @@ def run(**kwargs):
   if(energybins is not None):
     energyBoundaries            = [float(x) for x in energybins.split(',')]
   else:
-    energyBoundaries          = LikelihoodComponent.optimizeBins(LATdata.like1,energies,sourceName,minTs=tsmin,minEvt=3)
+    energyBoundaries          = LikelihoodComponent.optimizeBins(LATdata.like1,energies,sourceName,minTs=tsmin,minEvt=3,method=binmethod)
   
   print("\nEnergy boundaries:")
   for i,ee1,ee2 in zip(list(range(len(energyBoundaries)-1)),energyBoundaries[:-1],energyBoundaries[1:]):
@@ -198,34 +258,59 @@ def run(**kwargs):
   TSs                         = numpy.zeros(len(energyBoundaries)-1)
   phIndexes                   = numpy.zeros(len(energyBoundaries)-1)
   totalCounts                 = 0
-  for i,e1,e2 in zip(list(range(len(fluxes))),energyBoundaries[:-1],energyBoundaries[1:]):
-    thisLATdata               = dataHandling.LATData(eventfile,rspfile,ft2file,root="SED_%s-%s" %(e1,e2))
-    #Further cut in the energy range for this Band
-    #Remove the version _vv from the name of the irf
-    cleanedIrf                = "_".join(LATdata.irf.split("_")[:-1])
-    outf,thisCounts           = thisLATdata.performStandardCut(LATdata.ra,LATdata.dec,LATdata.rad,cleanedIrf,
-                                                               LATdata.tmin,LATdata.tmax,e1,e2,180,gtmktime=False,roicut=False)
-    totalCounts              += thisCounts
-    #Perform the likelihood analysis
-    outfilelike, sources      = thisLATdata.doUnbinnedLikelihoodAnalysis("__temporary_XML.xml",
-                                                                         tsmin=tsmin,
-                                                                         dogtdiffrsp=False,
-                                                                         expomap=expomap,
-                                                                         ltcube=ltcube)
-    source                    = [x for x in sources if x.name==sourceName][0]
-    if(source.flux.find("<")>=0):
-      #This is an upper limit
-      source.flux             = float(source.flux.split("<")[1].strip())
-      source.fluxError        = -1
-      source.photonFlux       = float(source.photonFlux.split("<")[1].strip())
-      source.photonFluxError  = -1
+  
+  #The bands are independent: fit them at the same time, each one in its own process
+  from GtBurst.Configuration import Configuration
+  ncpus                       = min(int(float(Configuration().get('maxNumberOfCPUs'))),
+                                    multiprocessing.cpu_count(),len(fluxes))
+  
+  #Remove the version _vv from the name of the irf
+  cleanedIrf                  = "_".join(LATdata.irf.split("_")[:-1])
+  
+  _sharedBandData.update(eventfile=eventfile,rspfile=rspfile,ft2file=ft2file,
+                         ra=LATdata.ra,dec=LATdata.dec,rad=LATdata.rad,irf=cleanedIrf,
+                         tmin=LATdata.tmin,tmax=LATdata.tmax,tsmin=tsmin,sourceName=sourceName,
+                         expomap=LATdata.exposureMap,ltcube=LATdata.livetimeCube,
+                         captureOutput=(ncpus > 1))
+  
+  tasks                       = [(i,e1,e2) for i,e1,e2 in zip(list(range(len(fluxes))),energyBoundaries[:-1],energyBoundaries[1:])]
+  
+  #The workers need to inherit the data through fork, which is not
+  #available on every platform
+  try:
+    context                   = multiprocessing.get_context('fork')
+  except ValueError:
+    context                   = None
+  pass
+  
+  try:
+    if(ncpus > 1 and context is not None):
+      print(("\nFitting %s energy bands using %s processes...\n" %(len(tasks),ncpus)))
+      #A new process for each band, so that the likelihood objects do not pile up
+      pool                    = context.Pool(ncpus,initializer=_initBandWorker,maxtasksperchild=1)
+      try:
+        results               = pool.imap_unordered(_fitBand,tasks)
+        allResults            = []
+        for i,bandResults,output in results:
+          print(("\n======== Band %s - %s MeV ========\n" %(tasks[i][1],tasks[i][2])))
+          print(output)
+          allResults.append((i,bandResults,output))
+        pass
+      finally:
+        pool.close()
+        pool.join()
+      pass
+    else:
+      _sharedBandData['captureOutput'] = False
+      allResults              = [_fitBand(task) for task in tasks]
     pass
-    fluxes[i]                 = source.flux
-    fluxes_errors[i]          = source.fluxError
-    phfluxes[i]               = source.photonFlux
-    phfluxes_errors[i]        = source.photonFluxError
-    TSs[i]                    = float(source.TS)
-    phIndexes[i]              = float(source.photonIndex)
+  finally:
+    _sharedBandData.clear()
+  pass
+  
+  for i,bandResults,output in allResults:
+    thisCounts,fluxes[i],fluxes_errors[i],phfluxes[i],phfluxes_errors[i],TSs[i],phIndexes[i] = bandResults
+    totalCounts              += thisCounts
   pass
   
   if(totalCounts!=totalInputCounts):
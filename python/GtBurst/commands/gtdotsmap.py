@@ -29,6 +29,7 @@ thisCommand.addParameter("tsmap","Name for the output file for the TS map",comma
 #thisCommand.addParameter("showmodelimage","Show an image representing the best fit likelihood model?",commandDefiner.OPTIONAL,"yes",possiblevalues=['yes','no'])
 thisCommand.addParameter("step","Size of the grid step (deg)",commandDefiner.OPTIONAL,0.8)
 thisCommand.addParameter("side","Size of the side of the TS map (deg). NB: (side/step)^2 likelihood analysis will be run",commandDefiner.OPTIONAL,'auto')
+thisCommand.addParameter("method","How to compute the map: 'gttsmap' (science tool) or 'fast' (in-process, using up to GTBURST_NCPUS processes)",commandDefiner.OPTIONAL,"gttsmap",possiblevalues=['gttsmap','fast'])
 thisCommand.addParameter("clobber","Overwrite output file? (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 thisCommand.addParameter("verbose","Verbose output (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 thisCommand.addParameter("figure","Matplotlib figure for the interactive mode",commandDefiner.OPTIONAL,None,partype=commandDefiner.PYTHONONLY)
@@ -86,6 +87,7 @@ def run(**kwargs):
     tsmap                       = thisCommand.getParValue('tsmap')
     step                        = float(thisCommand.getParValue('step'))
     side                        = thisCommand.getParValue('side')
+    method                      = thisCommand.getParValue('method')
     if(side=='auto'):
       side                      = None
 #    showmodelimage              = thisCommand.getParValue('showmodelimage')
@@ -124,7 +126,7 @@ def run(**kwargs):
       tsexpomap               = None
   
   LATdata                     = dataHandling.LATData(eventfile,rspfile,ft2file)
-  tsmap                       = LATdata.makeTSmap(xmlmodel,sourceName,step,side,tsmap,tsltcube,tsexpomap)
+  tsmap                       = LATdata.makeTSmap(xmlmodel,sourceName,step,side,tsmap,tsltcube,tsexpomap,method)
   tsltcube                    = LATdata.livetimeCube
   tsexpomap                   = LATdata.exposureMap
   
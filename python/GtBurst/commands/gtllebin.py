@@ -2,6 +2,7 @@
 
 import sys
 import os
+import numpy
 from GtBurst import commandDefiner
 
 from GtBurst.my_fits_io import pyfits
@@ -96,47 +97,54 @@ def run(**kwargs):
   
   message("\n    done.")
   
-  #Make PHA2 with gtbin
-  tempPHA2filename            = "__gtllebin__pha2.pha"
-  
-  # This will use the same energy binning as in the EBOUNDS extension of the rspfile
-  message("\n *  Run gtbindef and gtbin and bin in energy and time...\n")
-
   # if you input a cspec file it will clone the time binning:
   if cspec_in is not None:
-
-    tmpFile=pyfits.open(cspec_in)
-    message('=> Copying the binning from: %s' % cspec_in)
-    _SPECTRUM=tmpFile['SPECTRUM'].data
-    _TIME    =_SPECTRUM.field('TIME')
-    _ENDTIME =_SPECTRUM.field('ENDTIME')
-    tempTimeBinFile="__tmpBinFileFromCSPEC.txt"
-    txt=''
-    for i in range(len(_TIME)): txt+='%s\t%s\n' %( _TIME[i],_ENDTIME[i])
-    file(tempTimeBinFile,'w').writelines(txt)
-    tempTimeBinFile_fits="__tmpBinFileFromCSPEC.fits"
     
-
-    lleData.gtbindef['bintype']='T'
-    lleData.gtbindef['binfile']=tempTimeBinFile
-    lleData.gtbindef['outfile']=tempTimeBinFile_fits
-    lleData.gtbindef.run()    
-
-    lleData.binByEnergyAndTime(tempTimeBinFile_fits,tempPHA2filename)
-  else: lleData.binByEnergyAndTime(tstart,tstop,dt,tempPHA2filename)
-  
-  message("\n    done.")
-  
-  #Transform the PHA2 in CSPEC
-  message("\n *  Transform gtbin output in CSPEC format...")
+    message('=> Copying the binning from: %s' % cspec_in)
+    tmpFile                   = pyfits.open(cspec_in)
+    tstarts                   = numpy.array(tmpFile['SPECTRUM'].data.field('TIME'))
+    tstops                    = numpy.array(tmpFile['SPECTRUM'].data.field('ENDTIME'))
+    tmpFile.close()
+  else:
+    tstarts, tstops           = lleData.getLinearTimeBins(tstart,tstop,dt)
+  pass
   
-  pha2                        = dataHandling.Spectra(tempPHA2filename)
-  #Set Poisson errors to true (this will make POISSERR=True in the output CSPEC file)
-  pha2.setPoisson(True)
-  pha2.write(outfile,format="CSPEC",trigtime=lleData.trigTime,clobber=clobber)
+  if(lleData.isTTE):
+    
+    # This will use the same energy binning as in the EBOUNDS extension of the rspfile
+    message("\n *  Bin in energy and time and write the CSPEC file...\n")
+    
+    lleData.binByEnergyAndTimeToCSPEC(tstarts,tstops,outfile,clobber)
   
-  #Remove the temporary PHA2 file
-  os.remove(tempPHA2filename)
+  else:
+    
+    # The input is a CSPEC file: rebin it to a PHA2 and then transform it in CSPEC
+    tempPHA2filename          = "__gtllebin__pha2.pha"
+    tempTimeBinFile_fits      = "__tmpBinFileFromCSPEC.fits"
+    
+    message("\n *  Rebin in time...\n")
+    
+    timeBins                  = dataHandling.create_from_columns([pyfits.Column(name='START',format='D',array=tstarts),
+                                                                      pyfits.Column(name='STOP',format='D',array=tstops)])
+    timeBins.header.set('EXTNAME','TIMEBINS')
+    pyfits.HDUList([pyfits.PrimaryHDU(),timeBins]).writeto(tempTimeBinFile_fits,overwrite=True)
+    
+    lleData.binByEnergyAndTime(tempTimeBinFile_fits,tempPHA2filename)
+    os.remove(tempTimeBinFile_fits)
+    
+    message("\n    done.")
+    
+    #Transform the PHA2 in CSPEC
+    message("\n *  Transform the PHA2 in CSPEC format...")
+    
+    pha2                      = dataHandling.Spectra(tempPHA2filename)
+    #Set Poisson errors to true (this will make POISSERR=True in the output CSPEC file)
+    pha2.setPoisson(True)
+    pha2.write(outfile,format="CSPEC",trigtime=lleData.trigTime,clobber=clobber)
+    
+    #Remove the temporary PHA2 file
+    os.remove(tempPHA2filename)
+  pass
   
   message("\n    done.")
   
@@ -19,6 +19,7 @@ thisCommand.addParameter("rspfile","LLE response (RSP file)",commandDefiner.MAND
 thisCommand.addParameter("bkgintervals","FITS file defining off-pulse time intervals",commandDefiner.MANDATORY,partype=commandDefiner.INPUTFILE,extension="fits")
 thisCommand.addParameter("srcintervals","FITS file defining source time intervals",commandDefiner.MANDATORY,partype=commandDefiner.INPUTFILE,extension="fits")
 thisCommand.addParameter("bkgspectra","Name for the output file",commandDefiner.MANDATORY,partype=commandDefiner.OUTPUTFILE,extension="bak")
+thisCommand.addParameter("fitmode","How to fit the channels: 'batched' (all at once), 'parallel' (one per process, using up to GTBURST_NCPUS processes) or 'serial'",commandDefiner.OPTIONAL,"batched",possibleValues=['batched','parallel','serial'])
 thisCommand.addParameter("clobber","Overwrite output file? (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 thisCommand.addParameter("verbose","Verbose output (possible values: 'yes' or 'no')",commandDefiner.OPTIONAL,"yes")
 
@@ -67,6 +68,7 @@ def run(**kwargs):
     bkgintervalsFile            = thisCommand.getParValue('bkgintervals')
     srcintervalsFile            = thisCommand.getParValue('srcintervals')
     outfile                     = thisCommand.getParValue('bkgspectra')
+    fitmode                     = thisCommand.getParValue('fitmode')
     clobber                     = _yesOrNoToBool(thisCommand.getParValue('clobber'))
     verbose                     = _yesOrNoToBool(thisCommand.getParValue('verbose'))
   except KeyError as err:
@@ -105,7 +107,7 @@ def run(**kwargs):
   
   message(" *  Fit background with polynomials...")
   
-  cspecBackground               = dataHandling.CspecBackground(cspecfile,rspfile)
+  cspecBackground               = dataHandling.CspecBackground(cspecfile,rspfile,fitmode)
   backPha                       = cspecBackground.getBackgroudSpectrum(bkgIntervals,srcIntervals)
   message("\n    done.")
     
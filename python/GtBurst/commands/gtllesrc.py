@@ -92,10 +92,10 @@ def run(**kwargs):
   
   message("\n    done.")
   
-  #Make PHA2 with gtbin
+  #Make PHA2
   
   #This will use the same energy binning as in the EBOUNDS extension of the rspfile
-  message("\n *  Run gtbindef and gtbin and bin in energy and time...\n")
+  message("\n *  Bin in energy and time...\n")
   
   lleData.binByEnergyAndTime(srcintervals,outfile)
   message("\n    done.")
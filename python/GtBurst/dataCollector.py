@@ -7,14 +7,15 @@ from GtBurst.my_fits_io import pyfits
 
 
 from GtBurst.GtBurstException import GtBurstException
-import ftplib, socket
+import socket
 import time
 try:
   from tkinter import *
 except:
   #Silently accept when tkinter import fail (no X server?)
   pass
-from GtBurst import downloadCallback
+from GtBurst.FTPDownloader import FTPDownloader
+from GtBurst.DataCache import DataCache
 try:
   from GtBurst.lleProgressBar import Meter
 except:
@@ -22,6 +23,9 @@ except:
   pass
 
 class dataCollector(object):
+  #Number of files downloaded at the same time (each one on its own connection)
+  maxFTPConnections           = 4
+  
   def __init__(self,instrument,grbName,dataRepository=None,localRepository=None,
                     getTTE=True,getCSPEC=True,getRSP=True,getCTIME=True,**kwargs):
     
@@ -65,9 +69,11 @@ class dataCollector(object):
     print(("Local data repository (destination): %s (%s)" %(self.localRepository,message)))    
   pass
   
-  def downloadDirectoryWithFTP(self,address,filenames=None,namefilter=None):
-    #Connect to the server
-    if(address.find("ftps://")==0):
+  def downloadDirectoryWithFTP(self,address,filenames=None,namefilter=None,useCache=True):
+    #Connect to the server. Addresses starting with ftp:// use plain FTP,
+    #all the others FTP over TLS
+    useTLS                    = (address.find("ftp://")!=0)
+    if(address.find("ftps://")==0 or address.find("ftp://")==0):
       serverAddress           = address.split("/")[2]
       directory               = "/"+"/".join(address.split("/")[3:])
     else:
@@ -76,27 +82,16 @@ class dataCollector(object):
     pass
     #print('**************> downloadDirectoryWithFTP (serverAddress):',serverAddress)
     #print('**************> downloadDirectoryWithFTP       (address):',address)
-
+    
+    downloader                = FTPDownloader(serverAddress,directory,nConnections=self.maxFTPConnections,
+                                              maxTrials=10,timeout=60,useTLS=useTLS)
+    
     #Open FTP session
     try:
-      ftp                       = ftplib.FTP_TLS(serverAddress,"anonymous",'','',timeout=60)
+      ftp                       = downloader.connect()
     except socket.error as socketerror:
       raise GtBurstException(11,"Error when connecting: %s" % os.strerror(socketerror.errno))
     
-    #print("Loggin in to %s..." % serverAddress),
-    try:
-      ftp.login()
-      ftp.prot_p()
-    except:
-      #Maybe we are already logged in
-      try:
-        ftp.cwd('/')
-      except:
-        #nope! don't know what is happening
-        raise
-      pass
-    pass
-          
     print("done")
     self.makeLocalDir()
     try:
@@ -115,37 +110,13 @@ class dataCollector(object):
       ftp.retrlines('NLST', filenames.append)
     pass
     
-    maxTrials                 = 10
+    toDownload                = []
     
-    #Build the window for the progress
-    if(self.parent is None):
-      #Do not use any graphical output
-      root                 = None
-      m1                   = None
-    else:
-      #make a transient window
-      root                 = Toplevel()
-      root.transient(self.parent)
-      root.grab_set()        
-      l                    = Label(root,text='Downloading...')
-      l.grid(row=0,column=0)
-      m1                    = Meter(root, 500,20,'grey','blue',0,None,None,'white',relief='ridge', bd=3)
-      m1.grid(row=1,column=0)
-      m1.set(0.0,'Download started...')
-      l2                    = Label(root,text='Total progress:')
-      l2.grid(row=2,column=0)
-      m2                    = Meter(root, 500,20,'grey','blue',0,None,None,'white',relief='ridge', bd=3)
-      m2.grid(row=3,column=0)
-      m2.set(0.0,'Download started...')
-    pass
-    
-    for i,filename in enumerate(filenames):
+    for filename in filenames:
       if(namefilter is not None and filename.find(namefilter)<0):
         #Filename does not match, do not download it
         continue
       
-      if(root is not None):
-        m2.set((float(i))/len(filenames))
       skip                    = False
       if(not self.getCSPEC):
         if(filename.find("cspec")>=0):
@@ -164,61 +135,79 @@ class dataCollector(object):
       #  skip                  = (not self.minimal)
       if(skip):
         print(("Skipping %s ..." %(filename)))   
-        continue
       else:
-        print(("Retrieving %s ..." %(filename)), end=' ')
+        toDownload.append(filename)
+      pass
+    pass
+    
+    #Take from the local data cache the files which are already there,
+    #and download only the others
+    cache                     = DataCache()
+    
+    if(useCache and cache.isEnabled()):
+      missing                 = []
+      for filename in toDownload:
+        if(cache.get(self.instrument,self.trigName,filename,os.path.join(self.localRepository,filename))):
+          print(("Taking %s from the local data cache ..." %(filename)))
+        else:
+          missing.append(filename)
+        pass
+      pass
+      toDownload              = missing
+    pass
+    
+    #Build the window for the progress
+    if(self.parent is None):
+      #Do not use any graphical output
+      root                 = None
+      progress             = None
+    else:
+      #make a transient window
+      root                 = Toplevel()
+      root.transient(self.parent)
+      root.grab_set()        
+      l                    = Label(root,text='Downloading...')
+      l.grid(row=0,column=0)
+      m1                    = Meter(root, 500,20,'grey','blue',0,None,None,'white',relief='ridge', bd=3)
+      m1.grid(row=1,column=0)
+      m1.set(0.0,'Download started...')
+      l2                    = Label(root,text='Total progress:')
+      l2.grid(row=2,column=0)
+      m2                    = Meter(root, 500,20,'grey','blue',0,None,None,'white',relief='ridge', bd=3)
+      m2.grid(row=3,column=0)
+      m2.set(0.0,'Download started...')
       
+      #The downloads run in separate threads: the widgets are updated
+      #from this thread with the status of the downloads
+      def progress(status):
+        activeFiles         = status['activeFiles']
+        if(len(activeFiles)>0):
+          l['text']         = "Downloading %s..." %(", ".join(sorted(activeFiles.keys())))
+          received          = sum([x[0] for x in list(activeFiles.values())])
+          totalsize         = sum([x[1] for x in list(activeFiles.values())])
+          m1.set(float(received)/max(totalsize,1))
+        pass
+        m2.set(float(status['filesDone'])/max(status['filesTotal'],1),
+               "%s of %s files (%.2f MB/s)" %(status['filesDone'],status['filesTotal'],
+                                              status['bytes']/1024.0/1024.0/max(status['elapsed'],1e-3)))
+      pass
+    pass
+    
+    try:
+      downloader.download(toDownload,self.localRepository,connection=ftp,progress=progress)
+    finally:
       if(root is not None):
-        l['text']               = "Downloading %s..." % filename
-      
-      done                      = False
-      local_filename          = os.path.join(self.localRepository,filename)
-      
-      while(done==False):        
-        try:
-          f                       = open(local_filename, 'wb')
-        except:
-          raise IOError("Could not open file %s for writing. Do you have write permission on %s?" %(local_filename,self.localRepository))
-        
-        g                         = downloadCallback.get_size()
-        try:
-          ftp.dir(filename,g)
-          totalsize                 = g.size#*1024
-          printer                   = downloadCallback.Callback(totalsize, f,m1)
-          ftp.retrbinary('RETR '+ filename, printer)
-          localSize                 = f.tell()
-          f.close()
-          if(localSize!=totalsize):
-            #This will be catched by the next "except", which will retry
-            raise
-          done                = True
-        except:
-          print("\nConnection lost! Trying to reconnect...")
-          #Reconnect
-          f.close()
-          try:
-            ftp.close()
-          except:
-            pass
-          ftp                 = ftplib.FTP_TLS(serverAddress,"anonymous",'','',timeout=60)
-          try:
-            ftp.login()
-            ftp.prot_p()
-          except:
-            pass
-          ftp.cwd(directory)
-          done                = False
-          continue
-        pass  
-      print(" done")
+        root.destroy()
+      pass
     pass
     
-    ftp.close()
-    print("\nDownload files done!")
-    if(root is not None):
-      m2.set(1.0)
-      root.destroy()
+    if(useCache):
+      for filename in toDownload:
+        cache.put(self.instrument,self.trigName,filename,os.path.join(self.localRepository,filename))
+      pass
     pass
+    
+    print("\nDownload files done!")
   pass
   
   def getFTP(self,errorCode=None,namefilter=None):
@@ -3,20 +3,23 @@
 
 import datetime
 import glob
+import io
 import multiprocessing
 import random
 import re
 import shutil
 import subprocess
+import tempfile
 import time
 import numpy
 import xml.etree.ElementTree as ET
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stdout
 
 import BinnedAnalysis
 import UnbinnedAnalysis
 from GtBurst.wcs_wrap import pywcs
 import scipy.optimize
+import scipy.sparse
 
 from GtBurst.my_fits_io import pyfits
 
@@ -24,8 +27,11 @@ from GtBurst.my_fits_io import pyfits
 from GtBurst import IRFS
 from GtBurst import LikelihoodComponent
 from GtBurst import angularDistance
+from GtBurst import fast_ltcube
+from GtBurst.fast_ts_map import FastTSMap
 from GtBurst import version
 from GtBurst.Configuration import Configuration
+from GtBurst.ProductCache import ProductCache
 from GtBurst.GtBurstException import GtBurstException
 from GtBurst.commands.gtllebin import gtllebin
 from GtBurst.statMethods import *
@@ -987,48 +993,187 @@ class LLEData(object):
             raise ValueError("t2 is not a valid stop time")
         pass
 
-        # Write energy bin file
-        energyBinsFile = "__energyBins.fits"
-        self._writeEnergyBinFile(energyBinsFile)
+        tstarts, tstops = self.getLinearTimeBins(t1, t2, binsize)
 
-        self.gtbin['evfile'] = self.eventFile
-        self.gtbin['scfile'] = self.ft2File
-        self.gtbin['outfile'] = outfile
-        self.gtbin['algorithm'] = "PHA2"
-        self.gtbin['ebinalg'] = "FILE"
-        self.gtbin['ebinfile'] = energyBinsFile
-        self.gtbin['tbinalg'] = "LIN"
-        self.gtbin['tstart'] = t1
-        self.gtbin['tstop'] = t2
-        self.gtbin['dtime'] = binsize
-        self.gtbin['chatter'] = 1
-        self.gtbin['clobber'] = "yes"
-        self.gtbin.run()
+        self._binEventsToPHA2(tstarts, tstops, outfile)
 
-        os.remove(energyBinsFile)
+    pass
+
+    def getLinearTimeBins(self, t1, t2, binsize):
+        '''
+        Return start and stop (in MET) of the time bins of size binsize between t1 and t2
+        (seconds from the trigger time or MET), as gtbin would do with tbinalg=LIN
+        '''
+        t1 = float(t1) + int(float(t1) < 231292801.000) * self.trigTime
+        t2 = float(t2) + int(float(t2) < 231292801.000) * self.trigTime
+        binsize = float(binsize)
+
+        nBins = int(numpy.ceil((t2 - t1) / binsize - 1e-9))
+        edges = t1 + numpy.arange(nBins + 1) * binsize
+
+        return edges[:-1], edges[1:]
+
+    pass
+
+    def binEvents(self, tstarts, tstops):
+        '''
+        Bin the events of the TTE/LLE file in energy, using the EBOUNDS of the response,
+        and in the provided time bins (in MET, sorted and not overlapping). Returns
+        the counts (as a time bins x channels array) and the exposure of each time bin.
+        '''
+        if (not self.isTTE):
+            raise RuntimeError("binEvents needs a TTE/LLE/FT1 file")
+        pass
+
+        tstarts = numpy.asarray(tstarts, dtype=float)
+        tstops = numpy.asarray(tstops, dtype=float)
+
+        with pyfits.open(self.rspFile) as rsp:
+            ebounds = rsp[eboundsExtName].data
+            channelsEmin = numpy.array(ebounds.field(emin_column), dtype=float)
+            channelsEmax = numpy.array(ebounds.field(emax_column), dtype=float)
+        pass
+
+        nChan = len(channelsEmin)
+
+        with pyfits.open(self.eventFile) as f:
+            events = f[eventsExtName].data
+            eventsHeader = f[eventsExtName].header
+            time = numpy.array(events.field("TIME"), dtype=float)
+
+            if ("ENERGY" in events.columns.names):
+                # LLE and FT1 files: energy in MeV, EBOUNDS in keV
+                energy = numpy.array(events.field("ENERGY"), dtype=float) * 1000.0
+                pha = None
+            else:
+                # GBM TTE: use the center of the PHA channel, from the EBOUNDS of the TTE file
+                pha = numpy.array(events.field("PHA"), dtype=int)
+                tteEbounds = f[eboundsExtName].data
+                tteEnergies = (numpy.array(tteEbounds.field(emin_column), dtype=float) +
+                               numpy.array(tteEbounds.field(emax_column), dtype=float)) / 2.0
+                energy = tteEnergies[pha.clip(0, len(tteEnergies) - 1)]
+            pass
+
+            gtiStart = numpy.array(f["GTI"].data.field("START"), dtype=float)
+            gtiStop = numpy.array(f["GTI"].data.field("STOP"), dtype=float)
+        pass
+
+        # Find the time bin and the channel for each event (intervals are [start,stop) )
+        timeIdx = numpy.searchsorted(tstarts, time, side='right') - 1
+        chanIdx = numpy.searchsorted(channelsEmin, energy, side='right') - 1
+
+        good = (timeIdx >= 0) & (chanIdx >= 0)
+        good[good] = (time[good] < tstops[timeIdx[good]]) & (energy[good] < channelsEmax[chanIdx[good]])
+
+        counts = numpy.bincount(timeIdx[good] * nChan + chanIdx[good],
+                                minlength=len(tstarts) * nChan).reshape(len(tstarts), nChan)
+
+        # Exposure
+        if (self.isGBM):
+            # Duration of the good time intervals, minus the dead time of each
+            # event (which is longer for the overflow channel)
+            segStart, segStop = gtiStart, gtiStop
+            liveTime = segStop - segStart
+
+            deadTime = numpy.zeros(len(time)) + float(eventsHeader.get('EVT_DEAD', 0.0))
+            if (pha is not None):
+                overflow = (pha == len(tteEnergies) - 1)
+                deadTime[overflow] = float(eventsHeader.get('EVTDEDHI', eventsHeader.get('EVT_DEAD', 0.0)))
+            pass
+
+            inBin = (timeIdx >= 0)
+            inBin[inBin] = (time[inBin] < tstops[timeIdx[inBin]])
+            totalDeadTime = numpy.bincount(timeIdx[inBin], weights=deadTime[inBin], minlength=len(tstarts))
+        else:
+            # Live time from the spacecraft file, within the good time intervals
+            with pyfits.open(self.ft2File) as ft2:
+                scData = ft2['SC_DATA'].data
+                ft2Start = numpy.array(scData.field("START"), dtype=float)
+                ft2Stop = numpy.array(scData.field("STOP"), dtype=float)
+                ft2Livetime = numpy.array(scData.field("LIVETIME"), dtype=float)
+            pass
+
+            segStart, segStop, segIdx = _intersectIntervals(ft2Start, ft2Stop, gtiStart, gtiStop)
+            liveTime = (segStop - segStart) * ft2Livetime[segIdx] / (ft2Stop[segIdx] - ft2Start[segIdx])
+
+            totalDeadTime = 0.0
+        pass
+
+        weights = _getOverlapMatrix(segStart, segStop, tstarts, tstops)
+        exposure = weights.dot(liveTime) - totalDeadTime
+
+        return counts, exposure
+
+    pass
+
+    def binByEnergyAndTimeToCSPEC(self, tstarts, tstops, outfile, clobber=True):
+        '''
+        Bin the events in energy and in the provided time bins (see binEvents), and write
+        the result in a CSPEC file with Poisson errors. This is done in-process, without
+        temporary files and without running gtbindef and gtbin.
+        '''
+        tstarts = numpy.asarray(tstarts, dtype=float)
+        tstops = numpy.asarray(tstops, dtype=float)
+
+        counts, exposure = self.binEvents(tstarts, tstops)
+
+        spectra = self._binnedSpectra(tstarts, tstops, exposure, counts / (tstops - tstarts)[:, None])
+        spectra.write(outfile, format="CSPEC", trigtime=self.trigTime, clobber=clobber)
+
+    pass
+
+    def _binnedSpectra(self, tstarts, tstops, exposure, rates):
+        '''
+        Return a Spectra with Poisson errors for the binned rates, with the EBOUNDS of the response.
+        '''
+        with pyfits.open(self.rspFile) as rsp:
+            eboundsExt = rsp[eboundsExtName].copy()
+        pass
+
+        channels = numpy.array(eboundsExt.data.field("CHANNEL"), dtype=int)
+
+        if (self.isGBM):
+            chanType = "PHA"
+        else:
+            chanType = "PI"
+        pass
+
+        spectra = Spectra()
+        spectra.addSpectra(tstarts, tstops, exposure, channels, rates,
+                           telescope=self.telescope, instrument=self.instrument,
+                           spectrumType="TOTAL", chanType=chanType, poisserr=True)
+        spectra.addEboundsExtension(eboundsExt)
+
+        return spectra
+
+    pass
+
+    def _binEventsToPHA2(self, tstarts, tstops, outfile):
+        # Bin the events in-process (see binEvents) and write the PHA2 directly
+        tstarts = numpy.asarray(tstarts, dtype=float)
+        tstops = numpy.asarray(tstops, dtype=float)
+
+        counts, exposure = self.binEvents(tstarts, tstops)
+
+        spectra = self._binnedSpectra(tstarts, tstops, exposure, counts / exposure[:, None])
+        spectra.write(outfile, format="PHA2", clobber=True)
+
+        # Add the GTI of the event file, as gtbin does
+        with pyfits.open(self.eventFile) as f:
+            gti = f["GTI"].copy()
+        pass
+        pyfits.append(outfile, gti.data, header=gti.header)
 
     pass
 
     def _binByEnergyAndTimeFile(self, timeBinsFile, outfile):
         if (self.isTTE):
-            # Write energy bin file
-            energyBinsFile = "__energyBins.fits"
-            self._writeEnergyBinFile(energyBinsFile)
-            self.gtbin['evfile'] = self.eventFile
-            self.gtbin['scfile'] = self.ft2File
-            self.gtbin['outfile'] = outfile
-            self.gtbin['algorithm'] = "PHA2"
-            self.gtbin['ebinalg'] = "FILE"
-            self.gtbin['ebinfile'] = energyBinsFile
-            self.gtbin['tbinalg'] = "FILE"
-            self.gtbin['tbinfile'] = timeBinsFile
-            # Need to set this otherwise gtbin will throw a "TSTART must be before than TSTOP!"
-            # exception
-            self.gtbin['tstart'] = -1
-            self.gtbin['tstop'] = 0
-            self.gtbin['clobber'] = "yes"
-            self.gtbin.run()
-            os.remove(energyBinsFile)
+            timeIntervals = TimeIntervalFitsFile(timeBinsFile)
+            intervals = timeIntervals.getIntervals()
+            tstarts = numpy.array([interval.tstart for interval in intervals])
+            tstops = numpy.array([interval.tstop for interval in intervals])
+
+            self._binEventsToPHA2(tstarts, tstops, outfile)
             return
         else:
             # Rebin the CSPEC
@@ -1043,42 +1188,41 @@ class LLEData(object):
             spectraExposure = spectra.field("EXPOSURE")
 
             timeIntervals = TimeIntervalFitsFile(timeBinsFile)
-            newPHA2 = Spectra()
-
-            for interval in timeIntervals.getIntervals():
-                # Find all spectra between start and stop
-                mask = (spectraStop >= interval.tstart) & (spectraStart <= interval.tstop) & (spectraExposure > 0)
-
-                # Compute the weight for each interval: the weight will be 1 for intervals
-                # completely contained between tstart and tstop, and < 1 for the first and
-                # last interval. The weighted sum of the counts give the channel counts between
-                # tstart and tstop, assuming that they are distributed uniformly within the
-                # first and last bin
-                weight = []
-                for i in mask.nonzero()[0]:
-                    weight.append((min(interval.tstop, spectraStop[i]) - max(interval.tstart, spectraStart[i])) /
-                                  (spectraStop[i] - spectraStart[i]))
-                weight = numpy.array(weight)
-
-                if (len(((weight >= 1E-4) & (weight <= 1 - 1E-4)).nonzero()[0]) != 0):
-                    sys.stderr.write(
-                        "\n\nWARNING: time interval %s-%s is not covered exactly by the provided CSPEC file. The resulting spectra might be not accurate.\n\n" % (
-                        interval.tstart, interval.tstop))
-                print(weight)
-                # Sum channel by channel all counts
-                countsToSum = spectra[mask].field("COUNTS")
-                nChan = len(countsToSum[0, :])
-                exposure = numpy.sum(spectra[mask].field("EXPOSURE") * weight)
-                thisSpectrum = Spectrum(interval.tstart, interval.tstop, exposure,
-                                        telescope=self.telescope, instrument=self.instrument, poisserr=True,
-                                        spectrumtype="TOTAL")
-                for chan in range(nChan):
-                    totalCounts = numpy.sum(countsToSum[:, chan] * weight)
-                    error = numpy.sqrt(totalCounts)
-                    thisSpectrum.addChannel(chan, channelsEmin[chan], channelsEmax[chan], totalCounts / exposure,
-                                            error / exposure)
-                pass
+            intervals = timeIntervals.getIntervals()
+            tstarts = numpy.array([interval.tstart for interval in intervals])
+            tstops = numpy.array([interval.tstop for interval in intervals])
+
+            # Only spectra with exposure contribute
+            good = (spectraExposure > 0)
+
+            # Compute the weight of each spectrum in each interval: the weight will be 1
+            # for spectra completely contained between tstart and tstop, and < 1 for the
+            # first and last one. The weighted sum of the counts give the channel counts
+            # between tstart and tstop, assuming that they are distributed uniformly
+            # within the first and last bin
+            weights = _getOverlapMatrix(spectraStart[good], spectraStop[good], tstarts, tstops)
+
+            partial = (weights.data >= 1E-4) & (weights.data <= 1 - 1E-4)
+            partialRows = numpy.unique(numpy.repeat(numpy.arange(weights.shape[0]),
+                                                    numpy.diff(weights.indptr))[partial])
+            for i in partialRows:
+                sys.stderr.write(
+                    "\n\nWARNING: time interval %s-%s is not covered exactly by the provided CSPEC file. The resulting spectra might be not accurate.\n\n" % (
+                    tstarts[i], tstops[i]))
+
+            # Sum all counts in all channels at once
+            totalCounts = weights.dot(numpy.array(spectra.field("COUNTS")[good], dtype=float))
+            exposures = weights.dot(numpy.array(spectraExposure[good], dtype=float))
+            nChan = totalCounts.shape[1]
 
+            newPHA2 = Spectra()
+            for i in range(len(intervals)):
+                thisSpectrum = Spectrum.fromArrays(tstarts[i], tstops[i], exposures[i],
+                                                   numpy.arange(nChan), channelsEmin[:nChan], channelsEmax[:nChan],
+                                                   totalCounts[i] / exposures[i],
+                                                   numpy.sqrt(totalCounts[i]) / exposures[i],
+                                                   telescope=self.telescope, instrument=self.instrument,
+                                                   poisserr=True, spectrumtype="TOTAL")
                 newPHA2.addSpectrum(thisSpectrum)
             pass
             newPHA2.write(outfile, format="PHA2", clobber=True)
@@ -1102,6 +1246,55 @@ class LLEData(object):
 pass
 
 
+def _intersectIntervals(aStart, aStop, bStart, bStop):
+    '''
+    Intersect two lists of sorted, non-overlapping intervals. Returns start and stop
+    of the intersections, and for each one the index of the interval in the first list.
+    '''
+    aStart = numpy.asarray(aStart, dtype=float)
+    aStop = numpy.asarray(aStop, dtype=float)
+    bStart = numpy.asarray(bStart, dtype=float)
+    bStop = numpy.asarray(bStop, dtype=float)
+
+    first = numpy.searchsorted(bStop, aStart, side='right')
+    last = numpy.searchsorted(bStart, aStop, side='left')
+    nOverlaps = numpy.maximum(last - first, 0)
+
+    aIdx = numpy.repeat(numpy.arange(len(aStart)), nOverlaps)
+    bIdx = numpy.repeat(first - numpy.cumsum(nOverlaps) + nOverlaps, nOverlaps) + numpy.arange(nOverlaps.sum())
+
+    start = numpy.maximum(aStart[aIdx], bStart[bIdx])
+    stop = numpy.minimum(aStop[aIdx], bStop[bIdx])
+    keep = (stop > start)
+
+    return start[keep], stop[keep], aIdx[keep]
+
+
+def _getOverlapMatrix(inStart, inStop, outStart, outStop):
+    '''
+    Return a sparse (output bins x input bins) matrix with the fraction of each
+    input bin contained in each output bin. Input bins must be sorted and not
+    overlapping, output bins can be in any order.
+    '''
+    inStart = numpy.asarray(inStart, dtype=float)
+    inStop = numpy.asarray(inStop, dtype=float)
+    outStart = numpy.asarray(outStart, dtype=float)
+    outStop = numpy.asarray(outStop, dtype=float)
+
+    # Range of input bins touching each output bin
+    first = numpy.searchsorted(inStop, outStart, side='left')
+    last = numpy.searchsorted(inStart, outStop, side='right')
+    nOverlaps = numpy.maximum(last - first, 0)
+
+    rows = numpy.repeat(numpy.arange(len(outStart)), nOverlaps)
+    cols = numpy.repeat(first - numpy.cumsum(nOverlaps) + nOverlaps, nOverlaps) + numpy.arange(nOverlaps.sum())
+
+    overlap = (numpy.minimum(outStop[rows], inStop[cols]) - numpy.maximum(outStart[rows], inStart[cols]))
+    weights = overlap / (inStop[cols] - inStart[cols])
+
+    return scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(len(outStart), len(inStart)))
+
+
 class multiprocessScienceTools(dict):
     def __init__(self, scienceTool):
         # If there is more than one processor, use the multi-processor
@@ -1154,39 +1347,20 @@ class my_gtltcube(multiprocessScienceTools):
     def __init__(self):
         multiprocessScienceTools.__init__(self, 'gtltcube')
 
+        # Always use the native implementation, which uses as many processes as
+        # allowed (and only one if ncpus is 1)
+        self.run = self.multiproc_run
+
     pass
 
     def multiproc_run(self):
-        return self.singleproc_run()
 
-        # Get the length of the time interval
-        data = pyfits.getdata(self['evfile'], 'EVENTS')
-        if (data.shape[0] == 0 or (data.field("TIME").max() - data.field("TIME").min() <= 1000.0)):
-            # Use the single processor version (there is no gain in splitting)
-            return self.singleproc_run()
-        else:
-            pass
+        print("\nComputing the livetime cube...")
 
-        exepath = os.path.join(os.path.dirname(__file__), 'gtapps_mp', 'gtltcube_mp.py')
-        cmdline = "python %s %s %s %s %s" % (exepath, self.ncpus,
-                                      self['scfile'],
-                                      self['evfile'],
-                                      self['outfile'])
-        print (cmdline)
-        process = subprocess.Popen(cmdline.split(),
-                                   shell=False, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-        while True:
-            out = process.stdout.readline().decode(encoding='UTF-8')
-            if out == '' and process.poll() is not None:
-                break
-            print (out)
-        # gtltcube_mp(self.ncpus,
-        #            self['scfile'],
-        #            self['evfile'],
-        #            self['outfile'], False, 180)
-        print("\n")
+        fast_ltcube.make_livetime_cube(self['scfile'], self['evfile'], self['outfile'],
+                                       zmax=float(self['zmax']), dcostheta=float(self['dcostheta']),
+                                       binsz=float(self['binsz']), phibins=int(self['phibins']),
+                                       ncpus=self.ncpus)
 
     pass
 
@@ -1194,36 +1368,243 @@ class my_gtltcube(multiprocessScienceTools):
 pass
 
 
+# Data shared (read-only) with the worker processes of the parallel gtdiffrsp.
+# It is set before forking the pool, so that the workers inherit it
+_sharedDiffuseResponseData = {}
+
+
+def _getDiffuseResponseColumns(header):
+    # gtdiffrsp lists the names of the columns it writes in the
+    # NDIFRSP/DIFRSPn keywords of the EVENTS extension
+    return [header['DIFRSP%i' % i] for i in range(int(header.get('NDIFRSP', 0)))]
+
+
+def _runDiffuseResponseShard(args):
+    shardIndex, first, last = args
+
+    pars = _sharedDiffuseResponseData['pars']
+
+    # Each shard has its own directory, so that temporary files of different
+    # gtdiffrsp instances cannot clash
+    shardDir = tempfile.mkdtemp(prefix="__gtdiffrsp_%s_" % shardIndex,
+                                dir=_sharedDiffuseResponseData['workdir'])
+    shardFile = os.path.join(shardDir, "events.fits")
+
+    message = ''
+
+    for attempt in range(_sharedDiffuseResponseData['maxAttempts']):
+
+        # Write the shard from scratch at each attempt, since a failed
+        # run might have left it in an inconsistent state
+        with pyfits.open(pars['evfile'], memmap=True) as f:
+            hdus = [hdu.copy() for hdu in f]
+            hdus[f.index_of('EVENTS')] = pyfits.BinTableHDU(data=f['EVENTS'].data[first:last],
+                                                            header=f['EVENTS'].header)
+            pyfits.HDUList(hdus).writeto(shardFile, overwrite=True)
+        pass
+
+        tool = GtApp('gtdiffrsp')
+        for k, v in pars.items():
+            tool[k] = v
+        pass
+        tool['evfile'] = shardFile
+
+        output = io.StringIO()
+
+        try:
+            # Avoid interleaving the output of the workers
+            with redirect_stdout(output):
+                tool.run()
+
+            with pyfits.open(shardFile) as f:
+                header = f['EVENTS'].header
+                if (len(f['EVENTS'].data) != last - first or len(_getDiffuseResponseColumns(header)) == 0):
+                    raise RuntimeError("the output file does not contain the diffuse response")
+                pass
+            pass
+        except Exception as e:
+            message = "attempt %s: %s\n%s" % (attempt + 1, e, output.getvalue())
+            continue
+        pass
+
+        return shardIndex, shardDir, shardFile, ''
+
+    pass
+
+    return shardIndex, shardDir, None, message
+
+
 class my_gtdiffrsp(multiprocessScienceTools):
+    # Do not split the event list in shards smaller than this
+    minEventsPerShard = 200
+
+    # Number of times a shard is tried before giving up
+    maxAttempts = 3
+
     def __init__(self):
         multiprocessScienceTools.__init__(self, 'gtdiffrsp')
 
+        # If True, the result of the parallel run is checked against the
+        # one of the standard gtdiffrsp (which takes as much time as
+        # running gtdiffrsp serially). Enabled with validateDiffuseResponse
+        # in the configuration (or GTBURST_VALIDATE_DIFFRSP=yes)
+        validate = str(Configuration().get('validateDiffuseResponse')).strip().lower()
+        self.validate = validate in ['yes', 'y', 'true', '1']
+
     pass
 
     def multiproc_run(self):
-        # At the moment gtdiffrsp_mp is not very reliable (it fails sometimes),
-        # so let's force the use of the single processor version
-        return self.singleproc_run()
-        exepath = os.path.join(os.path.dirname(__file__), 'gtapps_mp', 'gtdiffrsp_mp.py')
-        cmdline = "%s %s %s %s %s %s __gtdiffrsp_result.fits" % (exepath, self.ncpus,
-                                                                 self['evfile'],
-                                                                 self['scfile'],
-                                                                 self['srcmdl'],
-                                                                 self['irfs'])
-        print (cmdline)
-        process = subprocess.Popen(cmdline.split(),
-                                   shell=False, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
 
-        while True:
-            out = process.stdout.readline().decode(encoding='UTF-8')
-            if out == '' and process.poll() is not None:
-                break
-            print (out)
-        # gtdiffrsp_mp(self.ncpus, self['scfile'], self['evfile'], '__gtdiffrsp_result.fits', False, self['srcmdl'], self['irfs'])
-        print("\n")
-        shutil.copyfile("__gtdiffrsp_result.fits", "%s" % (self['evfile']))
-        os.remove("__gtdiffrsp_result.fits")
+        evfile = os.path.abspath(self['evfile'])
+
+        with pyfits.open(evfile) as f:
+            nEvents = len(f['EVENTS'].data)
+        pass
+
+        nShards = min(self.ncpus, nEvents // self.minEventsPerShard)
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            context = None
+        pass
+
+        if (nShards < 2 or context is None):
+            return self.singleproc_run()
+
+        pars = dict(self)
+        pars['evfile'] = evfile
+
+        # Contiguous ranges of rows, one for each shard
+        edges = numpy.linspace(0, nEvents, nShards + 1).astype(int)
+        tasks = [(i, edges[i], edges[i + 1]) for i in range(nShards)]
+
+        _sharedDiffuseResponseData.update(pars=pars, workdir=os.path.dirname(evfile),
+                                          maxAttempts=self.maxAttempts)
+
+        print("\nComputing the diffuse response for %s events using %s processes..." % (nEvents, nShards))
+
+        try:
+            pool = context.Pool(nShards)
+            try:
+                results = pool.map(_runDiffuseResponseShard, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            pass
+        finally:
+            _sharedDiffuseResponseData.clear()
+        pass
+
+        try:
+            failed = [(shardIndex, message) for shardIndex, shardDir, shardFile, message in results
+                      if shardFile is None]
+
+            if (len(failed) > 0):
+                for shardIndex, message in failed:
+                    print("\nShard %s of gtdiffrsp failed:\n%s" % (shardIndex, message))
+                pass
+                print("\nWARNING: the parallel gtdiffrsp failed, running the standard one")
+                return self.singleproc_run()
+            pass
+
+            mergedFile = self._mergeShards(evfile, [shardFile for _, _, shardFile, _ in results])
+
+            try:
+                if (self.validate):
+                    self._validateMerged(evfile, mergedFile)
+                pass
+
+                os.replace(mergedFile, evfile)
+            finally:
+                if (os.path.exists(mergedFile)):
+                    os.remove(mergedFile)
+                pass
+            pass
+        finally:
+            for _, shardDir, _, _ in results:
+                shutil.rmtree(shardDir, ignore_errors=True)
+            pass
+        pass
+
+    pass
+
+    def _mergeShards(self, evfile, shardFiles):
+        # Gather the diffuse response columns of all shards, and write them in the
+        # original event file with a single write
+        shards = [pyfits.open(shardFile, memmap=True) for shardFile in shardFiles]
+
+        try:
+            # The header of the first shard contains the keywords added by gtdiffrsp
+            header = shards[0]['EVENTS'].header
+            names = _getDiffuseResponseColumns(header)
+
+            with pyfits.open(evfile, memmap=True) as f:
+                original = f['EVENTS'].columns
+
+                columns = []
+
+                for column in shards[0]['EVENTS'].columns:
+
+                    if (column.name in names):
+                        data = numpy.concatenate([shard['EVENTS'].data.field(column.name) for shard in shards])
+                        columns.append(pyfits.Column(name=column.name, format=column.format,
+                                                     unit=column.unit, array=data))
+                    else:
+                        columns.append(original[column.name])
+                    pass
+                pass
+
+                events = pyfits.BinTableHDU.from_columns(columns, header=header)
+
+                hdus = [hdu.copy() for hdu in f]
+                hdus[f.index_of('EVENTS')] = events
+
+                mergedFile = "%s.__gtdiffrsp_%s" % (evfile, os.getpid())
+                pyfits.HDUList(hdus).writeto(mergedFile, overwrite=True)
+            pass
+        finally:
+            for shard in shards:
+                shard.close()
+            pass
+        pass
+
+        return mergedFile
+
+    pass
+
+    def _validateMerged(self, evfile, mergedFile, rtol=1e-4):
+        # Run the standard gtdiffrsp on a copy of the original event file and
+        # compare its diffuse response columns with the merged ones
+        validationDir = tempfile.mkdtemp(prefix="__gtdiffrsp_validation_", dir=os.path.dirname(evfile))
+
+        try:
+            serialFile = os.path.join(validationDir, "events.fits")
+            shutil.copyfile(evfile, serialFile)
+
+            for k, v in iter(list(self.items())):
+                self.scienceTool[k] = v
+            pass
+            self.scienceTool['evfile'] = serialFile
+            self.scienceTool.run()
+
+            with pyfits.open(serialFile) as serial, pyfits.open(mergedFile) as merged:
+
+                for name in _getDiffuseResponseColumns(serial['EVENTS'].header):
+
+                    if (not numpy.allclose(merged['EVENTS'].data.field(name),
+                                           serial['EVENTS'].data.field(name), rtol=rtol, atol=0)):
+                        raise GtBurstException(202, "The parallel gtdiffrsp gave a result different from "
+                                                    "the standard one for column %s" % (name))
+                    pass
+                pass
+            pass
+
+            print("\nThe parallel gtdiffrsp gave the same result as the standard one")
+        finally:
+            self.scienceTool['evfile'] = self['evfile']
+            shutil.rmtree(validationDir, ignore_errors=True)
+        pass
 
     pass
 
@@ -1341,6 +1722,122 @@ class my_gtexpmap(multiprocessScienceTools):
     pass
 
 
+class LATEventStore(object):
+    '''
+    Keep in memory, sorted by time, the events of a wide selection made by
+    LATData.performStandardCut (usually without a class cut, i.e. with irf=None).
+    The events of any sub-interval can then be extracted with a binary search,
+    instead of running gtmktime and gtselect again on the whole FT1 file.
+    '''
+
+    def __init__(self, eventFile):
+
+        self.eventFile = eventFile
+
+        with pyfits.open(eventFile, memmap=False) as f:
+
+            self.primaryHeader = f[0].header.copy()
+            self.eventsHeader = f['EVENTS'].header.copy()
+            self.gtiHeader = f['GTI'].header.copy()
+
+            events = f['EVENTS'].data
+            time = numpy.array(events.field("TIME"), dtype=float)
+
+            # Science tools write time-ordered files, but better safe than sorry
+            if (numpy.any(numpy.diff(time) < 0)):
+                order = numpy.argsort(time, kind='mergesort')
+                events = events[order]
+                time = time[order]
+            pass
+
+            self.events = events
+            self.time = time
+
+            self.gtiStart = numpy.array(f['GTI'].data.field("START"), dtype=float)
+            self.gtiStop = numpy.array(f['GTI'].data.field("STOP"), dtype=float)
+        pass
+
+        h = self.primaryHeader
+        self.ra = float(h['_ROI_RA'])
+        self.dec = float(h['_ROI_DEC'])
+        self.rad = float(h['_ROI_RAD'])
+        self.tmin = float(h['_TMIN'])
+        self.tmax = float(h['_TMAX'])
+        self.emin = float(h['_EMIN'])
+        self.emax = float(h['_EMAX'])
+        self.zmax = float(h['_ZMAX'])
+        self.strategy = str(h['_STRATEG'])
+        self.thetamax = float(h['_THETAC'])
+
+    pass
+
+    def __len__(self):
+
+        return self.time.shape[0]
+
+    def contains(self, ra, dec, rad, tstart, tstop, emin, emax, zenithCut, thetaCut, strategy):
+        '''
+        Return True if a selection with these cuts (times in MET) is a subset of this one, and
+        uses the same Good Time Intervals.
+        '''
+
+        # The GTIs computed by gtmktime depend on the ROI center, the Zenith and the theta cut,
+        # and on the strategy, so these must be identical
+        sameGTIs = (abs(self.ra - float(ra)) < 1e-4 and abs(self.dec - float(dec)) < 1e-4 and
+                    abs(self.zmax - float(zenithCut)) < 1e-4 and abs(self.thetamax - float(thetaCut)) < 1e-4 and
+                    self.strategy == strategy)
+
+        if (self.strategy == 'time' and float(zenithCut) < 180):
+            # The Zenith cut of the 'time' strategy also depends on the radius of the ROI
+            sameGTIs = sameGTIs and abs(self.rad - float(rad)) < 1e-4
+        pass
+
+        return (sameGTIs and float(rad) <= self.rad + 1e-4 and
+                float(emin) >= self.emin and float(emax) <= self.emax and
+                float(tstart) >= self.tmin and float(tstop) <= self.tmax)
+
+    pass
+
+    def getEventsIndexes(self, tstart, tstop):
+        '''
+        Return first and last+1 index of the events with tstart <= TIME <= tstop
+        '''
+        return (numpy.searchsorted(self.time, float(tstart), side='left'),
+                numpy.searchsorted(self.time, float(tstop), side='right'))
+
+    pass
+
+    def writeInterval(self, tstart, tstop, outfile):
+        '''
+        Write a FT1 file containing only the events and the part of the GTIs between tstart
+        and tstop (MET). Return the number of events written.
+        '''
+
+        first, last = self.getEventsIndexes(tstart, tstop)
+
+        gtiStart, gtiStop, _ = _intersectIntervals([float(tstart)], [float(tstop)], self.gtiStart, self.gtiStop)
+
+        primary = pyfits.PrimaryHDU(header=self.primaryHeader.copy())
+        events = pyfits.BinTableHDU(data=self.events[first:last], header=self.eventsHeader.copy())
+        gti = pyfits.BinTableHDU.from_columns([pyfits.Column(name='START', format='D', unit='s', array=gtiStart),
+                                               pyfits.Column(name='STOP', format='D', unit='s', array=gtiStop)],
+                                              header=self.gtiHeader.copy())
+
+        for hdu in [primary, events, gti]:
+            hdu.header.set('TSTART', float(tstart))
+            hdu.header.set('TSTOP', float(tstop))
+        pass
+
+        pyfits.HDUList([primary, events, gti]).writeto(outfile, overwrite=True)
+
+        return last - first
+
+    pass
+
+
+pass
+
+
 class LATData(LLEData):
     def __init__(self, *kargs, **kwargs):
         LLEData.__init__(self, *kargs, **kwargs)
@@ -1367,8 +1864,9 @@ class LATData(LLEData):
 
         self.strategy = 'time'
         self.data_quality=True
-        # Use the evtype
-        if (irf.lower().find("p8") >= 0):
+        preselection = None
+        # Use the evtype (no class and no type cut if irf is None)
+        if (irf is not None and irf.lower().find("p8") >= 0):
 
             self.evtype = 3
 
@@ -1383,6 +1881,8 @@ class LATData(LLEData):
                 self.evtype = int(kwargs[key])
             elif (key == "data_quality"):
                 self.data_quality = bool(kwargs[key])
+            elif (key == "preselection"):
+                preselection = kwargs[key]
 
         pass
 
@@ -1424,7 +1924,19 @@ class LATData(LLEData):
         if (not self.eventFile):
             raise RuntimeError("You cannot select by time if you don't provide a FT1 file.")
 
-        if (gtmktime):
+        if (preselection is not None and
+                not preselection.contains(ra, dec, rad, tstart, tstop, emin, emax, zenithCut, thetaCut, self.strategy)):
+            print("\nThe pre-selected events do not cover the requested cuts, selecting from the original event file\n")
+            preselection = None
+        pass
+
+        if (preselection is not None):
+            # The pre-selection went already through gtmktime with the same filter, so we only
+            # need to extract the events and the GTIs of this time interval
+            outfilemk = "%s_presel.fit" % (self.rootName)
+            nPreselected = preselection.writeInterval(tstart, tstop, outfilemk)
+            print(("\nExtracted %s events between %s and %s from the pre-selection\n" % (nPreselected, tstart, tstop)))
+        elif (gtmktime):
             self.gtmktime['scfile'] = self.ft2File
             filt=""
             if (self.data_quality):
@@ -1491,14 +2003,19 @@ class LATData(LLEData):
         self.gtselect['emax'] = emax
         self.gtselect['zmax'] = zenithCut
 
-        if (irf.lower() in list(IRFS.IRFS.keys()) and IRFS.IRFS[irf].validateReprocessing(str(reprocessingVersion))):
+        if (irf is None):
+            irfName = 'NONE'
+            evclass = 'INDEF'
+        elif (irf.lower() in list(IRFS.IRFS.keys()) and IRFS.IRFS[irf].validateReprocessing(str(reprocessingVersion))):
             irf = IRFS.IRFS[irf]
+            irfName = irf.name
+            evclass = irf.evclass
         else:
             raise ValueError(
                 "Class %s not known or wrong class for this reprocessing version (%s)." % (irf, reprocessingVersion))
         pass
 
-        self.gtselect['evclass'] = irf.evclass
+        self.gtselect['evclass'] = evclass
         
         try:
         
@@ -1539,7 +2056,7 @@ class LATData(LLEData):
         f[0].header.set('_ZMAX', "%12.5f" % float(zenithCut))
         f[0].header.set('_STRATEG', self.strategy)
         f[0].header.set('_EVTYPE', self.evtype)
-        f[0].header.set('_IRF', "%s" % irf.name)
+        f[0].header.set('_IRF', "%s" % irfName)
         f[0].header.set('_REPROC', '%s' % reprocessingVersion)
         f[0].header.set('_THETAC', '%12.5f' % float(thetaCut))
 
@@ -1653,48 +2170,105 @@ class LATData(LLEData):
 
     pass
 
+    def _getEventFileInputs(self):
+        '''
+        Return the GTIs and the data selection keywords (DSS) of the event file, as inputs
+        for the keys of the product cache
+        '''
+        with pyfits.open(self.eventFile) as f:
+            gti = f['GTI'].data
+            header = f['EVENTS'].header
+            dss = ["%s=%s" % (k, header[k]) for k in list(header.keys()) if k.startswith("DS")]
+
+            return {'gtiStart': numpy.array(gti.field("START"), dtype=float),
+                    'gtiStop': numpy.array(gti.field("STOP"), dtype=float),
+                    'dss': ",".join(dss)}
+
+    pass
+
+    def _getFT2SliceInputs(self, tmin, tmax):
+        '''
+        Return the content of the rows of the FT2 file between tmin and tmax, as inputs
+        for the keys of the product cache
+        '''
+        with pyfits.open(self.ft2File) as f:
+            data = f['SC_DATA'].data
+            idx = (data.START > tmin) & (data.STOP < tmax)
+
+            return dict([("ft2_%s" % name, numpy.array(data.field(name)[idx])) for name in data.columns.names])
+
+    pass
+
     def makeLivetimeCube(self):
         self.getCuts()
 
-        # Cut the FT2 (otherwise gtltcube is SUPER slow)
-        shutil.copy(self.ft2File, "__ft2temp.fits")
-        f = pyfits.open("__ft2temp.fits", "update")
-        idx = (f['SC_DATA'].data.START > self.tmin - 300) & (f['SC_DATA'].data.STOP < self.tmax + 300)
-        f['SC_DATA'].data = f['SC_DATA'].data[idx]
-        f['SC_DATA'].header.set("TSTART", self.tmin - 300)
-        f['SC_DATA'].header.set("TSTOP", self.tmax + 300)
-        f.close()
+        outfilecube = "%s_ltcube.fit" % (self.rootName)
+
+        if (self.strategy == "events"):
+            print("\n\nApplying the Zenith cut in the livetime cube. Hope you know what you are doing...")
+            zmax = self.zmax
+        else:
+            zmax = 180
+
+        # If the same livetime cube has been computed before, just take it from the cache
+        cache = ProductCache()
+        inputs = self._getFT2SliceInputs(self.tmin - 300, self.tmax + 300)
+        inputs.update(self._getEventFileInputs())
+        key = cache.getKey('ltcube', zmax=float(zmax), dcostheta=0.025, binsz=1, phibins=1, **inputs)
+
+        if (cache.get(key, outfilecube)):
+            print("\nUsing the livetime cube in the cache (%s)" % (key))
+            self.livetimeCube = outfilecube
+            return
 
+        # The native implementation of gtltcube (see fast_ltcube) only reads the
+        # part of the FT2 file covered by the GTIs, so there is no need to cut it
         self.gtltcube['evfile'] = self.eventFile
-        self.gtltcube['scfile'] = "__ft2temp.fits"
+        self.gtltcube['scfile'] = self.ft2File
         outfilecube = "%s_ltcube.fit" % (self.rootName)
         self.gtltcube['outfile'] = outfilecube
         self.gtltcube['dcostheta'] = 0.025
         self.gtltcube['binsz'] = 1
         self.gtltcube['phibins'] = 1
         self.gtltcube['clobber'] = 'yes'
-        if (self.strategy == "events"):
-            print("\n\nApplying the Zenith cut in the livetime cube. Hope you know what you are doing...")
-            self.gtltcube['zmax'] = self.zmax
-        else:
-            self.gtltcube['zmax'] = 180
+        self.gtltcube['zmax'] = zmax
 
         try:
             self.gtltcube.run()
         except BaseException as e:
             raise GtBurstException(26, "gtltcube failed in an unexpected way: %s" % str(e))
         self.livetimeCube = outfilecube
-        os.remove("__ft2temp.fits")
+
+        cache.put(key, outfilecube)
 
     pass
 
     def makeExposureMap(self, binsz=1.0):
         self.getCuts()
 
+        outfileexpo = "%s_expomap.fit" % (self.rootName)
+        srcrad = min(2 * self.rad, 88.0)
+        # Guarantee that this is divisible by 4
+        nlong = 4 * int(math.ceil(4 * self.rad / binsz / 4.0))
+        nlat = 4 * int(math.ceil(4 * self.rad / binsz / 4.0))
+        nenergies = 20
+
+        # If the same exposure map has been computed before, just take it from the cache
+        cache = ProductCache()
+        key = cache.getKey('expomap', ltcube=cache.getFileDigest(self.livetimeCube),
+                           ra=self.ra, dec=self.dec, rad=self.rad, emin=self.emin, emax=self.emax,
+                           zmax=self.zmax, irf=self.irf, evtype=self.evtype, srcrad=srcrad,
+                           nlong=nlong, nlat=nlat, nenergies=nenergies,
+                           **self._getEventFileInputs())
+
+        if (cache.get(key, outfileexpo)):
+            print("\nUsing the exposure map in the cache (%s)" % (key))
+            self.exposureMap = outfileexpo
+            return
+
         self.gtexpmap['evfile'] = self.eventFile
         self.gtexpmap['scfile'] = self.ft2File
         self.gtexpmap['expcube'] = self.livetimeCube
-        outfileexpo = "%s_expomap.fit" % (self.rootName)
         self.gtexpmap['outfile'] = outfileexpo
         self.gtexpmap['irfs'] = self.irf
 
@@ -1704,11 +2278,10 @@ class LATData(LLEData):
             self.gtexpmap['evtype'] = self.evtype
         pass
 
-        self.gtexpmap['srcrad'] = min(2 * self.rad, 88.0)
-        # Guarantee that this is divisible by 4
-        self.gtexpmap['nlong'] = 4 * int(math.ceil(4 * self.rad / binsz / 4.0))
-        self.gtexpmap['nlat'] = 4 * int(math.ceil(4 * self.rad / binsz / 4.0))
-        self.gtexpmap['nenergies'] = 20
+        self.gtexpmap['srcrad'] = srcrad
+        self.gtexpmap['nlong'] = nlong
+        self.gtexpmap['nlat'] = nlat
+        self.gtexpmap['nenergies'] = nenergies
         self.gtexpmap['clobber'] = 'yes'
         try:
             self.gtexpmap.run()
@@ -1716,6 +2289,8 @@ class LATData(LLEData):
             raise GtBurstException(27, "gtexpmap failed in an unexpected way: %s" % str(e))
         self.exposureMap = outfileexpo
 
+        cache.put(key, outfileexpo)
+
     pass
 
     def makeBinnedExposureMap(self, binsz=1.0):
@@ -1828,7 +2403,7 @@ class LATData(LLEData):
 
     pass
 
-    def makeDiffuseResponse(self, xmlmodel):
+    def makeDiffuseResponse(self, xmlmodel, validate=None):
         self.getCuts()
 
         self.gtdiffrsp['evfile'] = self.eventFile
@@ -1848,8 +2423,14 @@ class LATData(LLEData):
         pass
 
         self.gtdiffrsp['clobber'] = 'yes'
+        if (validate is not None):
+            # Override the configuration
+            self.gtdiffrsp.validate = validate
+        pass
         try:
             self.gtdiffrsp.run()
+        except GtBurstException:
+            raise
         except:
             raise GtBurstException(202, "gtdiffrsp failed in an unexpected way")
 
@@ -1963,7 +2544,9 @@ class LATData(LLEData):
     pass
 
     def makeTSmap(self, xmlmodel, sourceName, binsz=0.7,
-                  side=None, outfile=None, tsltcube=None, tsexpomap=None):
+                  side=None, outfile=None, tsltcube=None, tsexpomap=None, method='gttsmap'):
+        # method can be 'gttsmap' (use the science tool) or 'fast' (compute the map
+        # in-process with FastTSMap, using up to maxNumberOfCPUs processes)
 
         self.getCuts()
 
@@ -1979,6 +2562,19 @@ class LATData(LLEData):
         pass
 
         self.makeDiffuseResponse(xmlmodel)
+
+        if (outfile is None):
+            outfile = "%s_tsmap.fit" % (self.rootName)
+
+        if (side is None):
+            nside = int(math.ceil(2 * float(self.rad) / float(binsz)))
+        else:
+            nside = int(math.ceil((float(side) / float(binsz))))
+        pass
+
+        if (method == 'fast'):
+            return self._makeFastTSmap(xmlmodel, sourceName, binsz, nside, outfile)
+
         self.gttsmap['irfs'] = self.irf
         self.gttsmap['expcube'] = self.livetimeCube
         # We have to produce a version of the xmlmodel without the source
@@ -1996,17 +2592,9 @@ class LATData(LLEData):
         self.gttsmap['evfile'] = self.eventFile
         self.gttsmap['scfile'] = self.ft2File
         self.gttsmap['expmap'] = self.exposureMap
-        if (outfile is None):
-            outfile = "%s_tsmap.fit" % (self.rootName)
         self.gttsmap['outfile'] = outfile
-
-        if (side is None):
-            self.gttsmap['nxpix'] = int(math.ceil(2 * float(self.rad) / float(binsz)))
-            self.gttsmap['nypix'] = int(math.ceil(2 * float(self.rad) / float(binsz)))
-        else:
-            self.gttsmap['nxpix'] = int(math.ceil((float(side) / float(binsz))))
-            self.gttsmap['nypix'] = int(math.ceil((float(side) / float(binsz))))
-        pass
+        self.gttsmap['nxpix'] = nside
+        self.gttsmap['nypix'] = nside
 
         # Fake values to avoid errors (this is a bug in recent version of the Science Tools)
         # They must be file FITS, but they will not be used
@@ -2031,6 +2619,30 @@ class LATData(LLEData):
 
     pass
 
+    def _makeFastTSmap(self, xmlmodel, sourceName, binsz, nside, outfile):
+
+        configuration = Configuration()
+        ncpus = min(int(float(configuration.get('maxNumberOfCPUs'))),
+                    multiprocessing.cpu_count())
+
+        obs = UnbinnedAnalysis.UnbinnedObs(self.eventFile, self.ft2File,
+                                           expMap=self.exposureMap,
+                                           expCube=self.livetimeCube, irfs=self.irf)
+        like = UnbinnedAnalysis.UnbinnedAnalysis(obs, xmlmodel, optimizer='Minuit')
+
+        print("Computing the TS map using %s processes..." % (ncpus))
+
+        try:
+            tsMap = FastTSMap(like, target=sourceName)
+            tsMap.compute_map(self.ra, self.dec, float(binsz) * nside / 2.0, nside,
+                              proj_name=projection, ncpus=ncpus, outfile=outfile)
+        except:
+            raise GtBurstException(206, "The computation of the TS map failed in an unexpected way")
+
+        return outfile
+
+    pass
+
     def doBinnedLikelihoodAnalysis(self, xmlmodel, tsmin=20, **kwargs):
 
         expomap = None
@@ -2662,8 +3274,37 @@ class TimeIntervalFitsFile(object):
 pass
 
 
+# Data shared (read-only) with the worker processes of the parallel background
+# fit. It is set before forking the pool, so that the workers inherit it
+# instead of receiving a pickled copy for each channel
+_sharedBackgroundData = {}
+
+
+def _fitSharedChannel(args):
+    chanNumber, polGrade = args
+
+    fitter = _sharedBackgroundData['fitter']
+    x = _sharedBackgroundData['x']
+    counts = _sharedBackgroundData['counts']
+    exposure = _sharedBackgroundData['exposure']
+
+    start = time.time()
+
+    # Avoid interleaving the output of the workers
+    with redirect_stdout(io.StringIO()):
+        polynomial, minLogLike = fitter._polyfit(x, counts[:, chanNumber], exposure, polGrade)
+
+    return polynomial, minLogLike, time.time() - start
+
+
 class CspecBackground(object):
-    def __init__(self, cspecFile, rspFile):
+    # Possible values for fitMode:
+    # 'batched'  : fit all channels at once with Newton iterations (default)
+    # 'parallel' : fit each channel with _polyfit (a trust-region Newton fit), on a pool of processes
+    # 'serial'   : fit each channel with _polyfit, one after the other
+    fitModes = ['batched', 'parallel', 'serial']
+
+    def __init__(self, cspecFile, rspFile, fitMode='batched'):
         # Check that the file exists
         if (not _fileExists(cspecFile)):
             raise IOError("File %s does not exist!" % (cspecFile))
@@ -2676,6 +3317,11 @@ class CspecBackground(object):
         pass
         self.rspFile = _getAbsPath(rspFile)
 
+        if (fitMode.lower() not in self.fitModes):
+            raise ValueError("Unknown fit mode %s. Possible values are: %s" % (fitMode, ",".join(self.fitModes)))
+        pass
+        self.fitMode = fitMode.lower()
+
         # Get informations
         self.__readHeader()
 
@@ -2759,34 +3405,37 @@ class CspecBackground(object):
         srcTimeIntervals = _getIterable(srcTimeIntervals)
 
         # Fit the background
-        polynomials = self.polynomialFit(bkgTimeIntervals)
+        self.polynomialFit(bkgTimeIntervals)
 
         # Instanciate the container for the spectra
         spectraContainer = Spectra()
 
+        # Integrate all the polynomials over all the intervals at once
+        tstarts = numpy.array([interval.tstart for interval in srcTimeIntervals])
+        tstops = numpy.array([interval.tstop for interval in srcTimeIntervals])
+        counts = self.polynomialSet.integral(tstarts, tstops)
+        countsErrors = self.polynomialSet.integralError(tstarts, tstops)
+
+        chanNumbers = numpy.array([channel.chanNumber for channel in self.channels])
+        emin = numpy.array([channel.emin for channel in self.channels])
+        emax = numpy.array([channel.emax for channel in self.channels])
+
         # Get the spectra and fill the container
-        for interval in srcTimeIntervals:
+        for i, interval in enumerate(srcTimeIntervals):
 
             # Since the polynomial fit return the "true" background rate,
             # the exposure for the background spectrum is equal to the duration
             # of the interval (deadtime = 0)
             duration = interval.getDuration()
-            thisSpectrum = Spectrum(interval.tstart, interval.tstop, duration,
-                                    telescope=self.telescop, instrument=self.instrume,
-                                    backfile='none', respfile='none', ancrfile='none',
-                                    spectrumType="BKG", chanType=self.chanType,
-                                    poisserr=False)
-
-            for channel, polynomial in zip(self.channels, polynomials):
-                rate = polynomial.integral(interval.tstart, interval.tstop) / duration
-                stat_err = polynomial.integralError(interval.tstart, interval.tstop) / duration
-                sys_err = BACK_SYS_ERROR
-                quality = 0  # Good
-
-                thisSpectrum.addChannel(channel.chanNumber, channel.emin, channel.emax,
-                                        rate, stat_err, quality, sys_err)
+            thisSpectrum = Spectrum.fromArrays(interval.tstart, interval.tstop, duration,
+                                               chanNumbers, emin, emax,
+                                               counts[i] / duration, countsErrors[i] / duration,
+                                               quality=0, sys_err=BACK_SYS_ERROR,
+                                               telescope=self.telescop, instrument=self.instrume,
+                                               backfile='none', respfile='none', ancrfile='none',
+                                               spectrumType="BKG", chanType=self.chanType,
+                                               poisserr=False)
 
-            pass
             spectraContainer.addSpectrum(thisSpectrum)
         pass
 
@@ -2826,21 +3475,32 @@ class CspecBackground(object):
             raise ValueError(
                 "The provided time intervals for the background fit resulted in no selected data. Cannot fit.")
 
+        # Put data to fit in an x vector and in a (bins x channels) matrix of counts
+        x = numpy.array((filteredData.field("TIME") + filteredData.field("ENDTIME")) / 2.0)
+        x -= self.trigTime
+        counts = numpy.array(filteredData.field("COUNTS"), dtype=float)
+        exposure = numpy.array(filteredData.field("EXPOSURE"))
+
         # Fit the sum of counts to get the optimal polynomial grade
         optimalPolGrade = self._fitGlobalAndDetermineOptimumGrade(filteredData)
 
-        # Compute the number of channels
-        nChannels = len(filteredData.field("COUNTS")[0])
+        # Fit the channels
+        if (self.fitMode == 'batched'):
+            results = self._fitChannels(x, counts, exposure, optimalPolGrade)
+        else:
+            results = self._fitChannelsWithPool(x, counts, exposure, optimalPolGrade)
+        pass
+
         polynomials = []
-        for chanNumber in range(nChannels):
+        for chanNumber, (thisPolynomial, cstat) in enumerate(results):
             print(("\nChannel %s: " % (chanNumber)))
-            thisPolynomial, cstat = self._fitChannel(chanNumber, filteredData, optimalPolGrade)
             print(thisPolynomial)
             print(('{0:>20} {1:>6.2f} for {2:<5} d.o.f.'.format("logLikelihood = ", cstat,
                                                                len(filteredData) - optimalPolGrade)))
             polynomials.append(thisPolynomial)
             pass
         self.polynomials = polynomials
+        self.polynomialSet = PolynomialSet(polynomials)
         return polynomials
 
 
@@ -2876,31 +3536,25 @@ class CspecBackground(object):
         counts = d.field('COUNTS')
         t = d.field('TIME') - self.trigTime
         exposure = d.field('EXPOSURE')
-        N = len(t)
-        LC = N * [0]
-        for j in range(N):
-            LC[j] = counts[j].sum()
+        LC = numpy.sum(counts, axis=1)
         f.close()
 
         subfigures.append(lcFigure.add_subplot(2, 1, 1, xlabel=xlabel, ylabel=ylabel))
-        subfigures[-1].step(t, [x[0] / x[1] for x in zip(LC, exposure)], where='post')
+        subfigures[-1].step(t, LC / exposure, where='post')
         subfigures[-1].xaxis.set_visible(False)
-        # Now add the residuals
-        residuals = []
-        for i, t1, t2 in zip(list(range(N)), t[:-1], t[1:]):
-            backgroundCounts, backErr = self.getTotalBackgroundCounts(t1, t2)
-            liveFrac = exposure[i] / (t2 - t1)
-            try:
-                residuals.append((LC[i] - backgroundCounts * liveFrac) / math.sqrt(
-                    backgroundCounts * liveFrac + pow(backErr * liveFrac, 2.0)))
-            except:
-                residuals.append(0)
-        pass
+        # Now add the residuals, computing the background for all the bins at once
+        backgroundCounts, backErr = self.getTotalBackgroundCounts(t[:-1], t[1:])
+        liveFrac = exposure[:-1] / (t[1:] - t[:-1])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            residuals = (LC[:-1] - backgroundCounts * liveFrac) / numpy.sqrt(
+                backgroundCounts * liveFrac + pow(backErr * liveFrac, 2.0))
+        residuals[~numpy.isfinite(residuals)] = 0
+
         subfigures.append(lcFigure.add_subplot(2, 1, 2, xlabel=xlabel, ylabel="Sigma"))
-        tmean = [(x[0] + x[1]) / 2.0 for x in zip(t[:-1], t[1:])]
-        subfigures[-1].errorbar(tmean, residuals, yerr=[1 for x in tmean])
+        tmean = (t[:-1] + t[1:]) / 2.0
+        subfigures[-1].errorbar(tmean, residuals, yerr=numpy.ones(len(tmean)))
         subfigures[-1].set_ylim([min(residuals), min(max(residuals), 10)])
-        subfigures[-1].step(tmean, [0 for x in tmean], "r--", where='post')
+        subfigures[-1].step(tmean, numpy.zeros(len(tmean)), "r--", where='post')
 
         # Wait for the window to close
         self.retryButton = lcFigure.text(0.9, 0.15, 'Retry',
@@ -2940,13 +3594,8 @@ class CspecBackground(object):
         pass
 
     def getTotalBackgroundCounts(self, t1, t2):
-        totalCounts = 0.0
-        statError = 0.0
-        for channel, polynomial in zip(self.channels, self.polynomials):
-            totalCounts += polynomial.integral(t1, t2)
-            statError += pow(polynomial.integralError(t1, t2), 2.0)
-            pass
-        statError = math.sqrt(statError)
+        # t1 and t2 can be arrays, in which case arrays are returned
+        totalCounts, statError = self.polynomialSet.totalIntegral(t1, t2)
         return totalCounts, statError
 
 
@@ -2995,9 +3644,6 @@ class CspecBackground(object):
             initialGuess = [abs(x[1]) / pow(meanx, x[0]) for x in enumerate(initialGuess)]
             pass
 
-        # Improve the solution using a logLikelihood statistic (Cash statistic)
-        logLikelihood = LogLikelihood(x[nonzeroMask], y[nonzeroMask], polynomial, exposure=exposure[nonzeroMask])
-
         # Check that we have enough non-empty bins to fit this grade of polynomial,
         # otherwise lower the grade
         dof = Nnonzero - (polGrade + 1)
@@ -3007,32 +3653,64 @@ class CspecBackground(object):
             # Fit is poorly or ill-conditioned, have to reduce the number of parameters
             while (dof < 2 and len(initialGuess) > 1):
                 initialGuess = initialGuess[:-1]
-                polynomial = Polynomial(initialGuess)
-                logLikelihood = LogLikelihood(x[nonzeroMask], y[nonzeroMask], polynomial, exposure=exposure[nonzeroMask])
             pass
         pass
 
-        # Try to improve the fit with the log-likelihood
-        # try:
-        if (1 == 1):
-            finalEstimate = scipy.optimize.fmin(logLikelihood, initialGuess,
-                                                ftol=1E-5, xtol=1E-5,
-                                                maxiter=1e6, maxfun=1E6,
-                                                disp=False)
-        # except:
-        else:
-            # We shouldn't get here!
-            raise GtBurstException(205,"Fit failed! Try to reduce the degree of the polynomial.")
+        if (numpy.sum(y[nonzeroMask]) == 0):
+            # All the counts are in bins without exposure, nothing to fit
+            return Polynomial([0.0]), 0.0
+
+        # Improve the solution using a logLikelihood statistic (Cash statistic).
+        # Work with x in [-1,1] to keep the Hessian well conditioned, and go back
+        # to the original x at the end
+        nPar = len(initialGuess)
+        scale = numpy.max(numpy.abs(x[nonzeroMask]))
+        if (scale == 0):
+            scale = 1.0
+        toOriginal = pow(scale, -numpy.arange(nPar, dtype=float))
+
+        logLikelihood = BatchedLogLikelihood(x[nonzeroMask] / scale, y[nonzeroMask], nPar - 1,
+                                             exposure=exposure[nonzeroMask])
+
+        startingPoint = numpy.array(initialGuess, dtype=float) / toOriginal
+        if (not numpy.isfinite(logLikelihood(startingPoint))):
+            # The initial guess is negative somewhere: start from a constant rate
+            startingPoint = numpy.zeros(nPar)
+            startingPoint[0] = numpy.sum(y[nonzeroMask]) / numpy.sum(exposure[nonzeroMask])
+        pass
+
+        # The Cash statistic is convex in the parameters of the polynomial, so a
+        # Newton method using the analytic gradient and Hessian converges quickly
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            result = scipy.optimize.minimize(logLikelihood.getValueAndFreeDerivs, startingPoint,
+                                             jac=True, hess=logLikelihood.getHessian,
+                                             method='trust-exact', options={'gtol': 1e-8})
+            finalEstimate = result.x
+
+            if (not result.success):
+                # Refine with the simplex
+                finalEstimate = scipy.optimize.fmin(logLikelihood, finalEstimate,
+                                                    ftol=1E-5, xtol=1E-5,
+                                                    maxiter=1e6, maxfun=1E6,
+                                                    disp=False)
+            pass
         pass
 
         # Get the value for cstat at the minimum
-        minlogLikelihood = logLikelihood(finalEstimate)
+        minlogLikelihood, gradient, hessian = logLikelihood.evaluate(finalEstimate)
+
+        if (not numpy.isfinite(minlogLikelihood)):
+            # We shouldn't get here!
+            raise GtBurstException(205,"Fit failed! Try to reduce the degree of the polynomial.")
+        pass
 
         # Update the polynomial with the fitted parameters,
         # and the relative covariance matrix
-        finalPolynomial = Polynomial(finalEstimate)
+        finalPolynomial = Polynomial(finalEstimate * toOriginal)
         try:
-            finalPolynomial.computeCovarianceMatrix(logLikelihood.getFreeDerivs)
+            covariance = numpy.linalg.inv(hessian)
+            finalPolynomial.setCovarianceMatrix(covariance * numpy.outer(toOriginal, toOriginal))
         except Exception:
             raise GtBurstException(205,"Error in covariance matrix computation!")
         # if test is defined, compare the results with those obtained with ROOT
@@ -3045,18 +3723,13 @@ class CspecBackground(object):
     def _fitGlobalAndDetermineOptimumGrade(self, data):
         # Fit the sum of all the channels to determine the optimal polynomial
         # grade
-        Nintervals = len(data)
 
         # Put data to fit in an x vector and y vector
         counts = data.field("COUNTS")
         x = numpy.array((data.field("TIME") + data.field("ENDTIME")) / 2.0)
         x -= self.trigTime
 
-        y = []
-        for i in range(Nintervals):
-            y.append(numpy.sum(counts[i]))
-        pass
-        y = numpy.array(y)
+        y = numpy.sum(numpy.array(counts, dtype=float), axis=1)
 
         exposure = numpy.array(data.field("EXPOSURE"))
 
@@ -3067,7 +3740,7 @@ class CspecBackground(object):
         grades         = []
         logLikelihoods = []
         for grade in range(minGrade, maxGrade + 1):
-            polynomial, logLike = self._polyfit(x, y, exposure, grade)
+            polynomial, logLike = self._fitChannels(x, y.reshape(-1, 1), exposure, grade)[0]
             print("  Log Likelihood=%s for polynomial grade %s" % (logLike,grade))
             logLikelihoods.append(logLike)
             grades.append(grade)
@@ -3101,28 +3774,101 @@ class CspecBackground(object):
         return bestGrade
 
 
-    def _fitChannel(self, chanNumber, data, polGrade):
+    def _fitChannels(self, x, counts, exposure, polGrade):
+        '''
+        Fit the light curves of all channels (counts is a bins x channels matrix)
+        at the same time with a polynomial of grade polGrade. Returns a list
+        of (polynomial, logLikelihood), one for each channel.
+        '''
 
-        Nintervals = len(data)
+        nChannels = counts.shape[1]
+        results = [None] * nChannels
 
-        # Put data to fit in an x vector and y vector
-        counts = data.field("COUNTS")
-        x = numpy.array((data.field("TIME") + data.field("ENDTIME")) / 2.0)
-        x -= self.trigTime
+        # Follow the same rules of _polyfit: empty channels get a null polynomial,
+        # and channels with too few non-empty bins are fitted with a constant
+        nNonzero = numpy.sum(counts > 0, axis=0)
+        grades = numpy.where(nNonzero - (polGrade + 1) < 2, 0, polGrade)
+
+        for chanNumber in numpy.nonzero(nNonzero == 0)[0]:
+            results[chanNumber] = (Polynomial([0.0]), 0.0)
 
-        y = []
-        for i in range(Nintervals):
-            y.append(counts[i][chanNumber])
+        # Only bins with exposure enter the fit
+        withExposure = (exposure > 0)
+
+        for grade in numpy.unique(grades[nNonzero > 0]):
+            channels = numpy.nonzero((grades == grade) & (nNonzero > 0))[0]
+
+            thesePolynomials, logLikes, converged = fitPolynomialsBatched(x[withExposure],
+                                                                          counts[withExposure][:, channels],
+                                                                          exposure[withExposure], grade)
+
+            for i, chanNumber in enumerate(channels):
+                if (converged[i]):
+                    results[chanNumber] = (thesePolynomials[i], logLikes[i])
+                else:
+                    # Fall back to the single-channel fit (_polyfit) for this channel
+                    results[chanNumber] = self._polyfit(x, counts[:, chanNumber], exposure, polGrade)
+                pass
+            pass
         pass
-        y = numpy.array(y)
 
-        exposure = numpy.array(data.field("EXPOSURE"))
+        return results
 
-        #try:
-        polynomial, minLogLike = self._polyfit(x, y, exposure, polGrade)
-        #except:
-        #polynomial, minLogLike = Polynomial([0.0]), 0.0
-        return polynomial, minLogLike
+    def _fitChannelsWithPool(self, x, counts, exposure, polGrade):
+        '''
+        Fit the light curves of all channels one by one with _polyfit, using a pool
+        of maxNumberOfCPUs processes (in 'parallel' mode) or the current process
+        (in 'serial' mode). Returns a list of (polynomial, logLikelihood), one for
+        each channel, and prints the time spent on each channel.
+        '''
+
+        nChannels = counts.shape[1]
+        tasks = [(chanNumber, polGrade) for chanNumber in range(nChannels)]
+
+        configuration = Configuration()
+        ncpus = min(int(float(configuration.get('maxNumberOfCPUs'))),
+                    multiprocessing.cpu_count(), nChannels)
+
+        # The workers need to inherit the data through fork, which is not
+        # available on every platform
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            context = None
+        pass
+
+        _sharedBackgroundData.update(fitter=self, x=x, counts=counts, exposure=exposure)
+
+        start = time.time()
+
+        try:
+            if (self.fitMode == 'parallel' and ncpus > 1 and context is not None):
+                print("\nFitting %s channels using %s processes..." % (nChannels, ncpus))
+                pool = context.Pool(ncpus)
+                try:
+                    # map returns the results in the same order as the tasks
+                    results = pool.map(_fitSharedChannel, tasks, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+                pass
+            else:
+                print("\nFitting %s channels..." % (nChannels))
+                results = [_fitSharedChannel(task) for task in tasks]
+            pass
+        finally:
+            _sharedBackgroundData.clear()
+        pass
+
+        elapsed = time.time() - start
+
+        print("\nTime spent on each channel:")
+        for chanNumber, (polynomial, minLogLike, thisTime) in enumerate(results):
+            print("  Channel %s: %.3f s" % (chanNumber, thisTime))
+        pass
+        print("  Total (wall clock): %.3f s" % (elapsed))
+
+        return [(polynomial, minLogLike) for polynomial, minLogLike, thisTime in results]
 
 
 class Channel(object):
@@ -3145,10 +3891,6 @@ class Spectrum(object):
         self.tstop = tstop
         self.exposure = exposure
 
-        # This dictionary will store the channels, having the chanNumber as
-        # key and a Channel class as value
-        self.channels = {}
-
         # This channelOffset will be added to the channel numbers,
         # thus the first channel will be numbered channelOffset,
         # the second channelOffset+1 etc. Default: 1 (as Xspec expects)
@@ -3196,13 +3938,24 @@ class Spectrum(object):
                 self.poisserr = kwargs[key]
         pass
 
-        # The following dictionary will have channels as keys, and
-        # counts as values
-        self.spectrum = {}
-        self.sortedChannelNumbers = []
+        # The channels are stored in arrays sorted by channel number, one array
+        # for each column of the PHA format
+        self.chanNumbers = numpy.zeros(0, dtype=int)
+        self.emin = numpy.zeros(0)
+        self.emax = numpy.zeros(0)
+        self.rate = numpy.zeros(0)
+        self.stat_err = numpy.zeros(0)
+        self.sys_err = numpy.zeros(0)
+        self.quality = numpy.zeros(0, dtype=int)
+        self.grouping = numpy.zeros(0, dtype=int)
+
+        # Channel instances, created when needed (see the channels property)
+        self._channels = None
 
     pass
 
+    _channelColumns = ['chanNumbers', 'emin', 'emax', 'rate', 'stat_err', 'sys_err', 'quality', 'grouping']
+
     def addChannel(self, chanNumber, emin, emax, rate, stat_err, quality=0, sys_err=0, grouping=1):
         '''
      Add a channel to the spectrum. Parameters:
@@ -3221,43 +3974,129 @@ class Spectrum(object):
      See http://heasarc.gsfc.nasa.gov/docs/heasarc/ofwg/docs/spectra/ogip_92_007/node7.html .
     '''
 
-        thisChannel = Channel(chanNumber, emin, emax)
+        values = self._checkValues(chanNumber, emin, emax, rate, stat_err, sys_err, quality, grouping)
 
-        # Store thisChannel as value of the channels dictionary (so we can retrieve it by
-        # using the chanNumber), and as key of the spectrum dictionary
-        # Note: both the first and the second dictionary here will store just a
-        # reference to the class thisChannel, thus using it twice does not mean it will
-        # be stored twice.
-        # It seems to be an unnecessary complication, but it will avoid duplicated channels
-        # and it allow to insert channels out of order
-        self.channels[chanNumber] = thisChannel
-        self.spectrum[thisChannel] = (rate, stat_err, sys_err, quality, grouping)
-        self.sortedChanellNumbers = sorted(self.channels.keys())
+        self._channels = None
+
+        # Channels can be inserted out of order, and adding an existing channel
+        # replaces it
+        idx = numpy.searchsorted(self.chanNumbers, chanNumber)
+        if (idx < len(self.chanNumbers) and self.chanNumbers[idx] == chanNumber):
+            for name, value in zip(self._channelColumns, values):
+                getattr(self, name)[idx] = value
+            pass
+        else:
+            for name, value in zip(self._channelColumns, values):
+                setattr(self, name, numpy.insert(getattr(self, name), idx, value))
+            pass
+        pass
 
     pass
 
+    def setChannels(self, chanNumbers, emin, emax, rates, stat_err, quality=0, sys_err=0, grouping=1):
+        '''
+     Set all the channels of the spectrum at once, from arrays with one element per
+     channel (see addChannel). quality, sys_err and grouping can also be scalars.
+    '''
+
+        chanNumbers = numpy.asarray(chanNumbers)
+        values = self._checkValues(chanNumbers, emin, emax, rates, stat_err, sys_err, quality, grouping)
+        values = [v if v.shape == chanNumbers.shape else numpy.zeros(chanNumbers.shape, dtype=v.dtype) + v
+                  for v in values]
+
+        if (numpy.all(chanNumbers[1:] > chanNumbers[:-1])):
+            # Already sorted: keep the arrays as they are (they might be views)
+            order = slice(None)
+        else:
+            # Sort, and keep only the last occurrence of duplicated channels
+            order = numpy.argsort(chanNumbers, kind='stable')
+            last = numpy.append(chanNumbers[order][1:] != chanNumbers[order][:-1], True)
+            order = order[last]
+        pass
+
+        for name, value in zip(self._channelColumns, values):
+            setattr(self, name, value[order])
+        pass
+
+        self._channels = None
+
+    pass
+
+    def _checkValues(self, chanNumbers, emin, emax, rates, stat_err, sys_err, quality, grouping):
+        # Missing errors (for example for spectra with Poisson errors) are stored as NaN
+        if (stat_err is None):
+            stat_err = numpy.nan
+        if (sys_err is None):
+            sys_err = numpy.nan
+
+        return [numpy.asarray(chanNumbers, dtype=int), numpy.asarray(emin, dtype=float),
+                numpy.asarray(emax, dtype=float), numpy.asarray(rates, dtype=float),
+                numpy.asarray(stat_err, dtype=float), numpy.asarray(sys_err, dtype=float),
+                numpy.asarray(quality, dtype=int), numpy.asarray(grouping, dtype=int)]
+
+    pass
+
+    @classmethod
+    def fromArrays(cls, tstart, tstop, exposure, chanNumbers, emin, emax, rates, stat_err,
+                   quality=0, sys_err=0, grouping=1, **kwargs):
+        '''
+     Build a spectrum in one go from arrays with one element per channel (see
+     setChannels). Other keywords are passed to the constructor.
+    '''
+        thisSpectrum = cls(tstart, tstop, exposure, **kwargs)
+        thisSpectrum.setChannels(chanNumbers, emin, emax, rates, stat_err, quality, sys_err, grouping)
+
+        return thisSpectrum
+
+    @property
+    def channels(self):
+        # Dictionary with the chanNumber as key and a Channel class as value. The
+        # Channel instances are created once for each set of channels, so they can
+        # be used as keys of the spectrum dictionary
+        if (self._channels is None):
+            self._channels = dict((n, Channel(n, e1, e2)) for n, e1, e2 in zip(self.chanNumbers.tolist(),
+                                                                               self.emin.tolist(),
+                                                                               self.emax.tolist()))
+        pass
+
+        return self._channels
+
+    @property
+    def spectrum(self):
+        # Dictionary with the channels as keys, and (rate, stat_err, sys_err, quality, grouping)
+        # as values
+        channels = self.channels
+        return dict((channels[n], values) for n, values in
+                    zip(self.chanNumbers.tolist(), zip(self.rate.tolist(), self.stat_err.tolist(),
+                                                       self.sys_err.tolist(), self.quality.tolist(),
+                                                       self.grouping.tolist())))
+
+    @property
+    def sortedChanellNumbers(self):
+        return self.chanNumbers.tolist()
+
     def getRates(self):
-        return [self.spectrum[self.channels[key]][0] for key in self.sortedChanellNumbers]
+        return self.rate.tolist()
 
     pass
 
     def getStat_err(self):
-        return [self.spectrum[self.channels[key]][1] for key in self.sortedChanellNumbers]
+        return self.stat_err.tolist()
 
     pass
 
     def getSys_err(self):
-        return [self.spectrum[self.channels[key]][2] for key in self.sortedChanellNumbers]
+        return self.sys_err.tolist()
 
     pass
 
     def getQuality(self):
-        return [self.spectrum[self.channels[key]][3] for key in self.sortedChanellNumbers]
+        return self.quality.tolist()
 
     pass
 
     def getGrouping(self):
-        return [self.spectrum[self.channels[key]][4] for key in self.sortedChanellNumbers]
+        return self.grouping.tolist()
 
     pass
 
@@ -3283,30 +4122,36 @@ class Spectra(object):
 
     pass
 
+    # Columns of the PHA/CSPEC formats with one value per spectrum, and with one value
+    # per channel
+    _spectrumColumns = {'tstart': float, 'tstop': float, 'exposure': float}
+    _channelColumns = {'channel': int, 'rate': float, 'stat_err': float, 'sys_err': float,
+                       'quality': int, 'grouping': int}
+
     def _normalConstructor(self):
-        # This list will contain all the instances of the class Spectrum
-        self.spectra = []
-
-        # The following lists corresponds to the different columns in the PHA/CSPEC
-        # formats, and they will be filled up by addSpectrum()
-        self.tstart = []
-        self.tstop = []
-        self.channel = []
-        self.rate = []
-        self.stat_err = []
-        self.sys_err = []
-        self.quality = []
-        self.grouping = []
-        self.exposure = []
+        # The columns are stored in (spectra x channels) arrays (or 1-d arrays for
+        # the columns with one value per spectrum), filled up by addSpectrum().
+        # The arrays are allocated in advance and grown when needed, so that adding
+        # spectra one by one is not quadratic. Use the properties (tstart, rate...)
+        # to get views of the filled part
+        self._columns = {}
+        self._nSpectra = 0
+        self._nChannels = None
+
         self.backfile = []
         self.respfile = []
         self.ancrfile = []
 
-        # These two lists store the maximum length of the filenames for background
-        # ancillary and response files, we will need them when writing the PHA2/CSPEC file
-        self.maxlengthbackfile = 0
-        self.maxlengthrespfile = 0
-        self.maxlengthancrfile = 0
+        # This list contains the instances of the class Spectrum. Spectra read from
+        # a file are created only when needed (see the spectra property)
+        self._spectra = []
+
+        # Keywords describing all the spectra (taken from the first spectrum)
+        self._metadata = None
+
+        # Channel numbers and energy bounds, used to build the Spectrum instances
+        # of spectra read from a file
+        self._channelBounds = None
 
         # This is to indicate if all the spectra have poisson errors
         self.poisser = False
@@ -3323,11 +4168,97 @@ class Spectra(object):
 
     pass
 
+    def _getColumn(self, name):
+        return self._columns[name][:self._nSpectra]
+
+    tstart = property(lambda self: self._getColumn('tstart'))
+    tstop = property(lambda self: self._getColumn('tstop'))
+    exposure = property(lambda self: self._getColumn('exposure'))
+    channel = property(lambda self: self._getColumn('channel'))
+    rate = property(lambda self: self._getColumn('rate'))
+    stat_err = property(lambda self: self._getColumn('stat_err'))
+    sys_err = property(lambda self: self._getColumn('sys_err'))
+    quality = property(lambda self: self._getColumn('quality'))
+    grouping = property(lambda self: self._getColumn('grouping'))
+
+    # Maximum length of the filenames for background, ancillary and response files,
+    # needed when writing the PHA2/CSPEC file
+    maxlengthbackfile = property(lambda self: max([len(x) for x in self.backfile] + [0]))
+    maxlengthrespfile = property(lambda self: max([len(x) for x in self.respfile] + [0]))
+    maxlengthancrfile = property(lambda self: max([len(x) for x in self.ancrfile] + [0]))
+
+    @property
+    def spectra(self):
+        for i, thisSpectrum in enumerate(self._spectra):
+            if (thisSpectrum is None):
+                self._spectra[i] = self._makeSpectrum(i)
+            pass
+        pass
+        return self._spectra
+
+    def _makeSpectrum(self, i):
+        if (self._channelBounds is None):
+            emin = emax = numpy.nan
+        else:
+            chanNumbers, emin, emax = self._channelBounds
+            idx = numpy.searchsorted(chanNumbers, self.channel[i]).clip(0, len(chanNumbers) - 1)
+            emin, emax = emin[idx], emax[idx]
+        pass
+        m = self._metadata
+
+        return Spectrum.fromArrays(self.tstart[i], self.tstop[i], self.exposure[i],
+                                   self.channel[i], emin, emax, self.rate[i],
+                                   self.stat_err[i], self.quality[i], self.sys_err[i], self.grouping[i],
+                                   telescope=m['telescope'], instrument=m['instrument'], filter=m['filter'],
+                                   backfile=self.backfile[i], respfile=self.respfile[i],
+                                   ancrfile=self.ancrfile[i], spectrumType=m['spectrumType'],
+                                   chanType=m['chanType'], poisserr=m['poisserr'])
+
+    def _appendRows(self, columns, backfiles, respfiles, ancrfiles):
+        # Add many spectra at once. columns is a dictionary with one array for each
+        # of the columns in _spectrumColumns and _channelColumns
+        nNew = len(columns['tstart'])
+        nChannels = numpy.shape(columns['rate'])[1]
+
+        if (self._nChannels is None):
+            self._nChannels = nChannels
+            for name, dtype in self._spectrumColumns.items():
+                self._columns[name] = numpy.zeros(nNew, dtype=dtype)
+            for name, dtype in self._channelColumns.items():
+                self._columns[name] = numpy.zeros([nNew, nChannels], dtype=dtype)
+            pass
+        elif (nChannels != self._nChannels):
+            raise ValueError("All the spectra must have the same number of channels (%s)" % (self._nChannels))
+        pass
+
+        # Grow the arrays if needed (doubling their size)
+        capacity = len(self._columns['tstart'])
+        if (self._nSpectra + nNew > capacity):
+            newCapacity = max(2 * capacity, self._nSpectra + nNew)
+            for name, column in self._columns.items():
+                newColumn = numpy.zeros((newCapacity,) + column.shape[1:], dtype=column.dtype)
+                newColumn[:self._nSpectra] = column[:self._nSpectra]
+                self._columns[name] = newColumn
+            pass
+        pass
+
+        for name, column in self._columns.items():
+            column[self._nSpectra:self._nSpectra + nNew] = columns[name]
+        pass
+
+        self._nSpectra += nNew
+
+        self.backfile.extend(backfiles)
+        self.respfile.extend(respfiles)
+        self.ancrfile.extend(ancrfiles)
+
+    pass
+
     def _getColOrKeyword(self, data, header, name):
         try:
             q = numpy.array(data.field(name))
         except:
-            q = numpy.array([header[name] for x in range(len(data))])
+            q = numpy.repeat(numpy.array([header[name]]), len(data))
         pass
 
         return q
@@ -3339,7 +4270,7 @@ class Spectra(object):
             rate = data.field("RATE")
         except:
             counts = data.field("COUNTS")
-            rate = numpy.array([x[0] / x[1] for x in zip(counts, (data.field("TELAPSE")))])
+            rate = counts / numpy.asarray(data.field("TELAPSE"))[:, None]
         pass
         return rate
 
@@ -3352,10 +4283,10 @@ class Spectra(object):
             if (q.ndim == 1):
                 # q has one value for spectrum, while we need N values for each i-th spectrum, where
                 # N is len(channel[i]). Copy the value to generate an array for each spectrum
-                q = numpy.array([numpy.zeros(len(x)) + q for x in channels])
+                q = numpy.zeros(channels.shape) + q[:, None]
             pass
         except:
-            q = numpy.array([numpy.zeros(len(x)) + defaultValue for x in channels])
+            q = numpy.zeros(channels.shape) + defaultValue
         pass
 
         return q
@@ -3371,53 +4302,35 @@ class Spectra(object):
 
         header = f["SPECTRUM"].header
         spectrumExtData = f["SPECTRUM"].data
-        eboundsExtData = f["EBOUNDS"].data
-        emin = eboundsExtData.field("E_MIN")
-        emax = eboundsExtData.field("E_MAX")
-        channels = eboundsExtData.field("CHANNEL")
-        ebounds = {}
-        for i in range(len(eboundsExtData)):
-            ebounds[channels[i]] = Channel(channels[i], emin[i], emax[i])
-        pass
-
-        Nspectra = len(spectrumExtData)
 
         # Get some infos from the header
-        telescope = header["TELESCOP"]
-        instrument = header["INSTRUME"]
-        spectrumType = header["HDUCLAS2"]
-        chanType = header["CHANTYPE"]
         try:
             poisserr = header["POISSERR"]
         except:
             poisserr = True
         pass
 
-        tstarts = spectrumExtData.field("TSTART")
-        telapses = spectrumExtData.field("TELAPSE")
-        tstops = tstarts + telapses
-        exposures = spectrumExtData.field("EXPOSURE")
-        channels = spectrumExtData.field("CHANNEL")
-        rates = self._getRate(spectrumExtData)
+        tstarts = numpy.array(spectrumExtData.field("TSTART"))
+        telapses = numpy.array(spectrumExtData.field("TELAPSE"))
+        channels = numpy.array(spectrumExtData.field("CHANNEL"))
+
+        columns = {}
+        columns['tstart'] = tstarts
+        columns['tstop'] = tstarts + telapses
+        columns['exposure'] = spectrumExtData.field("EXPOSURE")
+        columns['channel'] = channels
+        columns['rate'] = self._getRate(spectrumExtData)
 
         if (poisserr == True):
-            stat_err = None
+            columns['stat_err'] = numpy.nan
+            columns['sys_err'] = numpy.nan
         else:
-            stat_err = spectrumExtData.field("STAT_ERR")
+            columns['stat_err'] = spectrumExtData.field("STAT_ERR")
+            columns['sys_err'] = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "SYS_ERR")
         pass
 
-        sys_err = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "SYS_ERR")
-        quality = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "QUALITY")
-        grouping = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "GROUPING")
-
-        # Fix the grouping column (if all the grouping value for a given spectrum are 1, then subsitute the
-        # array of 1s with just one
-        for i, group in enumerate(grouping):
-            mask = (group == 0)
-            if (len(mask.nonzero()[0]) == len(group)):
-                grouping[i] = 0
-            pass
-        pass
+        columns['quality'] = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "QUALITY")
+        columns['grouping'] = self._getColOrKeywordOrZeros(spectrumExtData, header, channels, "GROUPING")
 
         backfiles = self._getColOrKeyword(spectrumExtData, header, "BACKFILE")
         respfiles = self._getColOrKeyword(spectrumExtData, header, "RESPFILE")
@@ -3425,28 +4338,14 @@ class Spectra(object):
 
         self._normalConstructor()
 
-        # add all the spectra contained in this PHA2
-        for i in range(Nspectra):
-            thisSpectrum = Spectrum(tstarts[i], tstops[i], exposures[i],
-                                    telescope=telescope, instrument=instrument,
-                                    backfile=backfiles[i], respfile=respfiles[i], ancrfile=ancrfiles[i],
-                                    spectrumType=spectrumType, chanType=chanType,
-                                    poisserr=poisserr)
-            for j, chan in enumerate(channels[i]):
-                if (stat_err  is not None):
-                    thisStatErr = stat_err[i][j]
-                    thisSysErr = sys_err[i][j]
-                else:
-                    thisStatErr = None
-                    thisSysErr = None
-                pass
-
-                thisSpectrum.addChannel(chan, ebounds[chan].emin, ebounds[chan].emax,
-                                        rates[i][j], thisStatErr, quality[i][j], thisSysErr, grouping[i][j])
-            pass
+        self._metadata = {'telescope': header["TELESCOP"], 'instrument': header["INSTRUME"],
+                          'filter': "UNKN-FILTER", 'spectrumType': header["HDUCLAS2"],
+                          'chanType': header["CHANTYPE"], 'poisserr': poisserr}
 
-            self.addSpectrum(thisSpectrum)
-        pass
+        # add all the spectra contained in this PHA2
+        self._appendRows(columns, [str(x) for x in backfiles], [str(x) for x in respfiles],
+                         [str(x) for x in ancrfiles])
+        self._spectra = [None] * len(tstarts)
 
         # Now load the EBOUNDS extension, if any
         try:
@@ -3467,7 +4366,7 @@ class Spectra(object):
     '''
         if (value is None):
             # Use the value for the first spectrum
-            self.poisserr = self.spectra[0].poisserr
+            self.poisserr = self._metadata['poisserr']
         else:
             self.poisserr = bool(value)
         pass
@@ -3475,28 +4374,55 @@ class Spectra(object):
     pass
 
     def addSpectrum(self, spectrum):
-        self.spectra.append(spectrum)
-
-        # Fill all the lists
-        self.tstart.append(spectrum.tstart)
-        self.tstop.append(spectrum.tstop)
-        self.channel.append(list(spectrum.channels.keys()))
-        self.rate.append(spectrum.getRates())
-        self.stat_err.append(spectrum.getStat_err())
-        self.sys_err.append(spectrum.getSys_err())
-        self.quality.append(spectrum.getQuality())
-        self.grouping.append(spectrum.getGrouping())
-        self.exposure.append(spectrum.exposure)
-        self.backfile.append(spectrum.backfile)
-        self.respfile.append(spectrum.respfile)
-        self.ancrfile.append(spectrum.ancrfile)
-
-        # This is to store the maximum length of the strings describing background,
-        # response and ancillary files, which is needed to write the columns in the correct
-        # FITS format
-        self.maxlengthbackfile = max([len(x) for x in self.backfile])
-        self.maxlengthrespfile = max([len(x) for x in self.respfile])
-        self.maxlengthancrfile = max([len(x) for x in self.ancrfile])
+        if (self._metadata is None):
+            self._metadata = {'telescope': spectrum.telescope, 'instrument': spectrum.instrument,
+                              'filter': spectrum.filter, 'spectrumType': spectrum.spectrumType,
+                              'chanType': spectrum.chanType, 'poisserr': spectrum.poisserr}
+        pass
+
+        # Fill all the columns
+        columns = {'tstart': [spectrum.tstart], 'tstop': [spectrum.tstop], 'exposure': [spectrum.exposure],
+                   'channel': [spectrum.chanNumbers], 'rate': [spectrum.rate],
+                   'stat_err': [spectrum.stat_err], 'sys_err': [spectrum.sys_err],
+                   'quality': [spectrum.quality], 'grouping': [spectrum.grouping]}
+
+        self._appendRows(columns, [spectrum.backfile], [spectrum.respfile], [spectrum.ancrfile])
+        self._spectra.append(spectrum)
+
+        self.setPoisson()
+
+    pass
+
+    def addSpectra(self, tstart, tstop, exposure, channels, rates, stat_err=None, sys_err=None,
+                   quality=0, grouping=0, backfile='none', respfile='none', ancrfile='none', **kwargs):
+        '''
+    Add many spectra at once. tstart, tstop and exposure have one element per
+    spectrum, while channels and the other columns are (spectra x channels) arrays
+    (or scalars, or one array valid for all spectra). Other keywords describe the
+    spectra, as in the constructor of Spectrum.
+    '''
+        if (self._metadata is None):
+            template = Spectrum(0, 0, 0, **kwargs)
+            self._metadata = {'telescope': template.telescope, 'instrument': template.instrument,
+                              'filter': template.filter, 'spectrumType': template.spectrumType,
+                              'chanType': template.chanType, 'poisserr': template.poisserr}
+        pass
+
+        nSpectra = len(tstart)
+        rates = numpy.asarray(rates, dtype=float)
+        shape = rates.shape
+
+        def _column(value):
+            if (value is None):
+                value = numpy.nan
+            return numpy.zeros(shape) + value
+
+        columns = {'tstart': tstart, 'tstop': tstop, 'exposure': exposure,
+                   'channel': _column(channels), 'rate': rates, 'stat_err': _column(stat_err),
+                   'sys_err': _column(sys_err), 'quality': _column(quality), 'grouping': _column(grouping)}
+
+        self._appendRows(columns, [backfile] * nSpectra, [respfile] * nSpectra, [ancrfile] * nSpectra)
+        self._spectra.extend([None] * nSpectra)
 
         self.setPoisson()
 
@@ -3505,6 +4431,12 @@ class Spectra(object):
     def addEboundsExtension(self, ebounds):
         self.ebounds = ebounds.copy()
 
+        # Channel numbers and energy bounds, sorted by channel
+        channels = numpy.array(ebounds.data.field("CHANNEL"))
+        order = numpy.argsort(channels)
+        self._channelBounds = (channels[order], numpy.array(ebounds.data.field("E_MIN"))[order],
+                               numpy.array(ebounds.data.field("E_MAX"))[order])
+
     pass
 
     def addKeywordtoSpectrum(self, keyword, value):
@@ -3559,7 +4491,7 @@ class Spectra(object):
                 clobber = bool(kwargs[key])
         pass
 
-        Nchan = len(self.rate[0])
+        Nchan = self._nChannels
         vectFormatD = "%sD" % (Nchan)
         vectFormatI = "%sI" % (Nchan)
 
@@ -3576,7 +4508,7 @@ class Spectra(object):
                                    array=(numpy.array(self.tstop) - numpy.array(self.tstart)), unit="s")
 
         spec_numCol = pyfits.Column(name='SPEC_NUM', format='I',
-                                    array=list(range(1, len(self.spectra) + 1)))
+                                    array=numpy.arange(1, self._nSpectra + 1))
 
         channelCol = pyfits.Column(name='CHANNEL', format=vectFormatI,
                                    array=numpy.array(self.channel))
@@ -3635,19 +4567,19 @@ class Spectra(object):
         newTable.header.set('BACKSCAL', 1.0)
         newTable.header.set('HDUCLASS', 'OGIP')
         newTable.header.set('HDUCLAS1', 'SPECTRUM')
-        newTable.header.set('HDUCLAS2', self.spectra[0].spectrumType)
+        newTable.header.set('HDUCLAS2', self._metadata['spectrumType'])
         newTable.header.set('HDUCLAS3', 'RATE')
         newTable.header.set('HDUCLAS4', 'TYPE:II')
         newTable.header.set('HDUVERS', '1.2.0')
-        newTable.header.set('TELESCOP', self.spectra[0].telescope)
-        newTable.header.set('INSTRUME', self.spectra[0].instrument)
+        newTable.header.set('TELESCOP', self._metadata['telescope'])
+        newTable.header.set('INSTRUME', self._metadata['instrument'])
 
-        if (self.spectra[0].filter != 'unknown'):
-            newTable.header.set('FILTER', self.spectra[0].filter)
+        if (self._metadata['filter'] != 'unknown'):
+            newTable.header.set('FILTER', self._metadata['filter'])
 
-        newTable.header.set('CHANTYPE', self.spectra[0].chanType)
+        newTable.header.set('CHANTYPE', self._metadata['chanType'])
         newTable.header.set('POISSERR', self.poisserr)
-        newTable.header.set('DETCHANS', len(self.channel[0]))
+        newTable.header.set('DETCHANS', self._nChannels)
         newTable.header.set('CREATOR', "dataHandling.py v.%s" % (moduleVersion),
                             "(G.Vianello, giacomov@slac.stanford.edu)")
 
@@ -3690,22 +4622,26 @@ class Spectra(object):
                 clobber = bool(kwargs[key])
         pass
 
-        Nchan = len(self.rate[0])
+        Nchan = self._nChannels
         vectFormatD = "%sD" % (Nchan)
         vectFormatI = "%sJ" % (Nchan)
 
-        dt = numpy.array(self.tstop) - numpy.array(self.tstart)
+        dt = (self.tstop - self.tstart)[:, None]
+
+        counts = self.rate * dt
 
-        counts = [x[0] * x[1] for x in zip(numpy.array(self.rate), dt)]
+        if (self.poisserr):
+            # Counts are integer numbers, avoid truncating them because of rounding errors
+            counts = numpy.rint(counts)
 
         countsCol = pyfits.Column(name='COUNTS', format=vectFormatI,
                                   array=numpy.array(counts),
                                   unit="Counts")
         if (self.poisserr == False):
-            stat_err = [x[0] * x[1] for x in zip(numpy.array(self.stat_err), dt)]
+            stat_err = self.stat_err * dt
             stat_errCol = pyfits.Column(name='STAT_ERR', format=vectFormatD,
                                         array=numpy.array(stat_err))
-            sys_err = [x[0] * x[1] for x in zip(numpy.array(self.sys_err), dt)]
+            sys_err = self.sys_err * dt
             sys_errCol = pyfits.Column(name='SYS_ERR', format=vectFormatD,
                                        array=numpy.array(sys_err))
         pass
@@ -3715,7 +4651,7 @@ class Spectra(object):
 
         # If there is even just one bad channel in a given spectrum, set its quality as bad
         qualityCol = pyfits.Column(name='QUALITY', format="I",
-                                   array=numpy.array([max(x) for x in self.quality]))
+                                   array=numpy.max(self.quality, axis=1))
 
         timeCol = pyfits.Column(name='TIME', format='D',
                                 array=numpy.array(self.tstart), unit="s", bzero=trigTime)
@@ -3744,19 +4680,19 @@ class Spectra(object):
         newTable.header.set('BACKSCAL', 1.0)
         newTable.header.set('HDUCLASS', 'OGIP')
         newTable.header.set('HDUCLAS1', 'SPECTRUM')
-        newTable.header.set('HDUCLAS2', self.spectra[0].spectrumType)
+        newTable.header.set('HDUCLAS2', self._metadata['spectrumType'])
         newTable.header.set('HDUCLAS3', 'COUNT')
         newTable.header.set('HDUCLAS4', 'TYPE:II')
         newTable.header.set('HDUVERS', '1.0.0')
-        newTable.header.set('TELESCOP', self.spectra[0].telescope)
-        newTable.header.set('INSTRUME', self.spectra[0].instrument)
+        newTable.header.set('TELESCOP', self._metadata['telescope'])
+        newTable.header.set('INSTRUME', self._metadata['instrument'])
 
-        if (self.spectra[0].filter != 'unknown'):
-            newTable.header.set('FILTER', self.spectra[0].filter)
+        if (self._metadata['filter'] != 'unknown'):
+            newTable.header.set('FILTER', self._metadata['filter'])
 
-        newTable.header.set('CHANTYPE', self.spectra[0].chanType)
+        newTable.header.set('CHANTYPE', self._metadata['chanType'])
         newTable.header.set('POISSERR', self.poisserr)
-        newTable.header.set('DETCHANS', len(self.channel[0]))
+        newTable.header.set('DETCHANS', self._nChannels)
         newTable.header.set('TRIGTIME', trigTime)
         newTable.header.set('CREATOR', "dataHandling.py v.%s" % (moduleVersion),
                             "(G.Vianello, giacomov@slac.stanford.edu)")
@@ -4,6 +4,7 @@ import time
 import re, os
 import sys
 from GtBurst.dataCollector import *
+from GtBurst.DataCache import DataCache
 from GtBurst import dataHandling
 from GtBurst.commands.gtllebin import gtllebin
 from GtBurst.GtBurstException import *
@@ -140,6 +141,26 @@ class DownloadTransientData(dataCollector):
     for k,v in iter(list(parameters.items())):
       print(("%30s = %s" %(k,v)))
     
+    #If the same query has been done before, take the files from the local data cache
+    cache                       = DataCache()
+    
+    if(cache.isEnabled()):
+      self.makeLocalDir()
+      newFilenames              = {}
+      for suffix in ['ft1','ft2']:
+        newfilename             = os.path.join(self.localRepository,"gll_%s_tr_bn%s_v00.fit" %(suffix,self.grbName))
+        if(cache.get(self.instrument,self.trigName,os.path.basename(newfilename),newfilename,selection=parameters)):
+          newFilenames[suffix]  = newfilename
+        pass
+      pass
+      
+      if(len(newFilenames)==2):
+        print("\nTaking the files for this query from the local data cache\n")
+        self._makeDatasets(newFilenames,makecspec)
+        return
+      pass
+    pass
+    
     #POST encoding    
     postData                    = urllib.parse.urlencode(parameters)
     url                         = "https://fermi.gsfc.nasa.gov/cgi-bin/ssc/LAT/LATDataQuery.cgi?%s" % postData
@@ -293,7 +314,9 @@ class DownloadTransientData(dataCollector):
     if(links is not None):
       filenames                 = [x.split('/')[-1] for x in links]    
       try:
-        self.downloadDirectoryWithFTP(remotePath,filenames=filenames)
+        #The names of the files of a query are not reused: they are put in the
+        #data cache after renaming, keyed on the query parameters
+        self.downloadDirectoryWithFTP(remotePath,filenames=filenames,useCache=False)
       except Exception as e:
           #Try with "wget", if the system has it
         for ff in filenames:
@@ -332,8 +355,14 @@ class DownloadTransientData(dataCollector):
       
       os.rename(localPath,newfilename)
       newFilenames[suffix]    = newfilename
+      
+      cache.put(self.instrument,self.trigName,os.path.basename(newfilename),newfilename,selection=parameters)
       pass
-    ###########################
+    
+    self._makeDatasets(newFilenames,makecspec)
+  pass
+  
+  def _makeDatasets(self,newFilenames,makecspec):
     if(makecspec and 'ft1' in list(newFilenames.keys()) and 'ft2' in list(newFilenames.keys())):
       dataHandling._makeDatasetsOutOfLATdata(newFilenames['ft1'],newFilenames['ft2'],
                                              self.grbName,self.tstart,self.tstop,
@@ -342,7 +371,7 @@ class DownloadTransientData(dataCollector):
                                              cspecstart=-1000,
                                              cspecstop=1000,
                                              makecspec=True)
-    
+    pass
   pass
   
 pass
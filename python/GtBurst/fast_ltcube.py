@@ -0,0 +1,377 @@
+import multiprocessing
+
+import numpy as np
+
+from GtBurst.my_fits_io import pyfits
+
+# Data shared with the worker processes (they are forked, so they get a copy without pickling)
+_shared_data = {}
+
+# Number of rows of the FT2 file processed at once by each worker
+_chunk_size = 32
+
+
+def get_nside(binsz):
+    """
+    Returns the HEALPix nside used by gtltcube for the given pixel size: the smallest power of 2 giving pixels
+    not larger than binsz
+
+    :param binsz: pixel size (deg)
+    :return: nside
+    """
+
+    n_pixels = 4 * np.pi / np.radians(float(binsz)) ** 2
+
+    nside = 1
+
+    while 12 * nside ** 2 < n_pixels:
+
+        nside *= 2
+
+    return nside
+
+
+def get_pixel_directions(nside):
+    """
+    Returns the unit vectors (in equatorial coordinates) of the centers of the HEALPix pixels in NESTED ordering
+
+    :param nside: HEALPix nside
+    :return: (unit vectors (npix x 3), ra (deg), dec (deg))
+    """
+
+    npface = nside * nside
+    pixels = np.arange(12 * npface, dtype=np.int64)
+
+    face = pixels // npface
+    ipf = pixels % npface
+
+    # De-interleave the bits of the index within the face: even bits are x, odd bits are y
+    ix = np.zeros_like(ipf)
+    iy = np.zeros_like(ipf)
+
+    for bit in range(int(np.log2(nside)) + 1):
+
+        ix |= ((ipf >> (2 * bit)) & 1) << bit
+        iy |= ((ipf >> (2 * bit + 1)) & 1) << bit
+
+    jrll = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+    jpll = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+    # Ring index (from the north pole) and number of pixels in the ring
+    jr = jrll[face] * nside - ix - iy - 1
+
+    nr = np.where(jr < nside, jr, np.where(jr > 3 * nside, 4 * nside - jr, nside))
+
+    z = np.where(jr < nside, 1.0 - nr ** 2 / (3.0 * npface),
+                 np.where(jr > 3 * nside, nr ** 2 / (3.0 * npface) - 1.0,
+                          (2 * nside - jr) * 2.0 / (3.0 * nside)))
+
+    kshift = np.where((jr >= nside) & (jr <= 3 * nside), (jr - nside) & 1, 0)
+
+    jp = (jpll[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, jp)
+    jp = np.where(jp < 1, jp + 4 * nside, jp)
+
+    phi = (jp - (kshift + 1) * 0.5) * (np.pi / 2.0 / nr)
+
+    sin_theta = np.sqrt(1.0 - z ** 2)
+
+    directions = np.column_stack([sin_theta * np.cos(phi), sin_theta * np.sin(phi), z])
+
+    return directions, np.degrees(phi), np.degrees(np.arcsin(z))
+
+
+def _unit_vectors(ra, dec):
+
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def _get_phi_index(phi, n_phibins):
+    """
+    Returns the index of the phi bin as gtltcube does: phi (deg) is folded in 0-45 deg using the symmetry of the
+    instrument, and the bins are uniform in the folded phi. Index 0 is the phi-integrated bin, so the indexes of the
+    phi bins go from 1 to n_phibins
+
+    :param phi: azimuth in the spacecraft frame (deg)
+    :param n_phibins: number of phi bins
+    :return: index of the phi bin
+    """
+
+    phi = np.mod(phi, 90.0)
+    phi = np.where(phi > 45.0, 90.0 - phi, phi)
+
+    return 1 + np.minimum((phi / 45.0 * n_phibins).astype(np.int64), n_phibins - 1)
+
+
+def _accumulate_chunk(chunk):
+    """
+    Accumulates livetime vs. cos(theta) (and phi) for all pixels, for the FT2 rows in the chunk
+
+    :param chunk: (first row, last row + 1)
+    :return: (exposure, weighted exposure), both arrays of shape (npix * ncosbins * (nphibins + 1))
+    """
+
+    first, last = chunk
+
+    d = _shared_data
+
+    n_pix = d['pixels'].shape[0]
+    n_bins = d['n_bins']
+    n_phibins = d['n_phibins']
+    n_values = n_pix * n_bins * (n_phibins + 1)
+
+    cos_theta = np.dot(d['scz'][first:last], d['pixels'].T)
+
+    # Pixels out of the field of view (or above the Zenith cut) get a zero weight
+    good = cos_theta > 0
+
+    if d['zenith'] is not None:
+
+        good &= np.dot(d['zenith'][first:last], d['pixels'].T) >= d['cos_zmax']
+
+    # Bins are uniform in sqrt(1 - cos(theta)), bin 0 is on-axis
+    bins = np.minimum((np.sqrt(1.0 - np.clip(cos_theta, 0.0, 1.0)) * n_bins).astype(np.int64), n_bins - 1)
+
+    flat_index = (bins + d['pixel_offsets']).ravel()
+
+    if n_phibins > 0:
+
+        # Azimuth of each pixel in the spacecraft frame, measured from the x axis. As in gtltcube, the livetime
+        # is accumulated both in the phi-integrated bins and in the bins of the right phi, which for the
+        # phi bin k start at k * ncosbins
+        scy = np.cross(d['scz'][first:last], d['scx'][first:last])
+
+        phi = np.degrees(np.arctan2(np.dot(scy, d['pixels'].T), np.dot(d['scx'][first:last], d['pixels'].T)))
+
+        flat_index = np.concatenate([flat_index, flat_index + (_get_phi_index(phi, n_phibins) * n_bins).ravel()])
+
+    livetime = (good * d['livetime'][first:last, np.newaxis]).ravel()
+    livetime_fraction = np.repeat(d['livetime_fraction'][first:last], n_pix)
+
+    if n_phibins > 0:
+
+        livetime = np.tile(livetime, 2)
+        livetime_fraction = np.tile(livetime_fraction, 2)
+
+    exposure = np.bincount(flat_index, weights=livetime, minlength=n_values)
+
+    livetime *= livetime_fraction
+
+    weighted_exposure = np.bincount(flat_index, weights=livetime, minlength=n_values)
+
+    return exposure, weighted_exposure
+
+
+def _get_covered_fraction(start, stop, gti_start, gti_stop):
+    """
+    Returns the fraction of each (sorted, not overlapping) interval start-stop covered by the GTIs
+    """
+
+    fraction = np.zeros(start.shape[0])
+
+    for t1, t2 in zip(gti_start, gti_stop):
+
+        # Only the intervals overlapping with this GTI
+        i1 = np.searchsorted(stop, t1, side='right')
+        i2 = np.searchsorted(start, t2, side='left')
+
+        overlap = np.minimum(stop[i1:i2], t2) - np.maximum(start[i1:i2], t1)
+
+        fraction[i1:i2] += np.maximum(overlap, 0) / (stop[i1:i2] - start[i1:i2])
+
+    return fraction
+
+
+def make_livetime_cube(ft2file, evfile, outfile, zmax=180.0, dcostheta=0.025, binsz=1.0, phibins=0, ncpus=1):
+    """
+    Computes a livetime cube equivalent to the one of gtltcube, using the GTIs of the event file and the pointing
+    history in the FT2 file.
+
+    :param ft2file: spacecraft file (FT2)
+    :param evfile: event file (FT1), only the GTI extension is used
+    :param outfile: name for the output livetime cube
+    :param zmax: maximum Zenith angle (deg). The livetime of a pixel is not accumulated when the pixel is above it
+    :param dcostheta: step in cos(theta)
+    :param binsz: pixel size (deg)
+    :param phibins: number of bins in phi (0 to accumulate the livetime against cos(theta) only)
+    :param ncpus: maximum number of processes to use
+    :return: outfile
+    """
+
+    with pyfits.open(evfile) as f:
+
+        gti_start = np.array(f['GTI'].data.field("START"), dtype=float)
+        gti_stop = np.array(f['GTI'].data.field("STOP"), dtype=float)
+
+    order = np.argsort(gti_start)
+    gti_start = gti_start[order]
+    gti_stop = gti_stop[order]
+
+    # Read only the rows of the FT2 file we need (the file is memory-mapped)
+    with pyfits.open(ft2file, memmap=True) as f:
+
+        sc_data = f['SC_DATA'].data
+        start = sc_data.field("START")
+        stop = sc_data.field("STOP")
+
+        if gti_start.shape[0] > 0:
+
+            first = np.searchsorted(stop, gti_start.min(), side='right')
+            last = np.searchsorted(start, gti_stop.max(), side='left')
+
+        else:
+
+            first, last = 0, 0
+
+        start = np.array(start[first:last], dtype=float)
+        stop = np.array(stop[first:last], dtype=float)
+        livetime = np.array(sc_data.field("LIVETIME")[first:last], dtype=float)
+        scz = _unit_vectors(sc_data.field("RA_SCZ")[first:last], sc_data.field("DEC_SCZ")[first:last])
+
+        if int(phibins) > 0:
+
+            scx = _unit_vectors(sc_data.field("RA_SCX")[first:last], sc_data.field("DEC_SCX")[first:last])
+
+        else:
+
+            scx = None
+
+        if float(zmax) < 180:
+
+            zenith = _unit_vectors(sc_data.field("RA_ZENITH")[first:last], sc_data.field("DEC_ZENITH")[first:last])
+
+        else:
+
+            zenith = None
+
+    # Livetime in each row of the FT2 file within the GTIs, and livetime fraction (used by the
+    # efficiency correction through the weighted exposure)
+    duration = stop - start
+    livetime_fraction = np.where(duration > 0, livetime / np.where(duration > 0, duration, 1.0), 0.0)
+    livetime = livetime * _get_covered_fraction(start, stop, gti_start, gti_stop)
+
+    keep = livetime > 0
+
+    nside = get_nside(binsz)
+    pixels, pixels_ra, pixels_dec = get_pixel_directions(nside)
+    n_bins = int(round(1.0 / float(dcostheta)))
+    n_phibins = int(phibins)
+    n_values = n_bins * (n_phibins + 1)
+
+    _shared_data.clear()
+    _shared_data.update({'pixels': pixels, 'n_bins': n_bins, 'n_phibins': n_phibins,
+                         'pixel_offsets': np.arange(pixels.shape[0]) * n_values,
+                         'scz': scz[keep], 'scx': None if scx is None else scx[keep],
+                         'livetime': livetime[keep], 'livetime_fraction': livetime_fraction[keep],
+                         'zenith': None if zenith is None else zenith[keep],
+                         'cos_zmax': np.cos(np.radians(float(zmax)))})
+
+    n_rows = int(keep.sum())
+    chunks = [(i, min(i + _chunk_size, n_rows)) for i in range(0, n_rows, _chunk_size)]
+
+    ncpus = max(1, min(int(ncpus), len(chunks)))
+
+    pool = None
+
+    if ncpus > 1:
+
+        try:
+
+            pool = multiprocessing.get_context('fork').Pool(ncpus)
+
+        except ValueError:
+
+            # Fork is not available on this platform
+            pool = None
+
+    try:
+
+        if pool is not None:
+
+            results = pool.map(_accumulate_chunk, chunks)
+
+        else:
+
+            results = list(map(_accumulate_chunk, chunks))
+
+    finally:
+
+        if pool is not None:
+
+            pool.close()
+            pool.join()
+
+        _shared_data.clear()
+
+    exposure = np.zeros(pixels.shape[0] * n_values)
+    weighted_exposure = np.zeros(pixels.shape[0] * n_values)
+
+    for this_exposure, this_weighted_exposure in results:
+
+        exposure += this_exposure
+        weighted_exposure += this_weighted_exposure
+
+    _write_livetime_cube(outfile, exposure.reshape(-1, n_values), weighted_exposure.reshape(-1, n_values),
+                         n_bins, n_phibins, pixels_ra, pixels_dec, nside, gti_start, gti_stop)
+
+    return outfile
+
+
+def _write_livetime_cube(outfile, exposure, weighted_exposure, n_bins, n_phibins, ra, dec, nside, gti_start,
+                         gti_stop):
+
+    # With phi bins, COSBINS contains the phi-integrated bins followed by the bins of each phi bin
+    n_values = exposure.shape[1]
+
+    tstart = float(gti_start.min()) if gti_start.shape[0] > 0 else 0.0
+    tstop = float(gti_stop.max()) if gti_stop.shape[0] > 0 else 0.0
+
+    def healpix_table(values, extname):
+
+        columns = [pyfits.Column(name='COSBINS', format='%sE' % n_values, unit='s', array=values),
+                   pyfits.Column(name='RA', format='E', unit='deg', array=ra),
+                   pyfits.Column(name='DEC', format='E', unit='deg', array=dec)]
+
+        table = pyfits.BinTableHDU.from_columns(columns)
+        table.name = extname
+
+        header = table.header
+        header.set('PIXTYPE', 'HEALPIX')
+        header.set('ORDERING', 'NESTED')
+        header.set('COORDSYS', 'EQU')
+        header.set('NSIDE', nside)
+        header.set('FIRSTPIX', 0)
+        header.set('LASTPIX', 12 * nside * nside - 1)
+        header.set('THETABIN', 'SQRT(1-COSTHETA)')
+        header.set('NBRBINS', n_bins)
+        header.set('COSMIN', 0.0)
+        header.set('PHIBINS', n_phibins)
+        header.set('TSTART', tstart)
+        header.set('TSTOP', tstop)
+
+        return table
+
+    # Bin boundaries in cos(theta)
+    edges = 1.0 - (np.arange(n_bins + 1) / float(n_bins)) ** 2
+
+    ctheta_bounds = pyfits.BinTableHDU.from_columns([pyfits.Column(name='CTHETA_MIN', format='E', array=edges[1:]),
+                                                     pyfits.Column(name='CTHETA_MAX', format='E', array=edges[:-1])])
+    ctheta_bounds.name = 'CTHETABOUNDS'
+
+    gti = pyfits.BinTableHDU.from_columns([pyfits.Column(name='START', format='D', unit='s', array=gti_start),
+                                           pyfits.Column(name='STOP', format='D', unit='s', array=gti_stop)])
+    gti.name = 'GTI'
+
+    primary = pyfits.PrimaryHDU()
+    primary.header.set('TSTART', tstart)
+    primary.header.set('TSTOP', tstop)
+    primary.header.set('CREATOR', 'GtBurst fast_ltcube')
+
+    pyfits.HDUList([primary,
+                    healpix_table(exposure, 'EXPOSURE'),
+                    healpix_table(weighted_exposure, 'WEIGHTED_EXPOSURE'),
+                    ctheta_bounds,
+                    gti]).writeto(outfile, overwrite=True)
@@ -1,13 +1,70 @@
 from UnbinnedAnalysis import *
 import astropy.wcs as pywcs
 import pyLikelihood
+import multiprocessing
+import time
 
 from astropy.coordinates import angular_separation
 import numpy as np
 
+from GtBurst.my_fits_io import pyfits
+
+# Data shared with the worker processes computing the TS map. They are forked after the null hypothesis
+# has been fit, so each of them gets its own copy of the primed likelihood object without pickling
+_shared_data = {}
+
+
+def _compute_pixels(chunk):
+
+    return _shared_data['ts_map']._compute_pixels(chunk, _shared_data['warm_start'])
+
+
+def _get_hilbert_index(x, y, n_bits):
+    """
+    Returns the position along a Hilbert curve of the points with integer coordinates x and y, on a grid of
+    2^n_bits x 2^n_bits points
+
+    :param x: array of x coordinates
+    :param y: array of y coordinates
+    :param n_bits: number of bits of the coordinates
+    :return: array of indexes
+    """
+
+    n = 2 ** n_bits
+
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros_like(x)
+
+    s = n // 2
+
+    while s > 0:
+
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant so that the curve is continuous
+        flip = ~ry & rx
+
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+
+        s //= 2
+
+    return d
+
 
 class FastTSMap(object):
 
+    # Possible orders for visiting the pixels of the map: 'grid' is column by column, with each fit starting from
+    # the best fit of the null hypothesis. 'spiral' (out from the seed) and 'hilbert' (along a Hilbert curve) are
+    # spatially coherent, and each fit starts from the solution of the nearest pixel already computed
+    traversals = ['grid', 'spiral', 'hilbert']
+
     def __init__(self, pylike_object, target="GRB"):
         """
 
@@ -44,85 +101,379 @@ class FastTSMap(object):
         # This is a C++ call-by-reference, so self._nullhyp_best_fit_param will be changed
         logLike.getFreeParamValues(self._nullhyp_best_fit_param)
 
-    def search_for_maximum(self, ra_center, dec_center, half_side_deg, n_side, proj_name='AIT', verbose=False):
+        # Best fit values of the free parameters (with the test source) for each pixel of the last map
+        self.pixel_free_params = {}
+
+        # Statistics about the last map (number of pixels, average time spent in the minimizer)
+        self.last_map_statistics = {}
+
+    @staticmethod
+    def get_wcs(ra_center, dec_center, half_side_deg, n_side, proj_name='AIT'):
         """
+        Returns the WCS of the grid used for the TS map
 
         :param ra_center: R.A. of the center of the map
         :param dec_center: Dec of the center of the map
-        :param half_size_deg: half size of the side of the TS map ("radius", even though it is a square)
-        :param n_side: number of points on one side. So n_side = 5 means that a 5x5 map will be computed
-        :param stepsize: size of the step, i.e., distance between two adiancent points in the RA or Dec direction
-        :param proj_name: name for the projection (default: AIT). All projections supported by astropy.wcs can be used
-        :return: (max_ts_position, max_ts): returns a tuple of (RA, Dec) and the maximum TS found
+        :param half_side_deg: half size of the side of the TS map
+        :param n_side: number of points on one side
+        :param proj_name: name for the projection
+        :return: an astropy.wcs.WCS instance
         """
 
         # Figure out step size
         stepsize = half_side_deg / (n_side / 2.0)
 
-        # Create WCS object which will allow us to make the grid
-
         wcs = pywcs.WCS(naxis=2)
         wcs.wcs.crpix = [n_side / 2. + 0.5, n_side / 2. + 0.5]
         wcs.wcs.cdelt = [-stepsize, stepsize]
         wcs.wcs.crval = [float(ra_center), float(dec_center)]
         wcs.wcs.ctype = ["RA---%s" % proj_name, "DEC--%s" % proj_name]
 
-        # Compute all TSs
+        return wcs
+
+    def compute_map(self, ra_center, dec_center, half_side_deg, n_side, proj_name='AIT', ncpus=1, outfile=None,
+                    verbose=False, traversal='grid', seed=None):
+        """
+        Computes the TS on all the points of the grid, using up to ncpus processes. If outfile is provided, the
+        TS map is written there as a FITS image, which is updated as the results come in (pixels not computed yet
+        are NaN).
+
+        :param ra_center: R.A. of the center of the map
+        :param dec_center: Dec of the center of the map
+        :param half_side_deg: half size of the side of the TS map ("radius", even though it is a square)
+        :param n_side: number of points on one side
+        :param proj_name: name for the projection (default: AIT)
+        :param ncpus: maximum number of processes to use
+        :param outfile: name for the output FITS file (optional)
+        :param verbose: print the TS for each pixel
+        :param traversal: order in which the pixels are visited (one of FastTSMap.traversals)
+        :param seed: (ra, dec) where the 'spiral' traversal starts (default: center of the map)
+        :return: (ts, ra, dec, wcs): TS, R.A. and Dec. of all pixels as (n_side x n_side) arrays (indexed as
+                 [y, x], like FITS images), and the WCS of the map
+        """
+
+        n_side = int(n_side)
+
+        wcs = self.get_wcs(ra_center, dec_center, half_side_deg, n_side, proj_name)
+
+        # Coordinates of all pixels with one call
+        y, x = np.mgrid[0:n_side, 0:n_side]
+        ra, dec = wcs.wcs_pix2world(x, y, 0)
+
+        ts = np.zeros((n_side, n_side)) * np.nan
+
+        if seed is None:
+
+            seed = (ra_center, dec_center)
+
+        seed_x, seed_y = wcs.wcs_world2pix(float(seed[0]), float(seed[1]), 0)
+
+        order = self._get_traversal_order(n_side, traversal, seed_x, seed_y)
+
+        ncpus = max(1, min(int(ncpus), order.shape[0]))
+
+        # A few chunks per process, so that the load is balanced
+        n_chunks = min(order.shape[0], 4 * ncpus) if ncpus > 1 else 1
+
+        # Each chunk is a segment of the traversal, so that the pixels within it are close to each other
+        chunks = [[(int(k), int(x.flat[k]), int(y.flat[k]), float(ra.flat[k]), float(dec.flat[k])) for k in these]
+                  for these in np.array_split(order, n_chunks)]
+
+        fits_file = None
+
+        if outfile is not None:
+
+            primary = pyfits.PrimaryHDU(data=ts, header=wcs.to_header())
+            primary.writeto(outfile, overwrite=True)
+
+            fits_file = pyfits.open(outfile, mode='update')
+
+        # This must be set before forking the workers
+        _shared_data['ts_map'] = self
+        _shared_data['warm_start'] = (traversal != 'grid')
+
+        self.pixel_free_params = {}
+
+        minimizer_time = 0.0
+
+        pool = None
+
+        if ncpus > 1:
+
+            try:
+
+                pool = multiprocessing.get_context('fork').Pool(ncpus)
+
+            except ValueError:
+
+                # Fork is not available on this platform
+                pool = None
+
+        try:
+
+            if pool is not None:
+
+                results = pool.imap_unordered(_compute_pixels, chunks)
+
+            else:
+
+                results = map(_compute_pixels, chunks)
+
+            for chunk_results in results:
+
+                for k, this_TS, free_params, elapsed in chunk_results:
+
+                    ts.flat[k] = this_TS
+                    self.pixel_free_params[k] = free_params
+                    minimizer_time += elapsed
+
+                    if verbose:
+
+                        ang_sep = np.rad2deg(angular_separation(*np.deg2rad([ra_center, dec_center,
+                                                                             ra.flat[k], dec.flat[k]])))
+
+                        print(("(%.3f, %.3f) -> %.2f (%.3f deg away from center)" % (ra.flat[k], dec.flat[k],
+                                                                                    this_TS, ang_sep)))
+
+                if fits_file is not None:
+
+                    fits_file[0].data[:] = ts
+                    fits_file.flush()
+
+        finally:
+
+            if pool is not None:
+
+                pool.close()
+                pool.join()
+
+            _shared_data.clear()
+
+            if fits_file is not None:
+
+                fits_file.close()
+
+        self.last_map_statistics = {'traversal': traversal, 'n_pixels': ts.size,
+                                    'average_minimizer_time': minimizer_time / ts.size}
+
+        if verbose or traversal != 'grid':
+
+            print(("Average time in the minimizer: %.1f ms per pixel (%i pixels, traversal: %s)" %
+                   (1000.0 * minimizer_time / ts.size, ts.size, traversal)))
+
+        return ts, ra, dec, wcs
+
+    @staticmethod
+    def _get_traversal_order(n_side, traversal, seed_x, seed_y):
+        """
+        Returns the indexes of the pixels (in a flattened [y, x] image) in the order in which they must be visited
+
+        :param n_side: number of points on one side
+        :param traversal: one of FastTSMap.traversals
+        :param seed_x: x coordinate of the pixel where the 'spiral' traversal starts
+        :param seed_y: y coordinate of the pixel where the 'spiral' traversal starts
+        :return: array of indexes
+        """
+
+        y, x = np.mgrid[0:n_side, 0:n_side]
+        x = x.ravel()
+        y = y.ravel()
+
+        if traversal == 'grid':
+
+            # Same order as the original serial loop (x outer, y inner)
+            return np.lexsort((y, x))
+
+        elif traversal == 'spiral':
+
+            seed_x = min(max(int(np.round(seed_x)), 0), n_side - 1)
+            seed_y = min(max(int(np.round(seed_y)), 0), n_side - 1)
+
+            # Square rings around the seed, each one walked around by angle
+            ring = np.maximum(np.abs(x - seed_x), np.abs(y - seed_y))
+            angle = np.arctan2(y - seed_y, x - seed_x)
+
+            return np.lexsort((angle, ring))
+
+        elif traversal == 'hilbert':
+
+            n_bits = int(np.ceil(np.log2(max(n_side, 2))))
+
+            return np.argsort(_get_hilbert_index(x, y, n_bits), kind='stable')
+
+        else:
+
+            raise ValueError("Unknown traversal %s. Possible values are: %s" % (traversal,
+                                                                               ",".join(FastTSMap.traversals)))
+
+    def search_for_maximum(self, ra_center, dec_center, half_side_deg, n_side, proj_name='AIT', verbose=False,
+                           ncpus=1, refine=False, n_coarse=5, traversal='grid'):
+        """
+
+        :param ra_center: R.A. of the center of the map
+        :param dec_center: Dec of the center of the map
+        :param half_size_deg: half size of the side of the TS map ("radius", even though it is a square)
+        :param n_side: number of points on one side. So n_side = 5 means that a 5x5 map will be computed
+        :param stepsize: size of the step, i.e., distance between two adiancent points in the RA or Dec direction
+        :param proj_name: name for the projection (default: AIT). All projections supported by astropy.wcs can be used
+        :param ncpus: maximum number of processes to use
+        :param refine: if True, instead of computing the full grid start with a coarse grid of n_coarse x n_coarse
+                       points, then repeatedly compute a finer grid around the maximum, until the step is as small as
+                       the step of the full grid
+        :param n_coarse: number of points on one side of the grids used by the refinement
+        :param traversal: order in which the pixels are visited (one of FastTSMap.traversals)
+        :return: (max_ts_position, max_ts): returns a tuple of (RA, Dec) and the maximum TS found
+        """
+
+        if refine:
+
+            return self._refine_maximum(ra_center, dec_center, half_side_deg, n_side, proj_name, verbose,
+                                        ncpus, n_coarse, traversal)
+
+        ts, ra, dec, _ = self.compute_map(ra_center, dec_center, half_side_deg, n_side, proj_name, ncpus,
+                                          verbose=verbose, traversal=traversal)
+
+        if verbose:
+
+            ang_sep = np.rad2deg(angular_separation(*np.deg2rad([ra_center, dec_center, ra, dec])))
+
+            print(("Total number of points: %i" % ang_sep.size))
+            print(("Minimum ang. dist: %s deg" % ang_sep.min()))
+            print(("Maximum ang. dist: %s deg" % ang_sep.max()))
+
+        return self._get_maximum(ts, ra, dec, (ra_center, dec_center))
+
+    @staticmethod
+    def _get_maximum(ts, ra, dec, default_position):
+
+        # Like the serial loop (x outer, y inner), the last pixel wins in case of ties, and the default position
+        # is kept if no TS is positive
+        ts_sequence = ts.T.ravel()
+
+        if ts_sequence.max() < 0:
+
+            return default_position, 0.0
+
+        idx = ts_sequence.shape[0] - 1 - np.argmax(ts_sequence[::-1])
+
+        y, x = idx % ts.shape[0], idx // ts.shape[0]
+
+        return (ra[y, x], dec[y, x]), float(ts[y, x])
+
+    def _refine_maximum(self, ra_center, dec_center, half_side_deg, n_side, proj_name, verbose, ncpus, n_coarse,
+                        traversal):
+
+        final_stepsize = half_side_deg / (n_side / 2.0)
 
-        # These two will hold maximum and position of the maximum
-        # Init them with worse case scenario
-        max_ts = 0.0
         max_ts_position = (ra_center, dec_center)
-        ang_sep = []
+        max_ts = 0.0
+
+        this_center = (ra_center, dec_center)
+        this_half_side = float(half_side_deg)
+
+        n_points = 0
 
-        for i in range(n_side):
+        while True:
 
-            for j in range(n_side):
+            ts, ra, dec, _ = self.compute_map(this_center[0], this_center[1], this_half_side, n_coarse, proj_name,
+                                              ncpus, verbose=verbose, traversal=traversal)
 
-                this_ra, this_dec = wcs.wcs_pix2world(i, j, 0)
+            n_points += ts.size
 
-                this_TS = self._calc_one_TS(float(this_ra), float(this_dec))
+            this_position, this_ts = self._get_maximum(ts, ra, dec, this_center)
 
-                if this_TS >= max_ts:
+            if this_ts >= max_ts:
 
-                    # New maximum
-                    max_ts = this_TS
-                    max_ts_position = (this_ra, this_dec)
+                max_ts = this_ts
+                max_ts_position = this_position
 
-                if verbose:
+            stepsize = this_half_side / (n_coarse / 2.0)
 
-                    ang_sep.append(np.rad2deg(angular_separation(*np.deg2rad([ra_center, dec_center,
-                                                                              this_ra, this_dec]))))
+            if stepsize <= final_stepsize:
 
-                    print(("(%.3f, %.3f) -> %.2f (%.3f deg away from center)" % (this_ra, this_dec,
-                                                                                this_TS, ang_sep[-1])))
+                break
+
+            # Next grid spans one step of the current one around the maximum
+            this_center = max_ts_position
+            this_half_side = stepsize
 
         if verbose:
-            print(("Total number of points: %i" % len(ang_sep)))
-            print(("Minimum ang. dist: %s deg" % min(ang_sep)))
-            print(("Maximum ang. dist: %s deg" % max(ang_sep)))
 
-        # Find maximum and its position
+            print(("Total number of points: %i (instead of %i)" % (n_points, n_side ** 2)))
+
         return max_ts_position, max_ts
 
+    def _compute_pixels(self, chunk, warm_start):
+        """
+        Computes the TS for a list of pixels, in the given order
+
+        :param chunk: list of (pixel index, x, y, ra, dec)
+        :param warm_start: if True, each fit starts from the solution of the nearest pixel already computed
+        :return: list of (pixel index, TS, best fit free parameters, time spent in the minimizer)
+        """
+
+        results = []
+        solved = np.zeros((len(chunk), 2))
+
+        for n, (k, x, y, ra, dec) in enumerate(chunk):
+
+            start_params = None
+
+            if warm_start and n > 0:
+
+                nearest = np.argmin(((solved[:n] - (x, y)) ** 2).sum(axis=1))
+                start_params = results[nearest][2]
+
+            this_TS, free_params, elapsed = self._fit_one_pixel(ra, dec, start_params)
+
+            solved[n] = (x, y)
+            results.append((k, this_TS, free_params, elapsed))
+
+        return results
+
     def _calc_one_TS(self, ra, dec):
 
+        return self._fit_one_pixel(ra, dec)[0]
+
+    def _fit_one_pixel(self, ra, dec, start_params=None):
+        """
+        Fits the model with the test source at the given position
+
+        :param ra: R.A. of the test source
+        :param dec: Dec. of the test source
+        :param start_params: starting values for the free parameters (including the ones of the test source). If
+                             None, the fit starts from the best fit of the null hypothesis
+        :return: (TS, best fit values of the free parameters, time spent in the minimizer)
+        """
+
         logLike = self._pylike_object.logLike
 
         # The first False says not to recompute the exposure, the second one avoid verbosity
         self._test_source.setDir(ra, dec, False, False)
         logLike.addSource(self._test_source)
 
+        if start_params is not None:
+
+            logLike.setFreeParamValues(pyLikelihood.DoubleVector(start_params))
+
         # This is the fastest way to minimize -logL if we don't care about errors
 
+        start = time.time()
+
         self._pylike_object.optObject.find_min_only(0, 1e-5)
 
+        elapsed = time.time() - start
+
         logLike1 = logLike.value()
         TS = 2.0 * (logLike1 - self._logLike0)
+
+        free_params = pyLikelihood.DoubleVector()
+        logLike.getFreeParamValues(free_params)
+
         logLike.deleteSource("_test_source")
 
         # Restore the parameters of the model without the source to their best fit
         # values
         logLike.setFreeParamValues(self._nullhyp_best_fit_param)
 
-        return TS
+        return TS, list(free_params), elapsed
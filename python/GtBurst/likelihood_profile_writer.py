@@ -1,30 +1,26 @@
 import numpy as np
 
-try:
-
-    import emcee
+import multiprocessing
+import os
+import xml.etree.ElementTree as ET
+import matplotlib.pyplot as plt
 
-except ImportError:
+from GtBurst.Configuration import Configuration
 
-    has_emcee = False
+# Data shared with the worker processes evaluating the profile. They are forked after the likelihood object has been
+# set up, so each of them owns a copy of it
+_shared_data = {}
 
-else:
 
-    has_emcee = True
+def _evaluate_profile_point(log_norm):
 
-import os
-import xml.etree.ElementTree as ET
-import matplotlib.pyplot as plt
+    return _shared_data['lnprob'](log_norm)
 
 
 class LikelihoodProfiler(object):
 
     def __init__(self, likelihood_object, best_fit_xml):
 
-        if not has_emcee:
-
-            raise ImportError("In order to use the likelihood profiler you need to have emcee installed")
-
         self._like = likelihood_object
         self._best_fit_xml = os.path.expandvars(os.path.expanduser(best_fit_xml))
 
@@ -55,7 +51,20 @@ class LikelihoodProfiler(object):
 
         return conv
 
-    def get_likelihood_profile(self, source_name='GRB', energy_flux=False, forced_photon_index=None):
+    def get_likelihood_profile(self, source_name='GRB', energy_flux=False, forced_photon_index=None, accuracy=0.01,
+                               max_evaluations=300, ncpus=None):
+        """
+        Computes the profile of the likelihood as a function of the normalization of the source
+
+        :param source_name: name of the source
+        :param energy_flux: if True, return the profile as a function of the energy flux instead of the photon flux
+        :param forced_photon_index: if not None, the photon index is fixed to this value
+        :param accuracy: target accuracy of the profile (in units of -log(likelihood)) close to the minimum. Farther
+                         away the accuracy is relaxed proportionally to the difference with the minimum
+        :param max_evaluations: maximum number of points of the profile (each one is a fit)
+        :param ncpus: number of processes evaluating the profile (default: maxNumberOfCPUs in the configuration)
+        :return: (-log(likelihood) values, normalization values)
+        """
 
         # Find name of normalization parameter
         tree = ET.parse(self._best_fit_xml)
@@ -106,14 +115,12 @@ class LikelihoodProfiler(object):
 
         #####################################
         # Strategy:
-        # We apply an adaptive sampling strategy for the profiled likelihood so that we will have many points close to
-        # the maximum, where we need very high resolution, and less points farther away.
-        # his will allow the interpolation of the profile to have very high fidelity close to the maximum.
-        # In order to achieve this, I exploit the capability
-        # of Markov Chain Monte Carlo methods, in particular emcee, that will return samples for the normalization in
-        # proportion to the likelihood value: many samples close to the maximum, fewer sample away from it.
-        # Then, since we need to explore the entire range between minimum and maximum, I will also make a regular grid
-        # going from minimum to maximum and append it to the grid returned by emcee
+        # We need many points close to the minimum, where we need very high resolution, and less points farther away,
+        # so that the interpolation of the profile has very high fidelity close to the minimum.
+        # We start from the best fit and a coarse grid from minimum to maximum (so that the minimum is bracketed and
+        # the whole range is covered), then we repeatedly add the middle point of the intervals where the
+        # interpolation error of the profile is larger than the requested accuracy. The points of each iteration
+        # are independent, so they are evaluated in parallel.
         ####################################
 
         # Function that will be used to "sample" the likelihood
@@ -170,40 +177,57 @@ class LikelihoodProfiler(object):
         self._like[source_name].src.spectrum().parameter(norm.attrib['name']).setBounds(min_value,
                                                                             max_value)
 
-        n_walkers = 30
+        if ncpus is None:
 
-        # Start all the walkers close to the best fit value
-        p0 = [[best_fit_norm + np.random.uniform(-best_fit_norm / 50.0, best_fit_norm / 50.0)]
-              for i in range(n_walkers)]
+            ncpus = int(float(Configuration().get('maxNumberOfCPUs')))
 
-        # Sample
-        sampler = emcee.EnsembleSampler(n_walkers, 1, lnprob)
-        _ = sampler.run_mcmc(np.log10(p0), 100)
+        ncpus = max(1, min(int(ncpus), multiprocessing.cpu_count()))
 
-        log_norm_values = sampler.flatchain
-        log_like_values = sampler.flatlnprobability
+        best_fit_log_norm = min(max(np.log10(max(best_fit_norm, min_value)), min_log_value), max_log_value)
 
-        # Remove infinite values
-        idx = np.isfinite(log_like_values)
-        log_like_values = log_like_values[idx]
-        photon_flux = 10**log_norm_values[idx].flatten()
+        # This must be set before forking the workers
+        _shared_data['lnprob'] = lnprob
+
+        pool = None
+
+        if ncpus > 1:
+
+            try:
+
+                pool = multiprocessing.get_context('fork').Pool(ncpus)
 
-        # Now do a sampling from the minimum to the maximum with 1000 steps (to make sure that we cover also far away
-        # from the minimum)
-        grid = np.logspace(np.log10(min_value), np.log10(max_value), 1000)[1:-1]
+            except ValueError:
 
-        grid_log_like_values = list(map(lnprob, np.log10(grid)))
+                # Fork is not available on this platform
+                pool = None
 
-        log_like_values = np.append(log_like_values, grid_log_like_values)
-        photon_flux = np.append(photon_flux, grid)
+        try:
+
+            log_norm_values, log_like_values = self._adaptive_sampling(pool, best_fit_log_norm, min_log_value,
+                                                                       max_log_value, accuracy, max_evaluations)
+
+        finally:
+
+            if pool is not None:
+
+                pool.close()
+                pool.join()
+
+            _shared_data.clear()
+
+        print("Likelihood profile computed with %i fits" % log_norm_values.shape[0])
+
+        # Remove infinite values
+        idx = np.isfinite(log_like_values)
+        log_like_values = log_like_values[idx]
+        photon_flux = 10**log_norm_values[idx]
 
         # Now sort by value
         idx = np.argsort(photon_flux)
         log_like_values = log_like_values[idx]
         photon_flux = photon_flux[idx]
 
-        # Make unique, in the very unlikely scenario where the emcee run and the regular grid provided
-        # some duplicated values
+        # Make unique (the best fit might coincide with a point of the grid)
         photon_flux_u, idx = np.unique(photon_flux, return_index=True)
         log_like_values_u = log_like_values[idx]
 
@@ -235,6 +259,110 @@ class LikelihoodProfiler(object):
 
         return self._mlog_like_values, self._norm_values
 
+    @staticmethod
+    def _adaptive_sampling(pool, best_fit_log_norm, min_log_value, max_log_value, accuracy, max_evaluations,
+                           n_initial=25, min_width=1e-4):
+        """
+        Samples the profile of -log(likelihood) adaptively in the log of the normalization
+
+        :param pool: pool of worker processes, or None to evaluate the points serially
+        :param best_fit_log_norm: log10 of the best fit normalization
+        :param min_log_value: log10 of the minimum normalization
+        :param max_log_value: log10 of the maximum normalization
+        :param accuracy: target accuracy close to the minimum (in units of -log(likelihood))
+        :param max_evaluations: maximum number of evaluations
+        :param n_initial: number of points of the initial grid
+        :param min_width: intervals narrower than this (in log10) are not split further
+        :return: (log10 of the normalizations, log(likelihood) values), sorted by normalization
+        """
+
+        def evaluate(points):
+
+            if pool is not None:
+
+                return np.array(pool.map(_evaluate_profile_point, points, chunksize=1), dtype=float)
+
+            else:
+
+                return np.array(list(map(_evaluate_profile_point, points)), dtype=float)
+
+        # Initial grid, excluding the boundaries, plus the best fit and two points close to it
+        delta = (max_log_value - min_log_value) / (n_initial - 1) / 10.0
+
+        x = np.linspace(min_log_value, max_log_value, n_initial)[1:-1]
+        x = np.append(x, [best_fit_log_norm - delta, best_fit_log_norm, best_fit_log_norm + delta])
+        x = np.unique(x[(x > min_log_value) & (x < max_log_value)])
+
+        y = evaluate(x)
+
+        while x.shape[0] < max_evaluations:
+
+            # We work with -log(likelihood), with the minimum at zero
+            good = np.isfinite(y)
+            xx = x[good]
+            ff = -y[good]
+            ff -= ff.min()
+
+            if xx.shape[0] < 3:
+
+                break
+
+            # Estimate the error on the middle point of each interval as the difference between linear interpolation
+            # and the parabola through the interval and one of the neighbours (on either side)
+            x_mid = (xx[:-1] + xx[1:]) / 2.0
+            linear = (ff[:-1] + ff[1:]) / 2.0
+
+            error = np.zeros(x_mid.shape[0])
+
+            for shift in [-1, 1]:
+
+                # Index of the third point used for the parabola
+                k = np.arange(x_mid.shape[0]) + (shift if shift < 0 else 2)
+                valid = (k >= 0) & (k < xx.shape[0])
+                k = np.clip(k, 0, xx.shape[0] - 1)
+
+                x0, x1, x2 = xx[:-1], xx[1:], xx[k]
+                f0, f1, f2 = ff[:-1], ff[1:], ff[k]
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+
+                    parabola = (f0 * (x_mid - x1) * (x_mid - x2) / ((x0 - x1) * (x0 - x2)) +
+                                f1 * (x_mid - x0) * (x_mid - x2) / ((x1 - x0) * (x1 - x2)) +
+                                f2 * (x_mid - x0) * (x_mid - x1) / ((x2 - x0) * (x2 - x1)))
+
+                error = np.where(valid, np.maximum(error, np.abs(parabola - linear)), error)
+
+            # Far from the minimum a lower accuracy is enough
+            tolerance = accuracy * (1.0 + np.minimum(ff[:-1], ff[1:]))
+
+            to_split = (error > tolerance) & (xx[1:] - xx[:-1] > min_width)
+
+            # Always make sure that the minimum is resolved with both its neighbours
+            i_min = np.argmin(ff)
+
+            for i in [i_min - 1, i_min]:
+
+                if 0 <= i < x_mid.shape[0] and xx[i + 1] - xx[i] > min_width and error[i] > accuracy:
+
+                    to_split[i] = True
+
+            if not np.any(to_split):
+
+                break
+
+            # Worst intervals first, if we cannot afford all of them
+            new_x = x_mid[to_split][np.argsort(-(error - tolerance)[to_split])]
+            new_x = new_x[:max_evaluations - x.shape[0]]
+
+            x = np.append(x, new_x)
+            y = np.append(y, evaluate(new_x))
+
+            idx = np.argsort(x)
+            x = x[idx]
+            y = y[idx]
+
+        return x, y
+
     def save(self, outfile):
 
         assert self._mlog_like_values is not None and self._norm_values is not None, \
@@ -13,7 +13,7 @@ from GtBurst.my_fits_io import pyfits
 parser                        = argparse.ArgumentParser("Apply the Bayesian Blocks algorithm on the input data")
 
 parser.add_argument("--infile", 
-                     help="FT1 or TTE data",
+                     help="FT1, TTE or CSPEC data",
                      type=str,required=True)
 
 parser.add_argument("--probability",
@@ -34,40 +34,68 @@ if __name__=="__main__":
   #Read input file
   with pyfits.open(args.infile) as f:
     
-    data = f['EVENTS'].data
-    
-    tstart = f['EVENTS'].header.get("TSTART")
-    tstop = f['EVENTS'].header.get("TSTOP")
-    
-    time = data.field("TIME")
-    
-    #This is probably useless, but sometimes input files
-    #are not time ordered and the BB algorithm would 
-    #crash
-    
-    time.sort()
-    
     BayesianBlocks.logger.setLevel(logging.DEBUG)
     
-    bb = BayesianBlocks.bayesian_blocks(time, tstart, tstop,
-                                        args.probability)
-    
-    #Make the light curve
-    
-    counts = numpy.zeros(bb.shape[0]-1)
-    
-    _time = time[ time > bb[0]]
-    
-    for i,(t1,t2) in enumerate(zip(bb[:-1],bb[1:])):
+    if "SPECTRUM" in f and "COUNTS" in f["SPECTRUM"].columns.names:
       
-      idx = (_time > t1) & (_time <= t2)
-      counts[i] = numpy.sum(idx)
-      _time = _time[~idx]
-    
-    with open(args.outfile,"w+") as f:
+      #CSPEC (or PHA2 with COUNTS) file: use the binned mode, summing
+      #all the channels. Bins without exposure cannot be used
+      
+      data = f['SPECTRUM'].data
+      
+      data = data[data.field("EXPOSURE") > 0]
       
-      f.write("#Tstart Tstop counts\n")
+      binStart = data.field("TIME")
+      binStop = data.field("ENDTIME")
       
-      for t1,t2,c in zip(bb[:-1],bb[1:],counts):
+      binCounts = data.field("COUNTS")
+      
+      if binCounts.ndim > 1:
         
-        f.write("%s %s %s\n" %(t1,t2,c))
+        binCounts = binCounts.sum(axis=1)
+      
+      bb = BayesianBlocks.bayesian_blocks_binned(binStart, binStop, binCounts,
+                                                 data.field("EXPOSURE"),
+                                                 args.probability)
+      
+      #Make the light curve. Block edges are always bin edges
+      
+      firstBins = numpy.searchsorted(binStart, bb[:-1])
+      
+      counts = numpy.add.reduceat(binCounts, firstBins)
+      exposure = numpy.add.reduceat(data.field("EXPOSURE"), firstBins)
+    
+    else:
+      
+      data = f['EVENTS'].data
+      
+      tstart = f['EVENTS'].header.get("TSTART")
+      tstop = f['EVENTS'].header.get("TSTOP")
+      
+      time = data.field("TIME")
+      
+      #This is probably useless, but sometimes input files
+      #are not time ordered and the BB algorithm would 
+      #crash
+      
+      time.sort()
+      
+      bb = BayesianBlocks.bayesian_blocks(time, tstart, tstop,
+                                          args.probability)
+      
+      #Make the light curve. The events are sorted, so the number of events
+      #in (t1,t2] is the difference between the positions of the edges
+      
+      counts = numpy.diff(numpy.searchsorted(time, bb, side='right'))
+      
+      #No livetime information for events, use the duration
+      exposure = numpy.diff(bb)
+    
+    duration = numpy.diff(bb)
+    
+    results = numpy.column_stack([bb[:-1], bb[1:], counts, duration,
+                                  exposure, counts / exposure])
+    
+    numpy.savetxt(args.outfile, results, fmt="%s",
+                  header="Tstart Tstop counts duration exposure rate",
+                  comments="#")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import argparse
+
+import time
+import numpy
+
+from GtBurst import BayesianBlocks
+
+
+parser                        = argparse.ArgumentParser("Compare the legacy, the NumPy and the pruned Bayesian Blocks engines")
+
+parser.add_argument("--sizes",
+                     help="Number of events in each test case (in 0-1000 s). Each size is run with a "
+                          "uniform rate and with a piecewise-constant rate",
+                     type=int,nargs='+',required=False,default=[30000,1000000])
+
+parser.add_argument("--probability",
+                     help="Null-hypothesis probability for the BB algorithm",
+                     type=float,required=False,default=1e-3)
+
+parser.add_argument("--legacy_max_events",
+                     help="Skip the legacy and the NumPy engines (which are O(N^2)) for larger test cases. "
+                          "By default they always run, which for 1e6 events takes a few hours",
+                     type=int,required=False,default=None)
+
+parser.add_argument("--seed",
+                     help="Seed for the random generator",
+                     type=int,required=False,default=0)
+
+def timeEngine(tt, p0, engine):
+
+  start                       = time.time()
+
+  edges                       = BayesianBlocks._bayesian_blocks(tt, 0, 1000, p0, engine=engine)
+
+  return edges, time.time() - start
+
+#Relative rate of the piecewise-constant test case in each interval (start, stop, rate):
+#a constant background, a bright pulse, and a softer step which decays back to the background
+piecewiseRates                = [(0,300,1.0),(300,320,20.0),(320,330,5.0),(330,600,2.0),(600,1000,1.0)]
+
+def generateEvents(n, case):
+
+  if case=='uniform':
+
+    tt                        = numpy.random.uniform(0,1000,n)
+
+  else:
+
+    starts,stops,rates        = map(numpy.array,zip(*piecewiseRates))
+
+    weights                   = rates * (stops - starts)
+    nPerInterval              = numpy.random.multinomial(n, weights / weights.sum())
+
+    tt                        = numpy.concatenate([numpy.random.uniform(t1,t2,k) for t1,t2,k in zip(starts,stops,nPerInterval)])
+
+  tt.sort()
+
+  return tt
+
+#Main code
+if __name__=="__main__":
+  args                        = parser.parse_args()
+
+  numpy.random.seed(args.seed)
+
+  #Make sure the compilation of the pruned engine (if numba is available)
+  #is not included in the timing
+  BayesianBlocks.bayesian_blocks(numpy.sort(numpy.random.uniform(0,1000,100)), 0, 1000, args.probability)
+
+  print("%10s %10s %8s %12s %12s %12s %10s %10s" %("Case","Events","Blocks","Legacy (s)","NumPy (s)","Pruned (s)",
+                                                    "Speed-up","Identical"))
+
+  allIdentical                = True
+
+  for n in args.sizes:
+
+    for case in ['uniform','piecewise']:
+
+      tt                      = generateEvents(n, case)
+
+      pruned, prunedTime      = timeEngine(tt, args.probability, 'pruned')
+
+      if args.legacy_max_events is None or n <= args.legacy_max_events:
+
+        legacy, legacyTime    = timeEngine(tt, args.probability, 'legacy')
+        vectorized, vectorizedTime = timeEngine(tt, args.probability, 'numpy')
+
+        identical             = numpy.array_equal(legacy, pruned) and numpy.array_equal(legacy, vectorized)
+        allIdentical          = allIdentical and identical
+
+        print("%10s %10i %8i %12.3f %12.3f %12.3f %10.1f %10s" %(case, n, pruned.shape[0]-1, legacyTime, vectorizedTime,
+                                                                  prunedTime, legacyTime / prunedTime, identical))
+
+      else:
+
+        print("%10s %10i %8i %12s %12s %12.3f %10s %10s" %(case, n, pruned.shape[0]-1, "skipped", "skipped",
+                                                            prunedTime, "-", "-"))
+
+  if not allIdentical:
+
+    raise RuntimeError("The engines found different blocks!")
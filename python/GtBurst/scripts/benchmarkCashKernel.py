@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+import argparse
+
+import time
+import numpy
+import scipy.optimize
+
+from GtBurst.statMethods import LogLikelihood, BatchedLogLikelihood, Polynomial
+
+
+parser                        = argparse.ArgumentParser("Compare the speed of the legacy and of the fast Cash statistic")
+
+parser.add_argument("--bins",
+                     help="Number of bins in the light curve",
+                     type=int,required=False,default=1000)
+
+parser.add_argument("--degree",
+                     help="Degree of the polynomial",
+                     type=int,required=False,default=3)
+
+parser.add_argument("--rate",
+                     help="Average rate (counts/s) of the light curve",
+                     type=float,required=False,default=20.0)
+
+parser.add_argument("--duration",
+                     help="Minimum duration (s) of each timing loop",
+                     type=float,required=False,default=2.0)
+
+parser.add_argument("--seed",
+                     help="Seed for the random generator",
+                     type=int,required=False,default=0)
+
+def evaluationsPerSecond(function, parameters, duration):
+
+  n                           = 0
+  start                       = time.time()
+
+  while time.time() - start < duration:
+
+    #Change slightly the parameters, so that no caching is possible
+    function(parameters * (1.0 + 1e-12 * (n % 2)))
+    n                        += 1
+
+  return n / (time.time() - start)
+
+#Main code
+if __name__=="__main__":
+  args                        = parser.parse_args()
+
+  numpy.random.seed(args.seed)
+
+  x                           = numpy.linspace(-500,500,args.bins)
+  exposure                    = numpy.zeros(args.bins) + 0.97
+  trueParameters              = numpy.zeros(args.degree+1)
+  trueParameters[0]           = args.rate
+  trueParameters[1:]          = args.rate * pow(1e-3,numpy.arange(1,args.degree+1))
+  y                           = numpy.random.poisson(Polynomial(trueParameters)(x) * exposure).astype(float)
+
+  legacy                      = LogLikelihood(x,y,Polynomial(list(trueParameters)),exposure=exposure)
+  fast                        = BatchedLogLikelihood(x,y,args.degree,exposure=exposure)
+
+  def legacyAll(parameters):
+    legacy(parameters)
+    legacy.getFreeDerivs(parameters)
+
+  print("%-50s %14s" %("Evaluation","Evals/s"))
+  print("%-50s %14.0f" %("LogLikelihood (value)",
+                         evaluationsPerSecond(legacy, trueParameters, args.duration)))
+  print("%-50s %14.0f" %("LogLikelihood (value + gradient)",
+                         evaluationsPerSecond(legacyAll, trueParameters, args.duration)))
+  print("%-50s %14.0f" %("BatchedLogLikelihood (value + grad. + Hessian)",
+                         evaluationsPerSecond(fast.evaluate, trueParameters, args.duration)))
+
+  #Now compare a complete fit, as done by the background fit of LLE and GBM data,
+  #starting from a constant rate
+  startingPoint               = numpy.zeros(args.degree+1)
+  startingPoint[0]            = numpy.sum(y) / numpy.sum(exposure)
+
+  start                       = time.time()
+  simplex                     = scipy.optimize.fmin(legacy, startingPoint, ftol=1E-5, xtol=1E-5,
+                                                    maxiter=1e6, maxfun=1E6, disp=False)
+  simplexTime                 = time.time() - start
+
+  start                       = time.time()
+  newton                      = scipy.optimize.minimize(fast.getValueAndFreeDerivs, startingPoint,
+                                                        jac=True, hess=fast.getHessian,
+                                                        method='trust-exact', options={'gtol': 1e-8})
+  newtonTime                  = time.time() - start
+
+  print("\n%-50s %14s %14s" %("Fit","Time (s)","Cash stat."))
+  print("%-50s %14.4f %14.4f" %("Simplex on LogLikelihood", simplexTime, legacy(simplex)))
+  print("%-50s %14.4f %14.4f" %("Newton on BatchedLogLikelihood", newtonTime, fast(newton.x)))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import argparse
+
+import io
+import time
+import numpy
+import scipy.optimize
+from contextlib import redirect_stdout
+
+from GtBurst import LikelihoodComponent
+
+
+parser                        = argparse.ArgumentParser("Compare the number of fits needed by the stepwise and the fast "
+                                                        "optimization of the energy bins of a SED, on a synthetic bright burst")
+
+parser.add_argument("--source",
+                     help="Number of photons from the burst",
+                     type=int,required=False,default=5000)
+
+parser.add_argument("--background",
+                     help="Number of background photons",
+                     type=int,required=False,default=20000)
+
+parser.add_argument("--tsmin",
+                     help="Minimum TS in each bin",
+                     type=float,required=False,default=20.0)
+
+parser.add_argument("--seed",
+                     help="Seed for the random generator",
+                     type=int,required=False,default=0)
+
+class PowerLawComponent(object):
+  #Mimics the part of the interface of a source of a pyLikelihood object used by optimizeBins
+  def __init__(self,nPhotons,index,emin,emax):
+    self.nPhotons             = nPhotons
+    self.index                = index
+    self.emin                 = emin
+    self.emax                 = emax
+    self.src                  = self
+  pass
+  
+  def _primitive(self,e):
+    return pow(numpy.clip(e,self.emin,self.emax),self.index+1)
+  
+  def Npred(self,e1,e2):
+    return self.nPhotons * (self._primitive(e2) - self._primitive(e1)) / (self._primitive(self.emax) - self._primitive(self.emin))
+  
+  def density(self,e):
+    #Expected counts per MeV
+    return self.nPhotons * (self.index+1) * pow(e,self.index) / (self._primitive(self.emax) - self._primitive(self.emin))
+  
+  def sample(self,n):
+    u                         = numpy.random.uniform(0,1,n)
+    a                         = self._primitive(self.emin)
+    b                         = self._primitive(self.emax)
+    return pow(a + u * (b - a),1.0/(self.index+1))
+pass
+
+class SyntheticLikelihood(object):
+  #The TS in an energy range comes from an unbinned fit of the photons in the range, with the
+  #background fixed and normalization and photon index of the source free, as in gtdosed with
+  #fixphindex=no. The fast method predicts it from the counts alone, so the prediction is
+  #only approximate, as with the real likelihood
+  def __init__(self,energies,components,sourceName):
+    self.energies             = energies
+    self.components           = components
+    self.sourceName           = sourceName
+    self.nFits                = 0
+  pass
+  
+  def sourceNames(self):
+    return list(self.components.keys())
+  
+  def __getitem__(self,name):
+    return self.components[name]
+  
+  def setEnergyRange(self,e1,e2):
+    self.e1,self.e2           = e1,e2
+  
+  def Ts(self,sourceName,reoptimize=False):
+    self.nFits               += 1
+    e                         = self.energies[(self.energies >= self.e1) & (self.energies <= self.e2)]
+    others                    = [c for name,c in list(self.components.items()) if name!=sourceName]
+    B                         = sum([c.Npred(self.e1,self.e2) for c in others])
+    
+    if(len(e)==0):
+      return 0.0
+    
+    backgroundDensity         = sum([c.density(e) for c in others])
+    logE1,logE2,logE          = numpy.log(self.e1),numpy.log(self.e2),numpy.log(e)
+    
+    def minusLogLike(parameters):
+      nSource,index           = parameters
+      #Power law with the given photon index, normalized to 1 between e1 and e2
+      if(abs(index+1) < 1e-6):
+        sourceDensity         = 1.0 / (e * (logE2 - logE1))
+      else:
+        sourceDensity         = (index+1) * numpy.exp(index*logE) / (numpy.exp((index+1)*logE2) - numpy.exp((index+1)*logE1))
+      return nSource + B - numpy.sum(numpy.log(nSource * sourceDensity + backgroundDensity))
+    
+    null                      = minusLogLike([0.0,-2.0])
+    best                      = scipy.optimize.minimize(minusLogLike,[max(len(e) - B,1.0),-2.0],method='L-BFGS-B',
+                                                        bounds=[(0,None),(-5,0)])
+    
+    return max(2 * (null - min(best.fun,null)),0.0)
+pass
+
+#Main code
+if __name__=="__main__":
+  args                        = parser.parse_args()
+
+  numpy.random.seed(args.seed)
+
+  source                      = PowerLawComponent(args.source,-2.0,100.0,1e5)
+  background                  = PowerLawComponent(args.background,-2.5,100.0,1e5)
+  energies                    = numpy.concatenate([source.sample(args.source),background.sample(args.background)])
+
+  #The fast method assumes that the TS grows with the number of photons, which is not
+  #always true for a fit, so some boundaries can differ from the stepwise ones
+  print("%-10s %10s %10s %10s %24s" %("Method","Fits","Time (s)","Bins","Boundaries not stepwise"))
+
+  results                     = {}
+
+  for method in ['stepwise','fast']:
+    like                      = SyntheticLikelihood(energies,{'GRB': source, 'BKG': background},'GRB')
+
+    start                     = time.time()
+    with redirect_stdout(io.StringIO()):
+      boundaries              = LikelihoodComponent.optimizeBins(like,energies,'GRB',minTs=args.tsmin,minEvt=3,method=method)
+    elapsed                   = time.time() - start
+
+    results[method]           = numpy.array(boundaries)
+    different                 = len(set(numpy.round(boundaries,6)) - set(numpy.round(results['stepwise'],6)))
+
+    print("%-10s %10s %10.3f %10s %24s" %(method,like.nFits,elapsed,len(boundaries)-1,different))
+  pass
@@ -14,7 +14,10 @@ from GtBurst.my_fits_io import pyfits
 from GtBurst.likelihood_profile_writer import LikelihoodProfiler
 from GtBurst.FuncFactory import Spectra
 import os
+import sys
 import subprocess
+import multiprocessing
+import multiprocessing.connection
 import glob
 import numpy
 import xml.etree.ElementTree as ET
@@ -216,9 +219,12 @@ def printCommand(cmdname, targs):
 pass
 
 
+sourceListColumns = ['name', 'ra', 'dec', 'tstart', 'tstop', 'TS', 'photonIndex', 'photonIndexError',
+                     'flux', 'fluxError', 'photonFlux', 'photonFluxError', 'roi', 'irf', 'zmax', 'thetamax', 'strategy']
+
+
 def writeSourceListToFile(sources, outfile):
-    colNames = ['name', 'ra', 'dec', 'tstart', 'tstop', 'TS', 'photonIndex', 'photonIndexError',
-                'flux', 'fluxError', 'photonFlux', 'photonFluxError', 'roi', 'irf', 'zmax', 'thetamax', 'strategy']
+    colNames = sourceListColumns
 
     with open(outfile, 'w+') as f:
         f.write("#%s" % (" ".join(colNames)))
@@ -237,6 +243,435 @@ def writeSourceListToFile(sources, outfile):
 pass
 
 
+# Name of the file where each interval saves its own results, within its directory
+intervalResultFile = "interval_result.txt"
+
+
+def get_interval_directory(workdir, t1, t2):
+
+    return os.path.join(workdir, "interval%s-%s" % (t1, t2))
+
+
+def select_irf(irf, t1, t2):
+
+    if irf != 'auto':
+
+        return irf
+
+    if t2 - t1 <= 100.0:
+
+        irf = 'p8_transient020e'
+
+    elif 100.0 < t2 - t1 < 1000.0:
+
+        irf = 'p8_transient010e'
+
+    else:
+
+        irf = 'p8_source'
+
+    print(("\nAutoselected %s class\n" % irf))
+
+    return irf
+
+
+def make_preselection(args, dataset, t1, t2):
+    """
+    Select, once for all the intervals, the events between t1 and t2 in the ROI with the energy, Zenith and theta
+    cuts but without any class cut. Each interval will then extract its events from this pre-selection, instead of
+    running gtmktime and gtselect on the whole FT1 file again.
+
+    :return: a dataHandling.LATEventStore instance
+    """
+
+    lat_data = dataHandling.LATData(dataset['eventfile'], dataset['rspfile'], dataset['ft2file'])
+
+    preselected_file, n_events = lat_data.performStandardCut(args.ra, args.dec, args.roi, None, t1, t2,
+                                                             args.emin, args.emax, args.zmax, args.thetamax,
+                                                             True, strategy=args.strategy)
+
+    return dataHandling.LATEventStore(os.path.abspath(preselected_file))
+
+
+def analyze_interval(args, dataset, t1, t2, preselection=None):
+    """
+    Select the data, build the model and run the likelihood analysis for the interval t1-t2. All the files are
+    written in the current working directory. If a pre-selection (see make_preselection) is provided, the events
+    are extracted from it.
+
+    :return: the GRB source with the results, or None if the data selection failed
+    """
+
+    particle_model = args.particle_model
+
+    irf = select_irf(args.irf, t1, t2)
+
+    # Select data
+    targs = {}
+    targs['rad'] = args.roi
+    targs['eventfile'] = dataset['eventfile']
+    targs['zmax'] = args.zmax
+    targs['thetamax'] = args.thetamax
+    targs['emin'] = args.emin
+    targs['emax'] = args.emax
+    targs['skymap'] = '%s_LAT_skymap_%s-%s.fit' % (args.triggername, t1, t2)
+    targs['rspfile'] = dataset['rspfile']
+    targs['strategy'] = args.strategy
+    targs['ft2file'] = dataset['ft2file']
+    targs['tstart'] = t1
+    targs['tstop'] = t2
+    targs['ra'] = args.ra
+    targs['dec'] = args.dec
+    targs['irf'] = irf
+    targs['allowEmpty'] = 'no'
+    targs['preselection'] = preselection
+
+    printCommand("gtdocountsmap.py", targs)
+    try:
+        _, skymap, _, filteredeventfile, _, _, _, _ = gtdocountsmap.run(**targs)
+    except:
+        print("\nERROR: could not complete selection of data for this interval.")
+        return None
+
+    # Build XML file
+    targs = {}
+    targs['xmlmodel'] = '%s_LAT_xmlmodel_%s-%s.xml' % (args.triggername, t1, t2)
+    targs['filteredeventfile'] = filteredeventfile
+    targs['galactic_model'] = args.galactic_model
+    targs['particle_model'] = particle_model
+    targs['ra'] = args.ra
+    targs['dec'] = args.dec
+    targs['fgl_mode'] = args.fgl_mode
+    targs['ft2file'] = dataset['ft2file']
+    targs['source_model'] = args.source_model
+    printCommand("gtbuildxmlmodel", targs)
+    _, xmlmodel = gtbuildxmlmodel.run(**targs)
+
+    # Now if the user has specified a specific photon index for upper limits,
+    # change the photon index in the XML file
+
+    # Save parameters in comments (ET will strip them out)
+
+    pars_in_comments = {}
+
+    for key in ['OBJECT', 'RA', 'DEC', 'IRF']:
+        pars_in_comments[key] = dataHandling._getParamFromXML(xmlmodel, key)
+
+    # Now change the photon index in the XML file
+
+    tree = ET.parse(xmlmodel)
+    root = tree.getroot()
+    index = root.findall("./source[@name='%s']/spectrum/parameter[@name='Index']" % 'GRB')[0]
+
+    ulphindex = args.ulphindex
+
+    if ulphindex == -1.0:
+        ulphindex += 0.01
+
+    index.set('value', str(ulphindex))
+
+    tree.write(xmlmodel)
+
+    # Add the parameters in comments back
+
+    dataHandling._writeParamIntoXML(xmlmodel, **pars_in_comments)
+
+    targs = {}
+    targs['spectralfiles'] = args.spectralfiles
+    targs['xmlmodel'] = xmlmodel
+    targs['liketype'] = args.liketype
+    targs['filteredeventfile'] = filteredeventfile
+    targs['rspfile'] = dataset['rspfile']
+    targs['showmodelimage'] = 'no'
+    targs['tsmin'] = args.tsmin
+    targs['optimizeposition'] = 'no'
+    targs['ft2file'] = dataset['ft2file']
+    targs['skymap'] = skymap
+    targs['flemin'] = args.flemin
+    targs['flemax'] = args.flemax
+
+    if args.ltcube != '':
+
+        if not os.path.exists(args.ltcube):
+            raise IOError("Livetime cube %s does not exists!" % (args.ltcube))
+
+        targs['ltcube'] = args.ltcube
+
+    if args.expomap != '':
+
+        if not os.path.exists(args.expomap):
+            raise IOError("Exposure map %s does not exists!" % (args.expomap))
+
+        targs['expomap'] = args.expomap
+
+    printCommand("gtdolike.py", targs)
+    (_, outfilelike, _, grb_TS,
+     _, bestra, _, bestdec,
+     _, poserr, _, distance,
+     _, sources) = gtdolike.run(**targs)
+
+    # Get root of the name
+    root_name = os.path.splitext(os.path.basename(filteredeventfile))[0]
+
+    # Find ltcube
+
+    ltcubes = glob.glob("%s_ltcube.fit*" % root_name)
+
+    assert len(ltcubes) == 1, "Couldn't find ltcube"
+
+    ltcube = ltcubes[0]
+
+    # Find expomap
+
+    expmaps = glob.glob("%s_expomap.fit*" % root_name)
+
+    assert len(expmaps) == 1, "Couldn't find exopmap"
+
+    expmap = expmaps[0]
+
+    # Find XML model output of gtdolike
+    xmls = glob.glob("%s_likeRes.xml" % root_name)
+
+    assert len(xmls) == 1, "Couldn't find XML"
+
+    xml_res = xmls[0]
+
+    # If the TS map is required, let's do it
+
+    if args.tsmap_spec is not None:
+        half_size, n_side = args.tsmap_spec.replace(" ", "").split(",")
+
+        obs = UnbinnedAnalysis.UnbinnedObs(filteredeventfile, dataset['ft2file'], expMap=expmap, expCube=ltcube)
+        like = UnbinnedAnalysis.UnbinnedAnalysis(obs, xml_res, 'MINUIT')
+
+        # When intervals are analyzed in parallel, GTBURST_NCPUS is the share of each interval
+        ncpus = min(int(float(Configuration().get('maxNumberOfCPUs'))), multiprocessing.cpu_count())
+
+        ftm = FastTSMap(like)
+        (bestra, bestdec), maxTS = ftm.search_for_maximum(args.ra, args.dec, float(half_size), int(n_side),
+                                                          verbose=False, ncpus=ncpus, refine=args.tsmap_refine,
+                                                          traversal=args.tsmap_traversal)
+
+    # Now append the results for this interval
+    grb = [x for x in sources if x.name.find("GRB") >= 0][0]
+
+    if args.tsmap_spec is not None:
+
+        if maxTS > grb.TS:
+            print("\n\n=========================================")
+            print(" Fast TS Map has found a better position")
+            print("=========================================\n\n")
+
+            # grb.ra                   = float(bestra)
+            # grb.dec                  = float(bestdec)
+            grb.TS = float(maxTS)
+
+            print(("(R.A., Dec.) = (%.3f, %3f) with TS = %.2f\n" % (bestra, bestdec, grb.TS)))
+
+    else:
+
+        # Do nothing, so that grb.ra and grb.dec will stay what they are already
+        pass
+
+    if args.likelihood_profile:
+        # Make a profile of the likelihood with a variable normalization
+        obs = UnbinnedAnalysis.UnbinnedObs(filteredeventfile, dataset['ft2file'], expMap=expmap, expCube=ltcube)
+        like = UnbinnedAnalysis.UnbinnedAnalysis(obs, xml_res, 'MINUIT')
+
+        # Setup likelihood object like is done in gtburst
+        like, phIndex_beforeFit, grb_name = dataHandling.LATData.setup_likelihood_object(like, xmlmodel)
+
+        lpw = LikelihoodProfiler(like, xml_res)
+
+        if grb.TS < args.tsmin:
+
+            print("\nForcing index to -2.0 and sampling\n")
+
+            lpw.get_likelihood_profile(forced_photon_index=-2.0)
+
+        else:
+
+            print("\nSampling\n")
+            lpw.get_likelihood_profile()
+
+        lpw.save("log_like_profile")
+        fig = lpw.plot()
+
+        fig.savefig("log_like_profile.png")
+
+        plt.close(fig)
+
+    if args.remove_fits_files:
+
+        fits_files = glob.glob("*.fit*")
+
+        for ff in fits_files:
+
+            os.remove(ff)
+
+    grb.name = args.triggername
+    grb.tstart = t1
+    grb.tstop = t2
+    grb.roi = args.roi
+    grb.irf = irf
+    grb.zmax = args.zmax
+    grb.thetamax = args.thetamax
+    grb.strategy = args.strategy
+
+    return grb
+
+
+def interval_worker(args, dataset, preselection, t1, t2, dirname, ncpus_per_interval, log_to_file):
+    """
+    Entry point of the process analyzing one interval. The change of working directory only affects this process,
+    so the other intervals (and the parent) are not disturbed. The results are saved in the directory of the
+    interval, and the exit code tells the parent whether the analysis succeeded.
+    """
+
+    os.chdir(dirname)
+
+    if log_to_file:
+
+        # Send the output of this process (including the one of the C++ code) to a log file, so that the
+        # output of the different intervals does not get mixed
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        log = os.open("interval.log", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        os.close(log)
+
+    # Avoid that the science tools run by each interval use all the CPUs
+
+    os.environ['GTBURST_NCPUS'] = str(ncpus_per_interval)
+
+    grb = analyze_interval(args, dataset, t1, t2, preselection)
+
+    if grb is None:
+
+        sys.exit(1)
+
+    # Write to a temporary file first, so that a result file is never found incomplete
+
+    writeSourceListToFile([grb], "%s.tmp" % intervalResultFile)
+
+    os.rename("%s.tmp" % intervalResultFile, intervalResultFile)
+
+    sys.stdout.flush()
+
+
+def run_intervals(args, dataset, preselection, intervals, workdir, ncpus, outfile):
+    """
+    Analyze the intervals using up to ncpus processes, one for each interval. Intervals already analyzed in a
+    previous run (i.e., which have a result file in their directory) are not analyzed again. Every time an
+    interval finishes, the results obtained so far are merged in outfile.
+
+    :return: list of the (t1, t2) intervals for which the analysis failed
+    """
+
+    ncpus_total = int(float(Configuration().get('maxNumberOfCPUs')))
+    ncpus_per_interval = max(1, ncpus_total // ncpus)
+
+    pending = []
+
+    for t1, t2 in intervals:
+
+        dirname = get_interval_directory(workdir, t1, t2)
+
+        if os.path.exists(os.path.join(dirname, intervalResultFile)):
+
+            print(("%s already contains results, skipping" % dirname))
+
+            continue
+
+        try:
+            os.makedirs(dirname)
+        except:
+            pass
+
+        if not os.path.isdir(dirname):
+            raise RuntimeError("Could not create/access directory %s" % (dirname))
+
+        pending.append((t1, t2, dirname))
+
+    running = {}
+    failed = []
+
+    while len(pending) > 0 or len(running) > 0:
+
+        # Start new intervals until all the processes are busy
+
+        while len(pending) > 0 and len(running) < ncpus:
+
+            t1, t2, dirname = pending.pop(0)
+
+            print(("\nInterval %s-%s: started in %s" % (t1, t2, dirname)))
+
+            sys.stdout.flush()
+
+            process = multiprocessing.Process(target=interval_worker,
+                                              args=(args, dataset, preselection, t1, t2, dirname,
+                                                    ncpus_per_interval, ncpus > 1))
+            process.start()
+
+            running[process.sentinel] = (process, t1, t2, dirname)
+
+        # Wait for at least one of them to finish
+
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+
+            process, t1, t2, dirname = running.pop(sentinel)
+
+            process.join()
+
+            if process.exitcode == 0 and os.path.exists(os.path.join(dirname, intervalResultFile)):
+
+                print(("\nInterval %s-%s: done" % (t1, t2)))
+
+            else:
+
+                print(("\nInterval %s-%s: FAILED (exit code %s). Check the output in %s" % (t1, t2, process.exitcode,
+                                                                                        dirname)))
+
+                failed.append((t1, t2))
+
+        merge_results(intervals, workdir, outfile)
+
+    return sorted(failed)
+
+
+def merge_results(intervals, workdir, outfile):
+    """
+    Collect the results of all the intervals which have been analyzed successfully, and write them in time
+    order in outfile
+    """
+
+    lines = []
+
+    for t1, t2 in sorted(intervals):
+
+        result_file = os.path.join(get_interval_directory(workdir, t1, t2), intervalResultFile)
+
+        if not os.path.exists(result_file):
+
+            continue
+
+        with open(result_file) as f:
+
+            # Skip the header
+
+            lines.extend([line for line in f.readlines()[1:] if line.strip() != ''])
+
+    with open(outfile, 'w+') as f:
+        f.write("#%s" % (" ".join(sourceListColumns)))
+        f.write("\n")
+        for line in lines:
+            f.write(line.rstrip("\n"))
+            f.write("\n")
+
+
 # def get_likelihood_profile(like, norm):
 #
 #     # Get the current settings of the parameter so we can restore it later
@@ -423,6 +858,14 @@ if __name__ == "__main__":
                         help="A TS map specification of the type half_size,n_side. For example: "
                              "'--tsmap_spec 0.5,8' makes a TS map 1 deg x 1 deg with 64 points",
                         default=None)
+    parser.add_argument("--tsmap_refine",
+                        help="Instead of computing the full TS map, start from a coarse grid and refine it around "
+                             "the maximum down to the resolution given by --tsmap_spec",
+                        default=False, action='store_true')
+    parser.add_argument("--tsmap_traversal",
+                        help="Order in which the points of the TS map are computed: 'grid' (each fit starts from "
+                             "scratch), 'spiral' or 'hilbert' (each fit starts from the solution of a nearby point)",
+                        default='grid', choices=FastTSMap.traversals)
     parser.add_argument("--filter_GTI", help="Automatically divide time intervals crossing GTIs", default=False,
                         action='store_true')
     parser.add_argument("--likelihood_profile",
@@ -432,9 +875,15 @@ if __name__ == "__main__":
     parser.add_argument("--remove_fits_files",
                         help="Whether to remove the FITS files of every interval in order to save disk space",
                         default=False, action='store_true')
+    parser.add_argument("--ncpus",
+                        help="Number of intervals to analyze at the same time, each one in its own process. It cannot "
+                             "exceed the maximum number of CPUs of the configuration (GTBURST_NCPUS)",
+                        default=1, type=int)
 
     args = parser.parse_args()
 
+    args.ncpus = max(1, min(args.ncpus, int(float(configuration.get('maxNumberOfCPUs')))))
+
     if args.ltcube != '':
         args.ltcube = os.path.abspath(os.path.expanduser(os.path.expandvars(args.ltcube)))
 
@@ -481,18 +930,6 @@ if __name__ == "__main__":
             args.tstarts = ",".join(map(str, d[col1]))
             args.tstops = ",".join(map(str, d[col2]))
 
-
-    if args.likelihood_profile:
-
-        # Check that we can import emcee
-        try:
-
-            import emcee
-
-        except ImportError:
-
-            raise ImportError("In order to make the likelihood profile you have to install emcee.")
-
     # Determine time intervals
     tstarts = numpy.array([float(x.replace('\\', "")) for x in args.tstarts.split(",")])
     tstops = numpy.array([float(x.replace('\\', "")) for x in args.tstops.split(",")])
@@ -544,313 +981,46 @@ if __name__ == "__main__":
     print(("%-20s %s" % ('Dec.', dec)))
     print(("%-20s %s" % ('Radius', args.roi)))
 
+    # Select the events for the whole time range only once. Note that intervals processed in parallel
+    # share this pre-selection
+
+    print("\nPre-selection of the events:")
+    print("-----------------------------")
+
+    preselection = make_preselection(args, dataset, min(tstarts), max(tstops))
+
     if args.filter_GTI:
 
-        # Fix the requested time intervals according to the GTIs
-
-        # First select between the first time and the last time, using the Zenith cut and strategy
-        # I am going to use
-        # Select data
-        t1 = min(tstarts)
-        t2 = max(tstops)
-
-        targs = {}
-        targs['rad'] = args.roi
-        targs['eventfile'] = dataset['eventfile']
-        targs['zmax'] = args.zmax
-        targs['thetamax'] = args.thetamax
-        targs['emin'] = args.emin
-        targs['emax'] = args.emax
-        targs['skymap'] = '%s_LAT_skymap_%s-%s.fit' % (args.triggername, t1, t2)
-        targs['rspfile'] = dataset['rspfile']
-        targs['strategy'] = args.strategy
-        targs['ft2file'] = dataset['ft2file']
-        targs['tstart'] = t1
-        targs['tstop'] = t2
-        targs['ra'] = args.ra
-        targs['dec'] = args.dec
-        # For this initial selection use the less restrictive IRF
-        targs['irf'] = 'p8_transient020e'
-        targs['allowEmpty'] = 'no'
-
-        printCommand("gtdocountsmap.py", targs)
-        try:
-            _, skymap, _, filteredeventfile, _, _, _, _ = gtdocountsmap.run(**targs)
-        except:
-            raise
+        # Fix the requested time intervals according to the GTIs of the pre-selection, which have
+        # been computed using the Zenith cut and strategy I am going to use
 
-        gtis = pyfits.getdata(filteredeventfile, 'GTI')
-        trigger_time = dataHandling.getTriggerTime(filteredeventfile)
+        trigger_time = dataHandling.getTriggerTime(preselection.eventFile)
 
         tstarts, tstops = clean_intervals(tstarts, tstops,
-                                          gtis.field("START") - trigger_time,
-                                          gtis.field("STOP") - trigger_time)
+                                          preselection.gtiStart - trigger_time,
+                                          preselection.gtiStop - trigger_time)
 
         print("\nAfter intersecting with GTI these are the intervals:")
         print("------------------------------------------------------")
         for t1, t2 in zip(tstarts, tstops):
             print(("%-20s - %s" % (t1, t2)))
 
-    results = []
-    initialWorkdir = os.getcwd()
-
-    for i, t1, t2 in zip(list(range(1, len(tstarts) + 1)), tstarts, tstops):
-
-        print(("\nInterval # %s (%s-%s):" % (i, t1, t2)))
-        print("-----------------------\n")
-
-        # Create a work dir and move there
-        dirname = os.path.abspath("interval%s-%s" % (t1, t2))
-
-        if os.path.exists(dirname):
-            print(("%s already exists, skipping" % dirname))
-
-            continue
-
-        particle_model = args.particle_model
+    intervals = sorted(zip(tstarts, tstops))
 
-        if args.irf == 'auto':
+    print(("\nAnalyzing %s intervals using %s process(es)" % (len(intervals), args.ncpus)))
 
-            if t2 - t1 <= 100.0:
+    failed = run_intervals(args, dataset, preselection, intervals, os.getcwd(), args.ncpus, args.outfile)
 
-                args.irf = 'p8_transient020e'
+    if len(failed) > 0:
 
-            elif 100.0 < t2 - t1 < 1000.0:
-
-                args.irf = 'p8_transient010e'
-
-            else:
-
-                args.irf = 'p8_source'
-
-            print(("\nAutoselected %s class\n" % args.irf))
-
-        irf = args.irf
-
-        try:
-            os.makedirs(dirname)
-        except:
-            pass
-        pass
-
-        try:
-            os.chdir(dirname)
-        except:
-            raise RuntimeError("Could not create/access directory %s" % (dirname))
-        pass
-
-        # Select data
-        targs = {}
-        targs['rad'] = args.roi
-        targs['eventfile'] = dataset['eventfile']
-        targs['zmax'] = args.zmax
-        targs['thetamax'] = args.thetamax
-        targs['emin'] = args.emin
-        targs['emax'] = args.emax
-        targs['skymap'] = '%s_LAT_skymap_%s-%s.fit' % (args.triggername, t1, t2)
-        targs['rspfile'] = dataset['rspfile']
-        targs['strategy'] = args.strategy
-        targs['ft2file'] = dataset['ft2file']
-        targs['tstart'] = t1
-        targs['tstop'] = t2
-        targs['ra'] = args.ra
-        targs['dec'] = args.dec
-        targs['irf'] = irf
-        targs['allowEmpty'] = 'no'
-
-        printCommand("gtdocountsmap.py", targs)
-        try:
-            _, skymap, _, filteredeventfile, _, _, _, _ = gtdocountsmap.run(**targs)
-        except:
-            print("\nERROR: could not complete selection of data for this interval.")
-            continue
-
-        # Build XML file
-        targs = {}
-        targs['xmlmodel'] = '%s_LAT_xmlmodel_%s-%s.xml' % (args.triggername, t1, t2)
-        targs['filteredeventfile'] = filteredeventfile
-        targs['galactic_model'] = args.galactic_model
-        targs['particle_model'] = particle_model
-        targs['ra'] = args.ra
-        targs['dec'] = args.dec
-        targs['fgl_mode'] = args.fgl_mode
-        targs['ft2file'] = dataset['ft2file']
-        targs['source_model'] = args.source_model
-        printCommand("gtbuildxmlmodel", targs)
-        _, xmlmodel = gtbuildxmlmodel.run(**targs)
-
-        # Now if the user has specified a specific photon index for upper limits,
-        # change the photon index in the XML file
-
-        # Save parameters in comments (ET will strip them out)
-
-        pars_in_comments = {}
-
-        for key in ['OBJECT', 'RA', 'DEC', 'IRF']:
-            pars_in_comments[key] = dataHandling._getParamFromXML(xmlmodel, key)
-
-        # Now change the photon index in the XML file
-
-        tree = ET.parse(xmlmodel)
-        root = tree.getroot()
-        index = root.findall("./source[@name='%s']/spectrum/parameter[@name='Index']" % 'GRB')[0]
-
-        if args.ulphindex == -1.0:
-            args.ulphindex += 0.01
-
-        index.set('value', str(args.ulphindex))
-
-        tree.write(xmlmodel)
-
-        # Add the parameters in comments back
-
-        dataHandling._writeParamIntoXML(xmlmodel, **pars_in_comments)
-
-        targs = {}
-        targs['spectralfiles'] = args.spectralfiles
-        targs['xmlmodel'] = xmlmodel
-        targs['liketype'] = args.liketype
-        targs['filteredeventfile'] = filteredeventfile
-        targs['rspfile'] = dataset['rspfile']
-        targs['showmodelimage'] = 'no'
-        targs['tsmin'] = args.tsmin
-        targs['optimizeposition'] = 'no'
-        targs['ft2file'] = dataset['ft2file']
-        targs['skymap'] = skymap
-        targs['flemin'] = args.flemin
-        targs['flemax'] = args.flemax
-
-        if args.ltcube != '':
-
-            if not os.path.exists(args.ltcube):
-                raise IOError("Livetime cube %s does not exists!" % (args.ltcube))
-
-            targs['ltcube'] = args.ltcube
-
-        if args.expomap != '':
-
-            if not os.path.exists(args.expomap):
-                raise IOError("Exposure map %s does not exists!" % (args.expomap))
-
-            targs['expomap'] = args.expomap
-
-        printCommand("gtdolike.py", targs)
-        (_, outfilelike, _, grb_TS,
-         _, bestra, _, bestdec,
-         _, poserr, _, distance,
-         _, sources) = gtdolike.run(**targs)
-
-        # Get root of the name
-        root_name = os.path.splitext(os.path.basename(filteredeventfile))[0]
-
-        # Find ltcube
-
-        ltcubes = glob.glob("%s_ltcube.fit*" % root_name)
-
-        assert len(ltcubes) == 1, "Couldn't find ltcube"
-
-        ltcube = ltcubes[0]
-
-        # Find expomap
-
-        expmaps = glob.glob("%s_expomap.fit*" % root_name)
-
-        assert len(expmaps) == 1, "Couldn't find exopmap"
-
-        expmap = expmaps[0]
-
-        # Find XML model output of gtdolike
-        xmls = glob.glob("%s_likeRes.xml" % root_name)
-
-        assert len(xmls) == 1, "Couldn't find XML"
-
-        xml_res = xmls[0]
-
-        # If the TS map is required, let's do it
-
-        if args.tsmap_spec is not None:
-            half_size, n_side = args.tsmap_spec.replace(" ", "").split(",")
-
-            obs = UnbinnedAnalysis.UnbinnedObs(filteredeventfile, dataset['ft2file'], expMap=expmap, expCube=ltcube)
-            like = UnbinnedAnalysis.UnbinnedAnalysis(obs, xml_res, 'MINUIT')
-
-            ftm = FastTSMap(like)
-            (bestra, bestdec), maxTS = ftm.search_for_maximum(args.ra, args.dec, float(half_size), int(n_side),
-                                                              verbose=False)
-
-        # Now append the results for this interval
-        grb = [x for x in sources if x.name.find("GRB") >= 0][0]
-
-        if args.tsmap_spec is not None:
-
-            if maxTS > grb.TS:
-                print("\n\n=========================================")
-                print(" Fast TS Map has found a better position")
-                print("=========================================\n\n")
-
-                # grb.ra                   = float(bestra)
-                # grb.dec                  = float(bestdec)
-                grb.TS = float(maxTS)
-
-                print(("(R.A., Dec.) = (%.3f, %3f) with TS = %.2f\n" % (bestra, bestdec, grb.TS)))
-
-        else:
-
-            # Do nothing, so that grb.ra and grb.dec will stay what they are already
-            pass
-
-        if args.likelihood_profile:
-            # Make a profile of the likelihood with a variable normalization
-            obs = UnbinnedAnalysis.UnbinnedObs(filteredeventfile, dataset['ft2file'], expMap=expmap, expCube=ltcube)
-            like = UnbinnedAnalysis.UnbinnedAnalysis(obs, xml_res, 'MINUIT')
-
-            # Setup likelihood object like is done in gtburst
-            like, phIndex_beforeFit, grb_name = dataHandling.LATData.setup_likelihood_object(like, xmlmodel)
-
-            lpw = LikelihoodProfiler(like, xml_res)
-
-            if grb.TS < args.tsmin:
-
-                print("\nForcing index to -2.0 and sampling\n")
-
-                lpw.get_likelihood_profile(forced_photon_index=-2.0)
-
-            else:
-
-                print("\nSampling\n")
-                lpw.get_likelihood_profile()
-
-            lpw.save("log_like_profile")
-            fig = lpw.plot()
-
-            fig.savefig("log_like_profile.png")
-
-            plt.close(fig)
-
-        if args.remove_fits_files:
-
-            fits_files = glob.glob("*.fit*")
-
-            for ff in fits_files:
-
-                os.remove(ff)
-
-        grb.name = args.triggername
-        grb.tstart = t1
-        grb.tstop = t2
-        grb.roi = args.roi
-        grb.irf = irf
-        grb.zmax = args.zmax
-        grb.thetamax = args.thetamax
-        grb.strategy = args.strategy
-        results.append(grb)
-
-        os.chdir(initialWorkdir)
-    pass
+        print("\nThe analysis failed for these intervals:")
+        print("------------------------------------------------------")
+        for t1, t2 in failed:
+            print(("%-20s - %s" % (t1, t2)))
 
     try:
 
-        writeSourceListToFile(results, args.outfile)
+        merge_results(intervals, os.getcwd(), args.outfile)
 
     except IOError:
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import argparse
+
+from GtBurst.ProductCache import ProductCache
+from GtBurst.DataCache import DataCache
+
+
+parser                        = argparse.ArgumentParser("Show statistics about, or clear, the cache of livetime cubes and exposure maps (or of downloaded data)")
+
+parser.add_argument("--clear",
+                     help="Remove all the products from the cache",
+                     action='store_true',required=False,default=False)
+
+parser.add_argument("--data",
+                     help="Act on the cache of downloaded data (GTBURST_CACHE) instead",
+                     action='store_true',required=False,default=False)
+
+#Main code
+if __name__=="__main__":
+  args                        = parser.parse_args()
+
+  if(args.data):
+    cache                     = DataCache()
+  else:
+    cache                     = ProductCache()
+  pass
+
+  if(not cache.isEnabled()):
+    if(args.data):
+      print("The data cache is disabled (dataCache is empty)")
+    else:
+      print("The product cache is disabled (productCacheSize is 0)")
+    pass
+  else:
+    if(args.clear):
+      cache.clear()
+      print("Cache cleared")
+    pass
+
+    statistics                = cache.getStatistics()
+
+    print("%-20s %s" %("Directory",cache.directory))
+    print("%-20s %.1f MB" %("Max. size",cache.maxSize / 1024.0 / 1024.0))
+    print("%-20s %s" %("Products",statistics['products']))
+    print("%-20s %.1f MB" %("Size",statistics['size'] / 1024.0 / 1024.0))
+    print("%-20s %s" %("Hits",statistics['hits']))
+    print("%-20s %s" %("Misses",statistics['misses']))
+  pass
@@ -300,9 +300,13 @@ class Polynomial(object):
   pass
   
   def computeCovarianceMatrix(self,statisticGradient):
-    self.covMatrix            = computeCovarianceMatrix(statisticGradient,self.params)
+    self.setCovarianceMatrix(computeCovarianceMatrix(statisticGradient,self.params))
+  pass
+  
+  def setCovarianceMatrix(self,covMatrix):
+    self.covMatrix            = numpy.array(covMatrix)
     #Check that the covariance matrix is positive-defined
-    negativeElements          = (numpy.matrix.diagonal(self.covMatrix) < 0)
+    negativeElements          = (numpy.diagonal(self.covMatrix) < 0)
     if(len(negativeElements.nonzero()[0]) > 0):
       raise GtBurstException(8, "The background fit has failed. Select one interval before the transient and one after, as close as possible "+
                                 "to respectively the beginning and the end of the transient, and few hundreds seconds in duration.")
@@ -326,28 +330,407 @@ class Polynomial(object):
   
   def integralError(self,xmin,xmax):
     # Based on http://root.cern.ch/root/html/tutorials/fit/ErrorIntegral.C.html
+    # xmin and xmax can also be arrays, in which case an array of errors is returned
     
     #Set the weights
-    i_plus_1                  = numpy.array(list(range(1,self.degree+1+1)),'d')
-    def evalBasis(x):
-      return (1/i_plus_1) * pow(x,i_plus_1)
-    c                         = evalBasis(xmax) - evalBasis(xmin)
+    c                         = _integralBasis(xmax,self.degree+1) - _integralBasis(xmin,self.degree+1)
     
     #Compute the error on the integral
-    err2                      = 0.0
-    nPar                      = self.degree+1
     parCov                    = self.getCovarianceMatrix()
-    for i in range(nPar):
-      s                       = 0.0
-      for j in range(nPar):
-        s                    += parCov[i,j] * c[j]
+    err2                      = numpy.einsum('...i,ij,...j->...',c,parCov,c)
+    
+    if(numpy.ndim(err2)==0):
+      return math.sqrt(err2)
+    else:
+      return numpy.sqrt(err2)
+  pass
+  
+pass
+
+def _integralBasis(x,nPar):
+  #Integrals between 0 and x of x^i, for i=0..nPar-1, as a (len(x) x nPar) array
+  #(or a nPar array if x is a scalar)
+  i_plus_1                    = numpy.arange(1,nPar+1,dtype=float)
+  return pow(numpy.asarray(x,dtype=float)[...,None],i_plus_1) / i_plus_1
+pass
+
+class PolynomialSet(object):
+  '''
+  A set of polynomials, for example the background models for all the channels
+  of a CSPEC file. The coefficients and the covariance matrices of all the
+  polynomials are stored in arrays (padded with zeros up to the maximum degree),
+  so that all the polynomials can be evaluated and integrated over many
+  intervals at once. Results are (intervals x polynomials) arrays.
+  '''
+  def __init__(self,polynomials):
+    self.polynomials          = list(polynomials)
+    
+    nPolynomials              = len(self.polynomials)
+    self.degree               = max([p.degree for p in self.polynomials])
+    nPar                      = self.degree+1
+    
+    self.params               = numpy.zeros([nPolynomials,nPar])
+    self.covMatrices          = numpy.zeros([nPolynomials,nPar,nPar])
+    
+    for i,polynomial in enumerate(self.polynomials):
+      n                       = polynomial.degree+1
+      self.params[i,:n]       = polynomial.getParams()
+      self.covMatrices[i,:n,:n] = polynomial.getCovarianceMatrix()
+    pass
+  pass
+  
+  def __len__(self):
+    return len(self.polynomials)
+  pass
+  
+  def __getitem__(self,i):
+    return self.polynomials[i]
+  pass
+  
+  def __call__(self,x):
+    x                         = numpy.asarray(x,dtype=float)
+    return numpy.dot(pow(x[...,None],numpy.arange(self.degree+1)),numpy.transpose(self.params))
+  pass
+  
+  def integral(self,xmin,xmax):
+    '''
+    Evaluate the integral of all the polynomials between xmin and xmax (which can be
+    arrays)
+    '''
+    c                         = _integralBasis(xmax,self.degree+1) - _integralBasis(xmin,self.degree+1)
+    
+    return numpy.dot(c,numpy.transpose(self.params))
+  pass
+  
+  def integralError(self,xmin,xmax):
+    '''
+    Evaluate the error on the integral of all the polynomials between xmin and xmax
+    (which can be arrays)
+    '''
+    c                         = _integralBasis(xmax,self.degree+1) - _integralBasis(xmin,self.degree+1)
+    
+    err2                      = numpy.einsum('...i,cij,...j->...c',c,self.covMatrices,c,optimize=True)
+    
+    return numpy.sqrt(err2)
+  pass
+  
+  def totalIntegral(self,xmin,xmax):
+    '''
+    Return the sum of the integrals of all the polynomials between xmin and xmax
+    (which can be arrays), and its error (the polynomials are independent)
+    '''
+    total                     = numpy.sum(self.integral(xmin,xmax),axis=-1)
+    error                     = numpy.sqrt(numpy.sum(pow(self.integralError(xmin,xmax),2.0),axis=-1))
+    
+    return total, error
+  pass
+  
+pass
+
+class BatchedLogLikelihood(object):
+  '''
+  Cash statistic for many light curves sharing the same time bins and exposure
+  (for example all the channels of a CSPEC file), each one modeled with its own
+  polynomial in time. The design matrix (powers of x times the exposure) is
+  computed only once and shared among all the light curves, and the value of the
+  statistic, its gradient and its Hessian are computed together for all the light
+  curves at once, so that a gradient-based minimizer can be used instead of the
+  simplex.
+  
+  Parameters are given as a (light curves x coefficients) array, or as a 1-d
+  array of coefficients when there is only one light curve. Differently from
+  LogLikelihood, parameters giving a negative model (or a null model where there
+  are counts) have an infinite statistic instead of a linearly extrapolated one.
+  '''
+  def __init__(self,x,y,degree,**kwargs):
+    self.x                    = numpy.asarray(x,dtype=float)
+    self.y                    = numpy.asarray(y,dtype=float)
+    self.degree               = degree
+    
+    if(self.y.ndim==1):
+      self.y                  = self.y.reshape(-1,1)
+    pass
+    
+    self.exposure             = numpy.zeros(len(self.x))+1.0
+    
+    for key in list(kwargs.keys()):
+      if  (key.lower()=="exposure"):            
+        self.exposure = numpy.array(kwargs[key],dtype=float)
+    pass
+    
+    #Design matrix: basis[i,p] = exposure_i * x_i^p
+    self.basis                = numpy.vander(self.x,degree+1,increasing=True) * self.exposure[:,None]
+    
+    #Only bins with counts contribute to the D_i * log(M_i) term (and to the
+    #derivatives of it), while the M_i term is linear in the parameters:
+    #Sum(M_i) = basisSum . p
+    self.hasCounts            = (self.y > 0)
+    self.basisSum             = numpy.sum(self.basis,axis=0)
+    
+    nonzero                   = numpy.any(self.hasCounts,axis=1)
+    self.nonzeroBins          = numpy.nonzero(nonzero)[0]
+    self.yNonzero             = numpy.ascontiguousarray(self.y[nonzero])
+    self.hasCountsNonzero     = numpy.ascontiguousarray(self.hasCounts[nonzero])
+    self.basisNonzero         = numpy.ascontiguousarray(self.basis[nonzero])
+    self.basisNonzeroT        = numpy.ascontiguousarray(numpy.transpose(self.basisNonzero))
+    
+    #Work buffers, allocated once. The results of evaluate() are returned in
+    #the last three, so they are overwritten by the next evaluation
+    nBins, nCurves            = self.y.shape
+    nNonzero                  = len(self.nonzeroBins)
+    nPar                      = degree+1
+    
+    self._model               = numpy.zeros([nBins,nCurves])
+    self._modelNonzero        = numpy.zeros([nNonzero,nCurves])
+    self._ratio               = numpy.zeros([nNonzero,nCurves])
+    self._weights             = numpy.zeros([nNonzero,nCurves])
+    self._weightedBasis       = numpy.zeros([nCurves,nPar,nNonzero])
+    self._value               = numpy.zeros(nCurves)
+    self._gradient            = numpy.zeros([nCurves,nPar])
+    self._hessian             = numpy.zeros([nCurves,nPar,nPar])
+    
+    self._lastParameters      = None
+  pass
+  
+  def getModel(self,parameters):
+    '''
+    Return the expected counts, as a (bins x light curves) array
+    '''
+    return numpy.dot(self.basis,numpy.transpose(parameters))
+  pass
+  
+  def _cash(self,M,y):
+    #Poisson loglikelihood statistic (Cash): L = Sum ( M_i - D_i * log(M_i))
+    #where D_i * log(M_i) = 0 if D_i = 0
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+      d_times_logM            = numpy.where(y > 0, y * log(M), 0.0)
+    
+    return numpy.sum(M - d_times_logM,axis=0)
+  pass
+  
+  def evaluate(self,parameters):
+    '''
+    Return the Cash statistic, its gradient and its Hessian for each light curve
+    (or for the only light curve, if parameters is a 1-d array). The arrays are
+    work buffers, overwritten when evaluating a different set of parameters
+    '''
+    parameters                = numpy.asarray(parameters,dtype=float)
+    
+    #Minimizers usually ask for the value and the derivatives at the same point
+    if(self._lastParameters is None or not numpy.array_equal(parameters,self._lastParameters)):
+      self._compute(parameters.reshape(-1,self.basis.shape[1]))
+      self._lastParameters    = parameters.copy()
+    pass
+    
+    if(parameters.ndim==1):
+      return float(self._value[0]), self._gradient[0], self._hessian[0]
+    else:
+      return self._value, self._gradient, self._hessian
+  pass
+  
+  def _compute(self,parameters):
+    
+    numpy.dot(self.basis,numpy.transpose(parameters),out=self._model)
+    numpy.take(self._model,self.nonzeroBins,axis=0,out=self._modelNonzero)
+    
+    #The entries of the buffers for bins without counts are never written, so
+    #they stay null
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+      #L = Sum ( M_i - D_i * log(M_i))
+      numpy.log(self._modelNonzero,out=self._ratio,where=self.hasCountsNonzero)
+      numpy.dot(parameters,self.basisSum,out=self._value)
+      self._value            -= numpy.einsum('ic,ic->c',self.yNonzero,self._ratio)
+      
+      #Negative models, or null models where there are counts (which give an
+      #infinite or undefined value), are not acceptable in the Poisson context
+      acceptable              = (numpy.min(self._model,axis=0) >= 0) & numpy.isfinite(self._value)
+      
+      #dL / dp = Sum [ (dM/dp)_i (1 - D_i/M_i) ]
+      numpy.divide(self.yNonzero,self._modelNonzero,out=self._ratio,where=self.hasCountsNonzero)
+      numpy.dot(numpy.transpose(self._ratio),self.basisNonzero,out=self._gradient)
+      numpy.subtract(self.basisSum,self._gradient,out=self._gradient)
+      
+      #d2L / dp dq = Sum [ (dM/dp)_i (dM/dq)_i D_i/M_i^2 ]
+      numpy.divide(self._ratio,self._modelNonzero,out=self._weights,where=self.hasCountsNonzero)
+      numpy.multiply(self.basisNonzeroT,numpy.transpose(self._weights)[:,None,:],out=self._weightedBasis)
+      numpy.matmul(self._weightedBasis,self.basisNonzero,out=self._hessian)
+    pass
+    
+    if(not numpy.all(acceptable)):
+      self._value[~acceptable]    = numpy.inf
+      self._gradient[~acceptable] = 0.0
+      self._hessian[~acceptable]  = 0.0
+    pass
+  pass
+  
+  def __call__(self,parameters):
+    '''
+      Evaluate the Cash statistic for each light curve
+    '''
+    return self.evaluate(parameters)[0]
+  pass
+  
+  def getValueAndFreeDerivs(self,parameters):
+    #Minimizers keep the gradient of the current point while trying new ones,
+    #so return a copy of the buffer
+    value, gradient, hessian  = self.evaluate(parameters)
+    return value, gradient.copy()
+  pass
+  
+  def getFreeDerivs(self,parameters):
+    '''
+    Return the gradient of the Cash statistic for each light curve, as a
+    (light curves x coefficients) array
+    '''
+    return self.evaluate(parameters)[1].copy()
+  pass
+  
+  def getHessian(self,parameters):
+    '''
+    Return the Hessian of the Cash statistic for each light curve, as a
+    (light curves x coefficients x coefficients) array
+    '''
+    return self.evaluate(parameters)[2].copy()
+  pass
+  
+pass
+
+def fitPolynomialsBatched(x,y,exposure,degree,tolerance=1e-9,maxIterations=100):
+  '''
+  Fit at the same time a polynomial of the given degree to each column of y
+  (counts, as a bins x light curves array), by minimizing the Cash statistic
+  with damped Newton steps. The statistic is convex in the coefficients of the
+  polynomial, so this converges to the same minimum found by the simplex,
+  in a handful of iterations.
+  
+  Returns a list of Polynomial instances (with covariance matrix), an array with
+  the minimum value of the statistic, and a boolean array which is False for the
+  light curves where the fit did not converge.
+  '''
+  x                           = numpy.asarray(x,dtype=float)
+  y                           = numpy.asarray(y,dtype=float)
+  exposure                    = numpy.asarray(exposure,dtype=float)
+  
+  if(y.ndim==1):
+    y                         = y.reshape(-1,1)
+  pass
+  
+  nCurves                     = y.shape[1]
+  nPar                        = degree+1
+  
+  #Work with x in [-1,1] to keep the design matrix well conditioned.
+  #Coefficients are transformed back at the end
+  scale                       = numpy.max(numpy.abs(x))
+  if(scale==0):
+    scale                     = 1.0
+  pass
+  
+  logLikelihood               = BatchedLogLikelihood(x/scale,y,degree,exposure=exposure)
+  
+  #Initial guess: least square fit of the rate, as numpy.polyfit would do.
+  #If the result is not positive everywhere, start from a constant instead
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    params                    = numpy.transpose(numpy.linalg.lstsq(logLikelihood.basis/exposure[:,None],
+                                                                   y/exposure[:,None],rcond=None)[0])
+  pass
+  
+  constant                    = numpy.zeros([nCurves,nPar])
+  constant[:,0]               = numpy.sum(y,axis=0)/numpy.sum(exposure)
+  
+  bad                         = numpy.any(logLikelihood.getModel(params) <= 0,axis=0)
+  params[bad]                 = constant[bad]
+  
+  converged                   = numpy.zeros(nCurves,dtype=bool)
+  
+  #Light curves without counts cannot be fitted
+  failed                      = (numpy.sum(y,axis=0) <= 0)
+  params[failed]              = 1.0
+  
+  values                      = logLikelihood(params).copy()
+  
+  for iteration in range(maxIterations):
+    
+    active                    = ~(converged | failed)
+    
+    if(not numpy.any(active)):
+      break
+    pass
+    
+    #The line search below does not evaluate the likelihood through evaluate(),
+    #so the buffers are not overwritten before being used
+    _, gradient, hessian      = logLikelihood.evaluate(params)
+    
+    step                      = numpy.zeros([nCurves,nPar])
+    
+    for i in numpy.nonzero(active)[0]:
+      try:
+        step[i]               = numpy.linalg.solve(hessian[i],gradient[i])
+      except numpy.linalg.LinAlgError:
+        failed[i]             = True
+    pass
+    
+    #Newton decrement: half of it estimates the distance from the minimum
+    decrement                 = numpy.sum(gradient*step,axis=1)
+    
+    converged                |= active & ~failed & (decrement/2.0 < tolerance)
+    active                    = ~(converged | failed)
+    
+    #Backtracking line search, keeping the model positive
+    stepSize                  = numpy.ones(nCurves)
+    todo                      = active.copy()
+    
+    for halving in range(50):
+      
+      if(not numpy.any(todo)):
+        break
       pass
-      err2                   += c[i]*s
+      
+      trial                   = params[todo] - stepSize[todo,None]*step[todo]
+      M                       = numpy.dot(logLikelihood.basis,numpy.transpose(trial))
+      positive                = numpy.all(M > 0,axis=0)
+      trialValues             = numpy.where(positive,
+                                            logLikelihood._cash(numpy.where(M > 0,M,1.0),y[:,todo]),
+                                            numpy.inf)
+      
+      accepted                = trialValues <= values[todo] - 1e-4*stepSize[todo]*decrement[todo]
+      
+      idx                     = numpy.nonzero(todo)[0]
+      params[idx[accepted]]   = trial[accepted]
+      values[idx[accepted]]   = trialValues[accepted]
+      
+      todo[idx[accepted]]     = False
+      stepSize[todo]         /= 2.0
+    pass
+    
+    #No decrease possible: we are at the minimum within the numerical precision
+    #if the Newton decrement is small, otherwise the fit failed
+    converged                |= todo & (decrement/2.0 < 1e3*tolerance)
+    failed                   |= todo & ~converged
+  pass
+  
+  converged                  &= ~failed
+  
+  #Go back to the original x, and get the covariance matrix from the Hessian
+  toOriginal                  = pow(scale,-numpy.arange(nPar,dtype=float))
+  hessian                     = logLikelihood.getHessian(params)
+  
+  polynomials                 = []
+  for i in range(nCurves):
+    polynomial                = Polynomial(params[i]*toOriginal)
+    
+    if(converged[i]):
+      try:
+        covariance            = numpy.linalg.inv(hessian[i])
+        polynomial.setCovarianceMatrix(covariance * numpy.outer(toOriginal,toOriginal))
+      except (numpy.linalg.LinAlgError,GtBurstException):
+        converged[i]          = False
     pass
     
-    return math.sqrt(err2)
+    polynomials.append(polynomial)
   pass
   
+  return polynomials, values, converged
 pass
 
 def computeCovarianceMatrix(grad,par,full_output=False,
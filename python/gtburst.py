@@ -1648,7 +1648,8 @@ class GUI(object, metaclass=MetaForExceptions):
         configureWindow.bottomtext.image_create(END, image=self.lightbulb)
         configureWindow.bottomtext.insert(END,
                                           "These values can be changed also by setting the environment "
-                                          "variables GTBURST_DATA, GTBURST_FTP, GTBURST_NCPUS")
+                                          "variables GTBURST_DATA, GTBURST_FTP, GTBURST_NCPUS, GTBURST_PRODUCT_CACHE_SIZE, "
+                                          "GTBURST_VALIDATE_DIFFRSP")
         configureWindow.bottomtext.config(state="disabled")
 
         # Read and write a configuration file
@@ -1656,7 +1657,7 @@ class GUI(object, metaclass=MetaForExceptions):
         sortedKeys = sorted(self.configuration.keys())
 
         for key in list(self.configuration.keys()):
-            if (key != 'maxNumberOfCPUs'):
+            if (key not in ['maxNumberOfCPUs', 'productCacheSize', 'validateDiffuseResponse']):
                 directory = True
                 browser = True
             else:
@@ -1689,7 +1690,8 @@ class GUI(object, metaclass=MetaForExceptions):
         showinfo("NOTE",
                  "The configuration will be active for this session only. If you want "
                  "to override the defaults for all future sessions, set the environment "
-                 "variables GTBURST_DATA, GTBURST_FTP and GTBURST_NCPUS", parent=window)
+                 "variables GTBURST_DATA, GTBURST_FTP, GTBURST_NCPUS, GTBURST_PRODUCT_CACHE_SIZE "
+                 "and GTBURST_VALIDATE_DIFFRSP", parent=window)
         window.destroy()
 
         pass